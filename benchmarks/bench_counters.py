@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Counter store benchmark: traffic totals and the ingest delta buffer as CounterStore
+against the old dict of [outgoing, incoming] lists, for a large user population.
+
+Reported for totals: memory per user (username strings excluded, both keep them),
+how much longer a full garbage collection pass takes with totals alive, and timer
+thread operations: merging delta of --active users and building their rows for the
+database write (every write period), exporting all totals (shutdown snapshot) and
+loading all totals from database rows (start).
+
+Reported for delta buffer: adding --records parsed records of --active users the way
+ingest does, memory per active user, and packing the swapped buffer for a worker or
+edge frame.
+
+Usage: python3 benchmarks/bench_counters.py [--users 500000] [--active 10000]
+                                            [--records 1000000]
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+# pylint: enable=C0413
+
+
+def legacy_load(rows):
+    """Totals as they were before CounterStore"""
+    return {username: [outgoing, incoming] for username, outgoing, incoming in rows}
+
+
+def legacy_merge(totals, delta):
+    """TrafficCounters.merge before CounterStore"""
+    for username, value in delta.items():
+        total = totals.get(username)
+        if total is None:
+            totals[username] = [value[0], value[1]]
+        else:
+            total[0] += value[0]
+            total[1] += value[1]
+
+
+def legacy_ingest(records):
+    """TrafficCounters.add_records before CounterStore"""
+    delta = defaultdict(lambda: [0, 0])
+    for username, direction, nbytes in records:
+        delta[username][direction] += nbytes
+    return delta
+
+
+def legacy_pack(delta):
+    """TrafficCounters.pack_delta before CounterStore"""
+    usernames = list(delta)
+    values = array("Q")
+    for username in usernames:
+        values.extend(delta[username])
+    return usernames, values
+
+
+def legacy_rows(totals, usernames):
+    """TrafficCounters.rows before CounterStore"""
+    return [(username,) + tuple(totals[username]) for username in usernames if username in totals]
+
+
+def store_load(rows):
+    """Totals as CounterStore"""
+    store = trafmon.CounterStore()
+    store.load(rows)
+    return store
+
+
+def store_ingest(records):
+    """Delta buffer as TrafficCounters.add_records fills it"""
+    delta = trafmon.CounterStore()
+    slots = delta.slots
+    columns = (delta.outgoing, delta.incoming)
+    for username, direction, nbytes in records:
+        slot = slots.get(username)
+        if slot is None:
+            slot = delta.slot(username)
+        columns[direction][slot] += nbytes
+    return delta
+
+
+def timed(function, *args, repeat=3):
+    """Best of repeat runs in milliseconds, and the last result"""
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def measure(name, load, merge, rows_of, export, rows, delta, active):
+    """One implementation, returns dict of results"""
+    gc_base_ms, _ = timed(gc.collect)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    totals = load(rows)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    gc_ms, _ = timed(gc.collect)
+    load_ms, _ = timed(load, rows)
+    # Merging changes totals, every repeat adds the same delta once more
+    merge_ms, _ = timed(merge, totals, delta)
+    rows_ms, _ = timed(rows_of, totals, active)
+    export_ms, _ = timed(export, totals)
+    return {"name": name, "bytes_per_user": memory / len(rows), "gc_ms": gc_ms - gc_base_ms,
+            "load_ms": load_ms, "merge_ms": merge_ms, "rows_ms": rows_ms,
+            "export_ms": export_ms}
+
+
+def measure_delta(name, ingest, pack, records):
+    """One delta buffer implementation, returns dict of results"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    delta = ingest(records)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    ingest_ms, delta = timed(ingest, records)
+    pack_ms, _ = timed(pack, delta)
+    return delta, {"name": name, "bytes_per_user": memory / len(delta),
+                   "ingest_ms": ingest_ms, "pack_ms": pack_ms}
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="Traffic totals memory and speed")
+    parser.add_argument("--users", type=int, default=500000, help="Users in totals.")
+    parser.add_argument("--active", type=int, default=10000,
+                        help="Users with traffic in one write period.")
+    parser.add_argument("--records", type=int, default=1000000,
+                        help="Parsed records in one write period.")
+    parser.add_argument("--seed", type=int, default=1, help="Generator seed.")
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    usernames = ["user%07d" % i for i in range(args.users)]
+    # Cumulative byte counters of a long running proxy do not fit small ints
+    rows = [(username, rand.randrange(1 << 32, 1 << 40), rand.randrange(1 << 32, 1 << 40))
+            for username in usernames]
+    active = rand.sample(usernames, min(args.active, args.users))
+    # Every active user has traffic, some users much more than others
+    records = [(username, rand.randrange(2), rand.randrange(1, 1 << 16)) for username in active]
+    records += [(rand.choice(active), rand.randrange(2), rand.randrange(1, 1 << 16))
+                for _ in range(args.records - len(records))]
+
+    legacy_delta, legacy_result = measure_delta("dict of lists", legacy_ingest, legacy_pack,
+                                                records)
+    store_delta, store_result = measure_delta("CounterStore", store_ingest,
+                                              trafmon.CounterStore.export, records)
+    results = [
+        measure("dict of lists", legacy_load, legacy_merge, legacy_rows,
+                legacy_pack, rows, legacy_delta, active),
+        measure("CounterStore", store_load, trafmon.CounterStore.add_delta,
+                trafmon.CounterStore.rows, trafmon.CounterStore.export, rows, store_delta,
+                active),
+    ]
+
+    print("users %d, active per write period %d, records per write period %d" %
+          (args.users, len(active), len(records)))
+    print("%-14s %14s %8s %9s %9s %9s %10s" % ("totals", "bytes/user", "gc ms", "load ms",
+                                              "merge ms", "rows ms", "export ms"))
+    for result in results:
+        print("%-14s %14.1f %8.1f %9.1f %9.2f %9.2f %10.1f" %
+              (result["name"], result["bytes_per_user"], result["gc_ms"], result["load_ms"],
+               result["merge_ms"], result["rows_ms"], result["export_ms"]))
+    print()
+    print("%-14s %14s %10s %9s" % ("delta buffer", "bytes/user", "ingest ms", "pack ms"))
+    for result in (legacy_result, store_result):
+        print("%-14s %14.1f %10.1f %9.2f" % (result["name"], result["bytes_per_user"],
+                                             result["ingest_ms"], result["pack_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Ingest stress test: parse throughput while database writes stall.
+
+Timer thread writes through a fake database writer, which hangs for --stall
+seconds on every write. Ingest throughput is reported per time window,
+windows which overlap a stalled write are marked.
+
+Usage: python3 benchmarks/bench_db_stall.py [--duration 10] [--stall 2]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+from loggen import LogGenerator
+# pylint: enable=C0413
+
+
+class StallingWriter:
+    """Database writer stand-in which hangs on every write"""
+
+    def __init__(self, stall):
+        self.stall = stall
+        self.intervals = []
+        self.last_flush_rows = 0
+        self.last_flush_latency = 0.0
+
+    def add_delta(self, delta, reset=False):
+        """Deltas are not needed"""
+
+    def write_traffic(self, rows):
+        """Pretend to write, but hang for a while"""
+        started = time.perf_counter()
+        time.sleep(self.stall)
+        finished = time.perf_counter()
+        self.intervals.append((started, finished))
+        self.last_flush_rows = len(rows)
+        self.last_flush_latency = finished - started
+        return 0, "OK!"
+
+    def close(self):
+        """Nothing to close"""
+
+    def stalled(self, start, end):
+        """True if any write overlaps [start, end) interval"""
+        return any(s < end and f > start for s, f in self.intervals)
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="Ingest throughput under database stalls")
+    parser.add_argument("--duration", type=float, default=10, help="Test duration, seconds.")
+    parser.add_argument("--stall", type=float, default=2, help="Every write hangs that long.")
+    parser.add_argument("--period", type=float, default=2, help="Timer write period, seconds.")
+    parser.add_argument("--window", type=float, default=0.5, help="Reporting window, seconds.")
+    args = parser.parse_args()
+
+    app = trafmon.Application()
+    app.verbose = 0
+    app.write_period = args.period
+    app.snapshot_enabled = False
+
+    log_thread = trafmon.LogThread("BENCH", trafmon.LogThread.LOG_TYPE_DANTE, app)
+    timer = trafmon.TimerThread(application=app, log_thread=log_thread)
+    timer.data_init_from_db = lambda: (0, "OK!")
+    timer.writer = StallingWriter(args.stall)
+
+    batch = LogGenerator(users=10000).lines(1000)
+    progress = []
+
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            timer.start()
+            started = time.perf_counter()
+            while time.perf_counter() - started < args.duration:
+                log_thread.parse_lines(batch)
+                progress.append(time.perf_counter())
+            log_thread.stop()
+            timer.join()
+        finally:
+            sys.stdout = stdout
+
+    windows = []
+    start = started
+    while start < started + args.duration:
+        end = start + args.window
+        count = sum(1 for t in progress if start <= t < end) * len(batch)
+        windows.append((start - started, count / args.window, timer.writer.stalled(start, end)))
+        start = end
+
+    for offset, rate, stalled in windows:
+        print("t=%5.1fs  lines/sec=%10.0f  %s" % (offset, rate, "DB STALLED" if stalled else ""))
+
+    stalled_rates = [rate for _, rate, stalled in windows if stalled]
+    free_rates = [rate for _, rate, stalled in windows if not stalled]
+    if stalled_rates and free_rates:
+        print("mean lines/sec, database stalled : %10.0f" % (sum(stalled_rates) / len(stalled_rates)))
+        print("mean lines/sec, database idle    : %10.0f" % (sum(free_rates) / len(free_rates)))
+
+
+if __name__ == "__main__":
+    main()
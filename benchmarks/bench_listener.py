@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Listener benchmark: total parsed lines/sec as number of concurrent
+log feeds (dante servers) grows.
+
+Usage: python3 benchmarks/bench_listener.py [--lines N] [--senders 1,4,16,64] [--parser-threads 1]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+from loggen import LogGenerator
+# pylint: enable=C0413
+
+
+class NullTimer(threading.Thread):
+    """Timer thread replacement, benchmark measures ingestion only"""
+    def __init__(self, application, log_thread):
+        super(NullTimer, self).__init__(daemon=True)
+
+    def run(self):
+        pass
+
+
+def free_port():
+    """Find free TCP port on loopback"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def send_feed(port, payload, barrier):
+    """One log feed, connects and sends all its lines"""
+    conn = socket.create_connection(("127.0.0.1", port))
+    barrier.wait()
+    conn.sendall(payload)
+    conn.close()
+
+
+def run_once(senders, lines_total, parser_threads):
+    """Run listener with given number of concurrent feeds, return lines/sec"""
+    app = trafmon.Application()
+    app.verbose = 0
+    app.listen_port = free_port()
+    app.ingest_parser_threads = parser_threads
+
+    thread = trafmon.LogThread("BENCH", trafmon.LogThread.LOG_TYPE_DANTE, app)
+    thread.start()
+    time.sleep(0.2)
+
+    generator = LogGenerator(users=1000, seed=senders)
+    per_sender = lines_total // senders
+    payloads = [generator.payload(per_sender) for _ in range(senders)]
+    expected = generator.bytes_total
+
+    barrier = threading.Barrier(senders + 1)
+    feeds = [threading.Thread(target=send_feed, args=(app.listen_port, payload, barrier))
+             for payload in payloads]
+    for feed in feeds:
+        feed.start()
+    barrier.wait()
+    started = time.perf_counter()
+
+    # Wait until every byte is accounted for, or until counters stop moving
+    received, last_change, elapsed = 0, started, 0
+    while time.perf_counter() - last_change < 2:
+        current = sum(v[0] + v[1] for v in app.counters.snapshot().values())
+        if current != received:
+            received, last_change = current, time.perf_counter()
+            elapsed = last_change - started
+        if received >= expected:
+            break
+        time.sleep(0.005)
+
+    for feed in feeds:
+        feed.join()
+    thread.stop()
+    thread.join()
+
+    return per_sender * senders / elapsed, received == expected
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="Concurrent listener benchmark")
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="Total lines to send per run.")
+    parser.add_argument("--senders", default="1,4,16,64,256",
+                        help="Comma-separated list of concurrent feed counts.")
+    parser.add_argument("--parser-threads", type=int, default=1,
+                        help="Parser threads behind ingest queue, 0 parses in receiver loop.")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        trafmon.TimerThread = NullTimer
+        for senders in [int(x) for x in args.senders.split(",")]:
+            sys.stdout = devnull
+            try:
+                rate, complete = run_once(senders, args.lines, args.parser_threads)
+            finally:
+                sys.stdout = stdout
+            print("senders=%-5d lines/sec=%12.0f %s" %
+                  (senders, rate, "" if complete else "(INCOMPLETE)"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Parser micro-benchmark: lines/sec of IoopParser against the old two-regex path.
+
+Usage: python3 benchmarks/bench_parser.py [--lines N] [--file danted.log ...]
+Without --file a synthetic corpus is generated.
+"""
+
+import argparse
+import gzip
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=C0413
+from dante_trafmon import IoopParser
+from loggen import LogGenerator
+# pylint: enable=C0413
+
+
+def legacy_parse(lines):
+    """Parsing loop as it was before IoopParser, without prints"""
+    traffic = defaultdict(lambda: [0, 0])
+    for line in lines:
+        regex = r'.*username\%(.*)@.*->.*\((.*)\)'
+        res = re.match(regex, line)
+        if res:
+            traffic[res.groups()[0]][0] += int(res.groups()[1])
+        else:
+            regex = r'.*->.*username\%(.*)@.*\((.*)\)'
+            res = re.match(regex, line)
+            if res:
+                traffic[res.groups()[0]][1] += int(res.groups()[1])
+    return traffic
+
+
+def ioop_parse(lines):
+    """Parsing loop with IoopParser"""
+    traffic = defaultdict(lambda: [0, 0])
+    parse = IoopParser().parse
+    for line in lines:
+        record = parse(line)
+        if record is not None:
+            traffic[record.username][record.direction] += record.nbytes
+    return traffic
+
+
+def load_corpus(files):
+    """Read log lines from plain or gzipped files"""
+    lines = []
+    for filename in files:
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "rt", encoding="utf-8", errors="replace") as handler:
+            lines.extend(line.rstrip("\n") for line in handler)
+    return lines
+
+
+def measure(function, lines, repeat):
+    """Best of repeat runs, returns (lines/sec, result)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(lines)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best, result
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="dante ioop parser micro-benchmark")
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="Synthetic corpus size.")
+    parser.add_argument("--noise", type=float, default=0.1,
+                        help="Share of non-ioop lines in synthetic corpus.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per parser, best one is reported.")
+    parser.add_argument("--file", nargs="*", default=None,
+                        help="Real dante log files to use as corpus.")
+    args = parser.parse_args()
+
+    if args.file:
+        lines = load_corpus(args.file)
+    else:
+        lines = LogGenerator(users=5000, noise_ratio=args.noise).lines(args.lines)
+
+    legacy_rate, legacy_result = measure(legacy_parse, lines, args.repeat)
+    ioop_rate, ioop_result = measure(ioop_parse, lines, args.repeat)
+
+    print("corpus lines      : %d" % len(lines))
+    print("legacy regex      : %12.0f lines/sec" % legacy_rate)
+    print("IoopParser        : %12.0f lines/sec  (x%.1f)" %
+          (ioop_rate, ioop_rate / legacy_rate))
+    print("results identical : %s" % (dict(legacy_result) == dict(ioop_result)))
+
+
+if __name__ == "__main__":
+    main()
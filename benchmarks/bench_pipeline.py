@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark: synthetic dante feeds -> LogThread -> TimerThread -> database.
+
+Reports ingest throughput, ingest-to-persist latency (p50/p99), memory and dropped
+bytes. Latency is measured with probe lines for unique users, sent at known times
+on a separate connection, until the database write containing them returns.
+
+Database is an in-process fake by default (--database fake), embedded SQLite or
+snapshot file storage in a temporary directory (--database sqlite|file), or a throwaway
+local PostgreSQL with empty "traffic" table, configured with --config (--database pgsql).
+Runs are seeded, so results of the same parameters are comparable; --json saves them.
+
+Usage: python3 benchmarks/bench_pipeline.py [--lines N] [--senders 8] [--users 10000]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+from loggen import LogGenerator, ioop_line
+# pylint: enable=C0413
+
+PROBE_PREFIX = "zzprobe"
+
+
+class FakeDatabaseWriter:
+    """In-process stand-in for storage backend, every write succeeds instantly"""
+
+    def __init__(self, application):
+        self.app = application
+        self.last_flush_rows = 0
+        self.last_flush_latency = 0.0
+        self.flushes = 0
+
+    def load_traffic(self):
+        """Nothing is stored before the run"""
+        return []
+
+    def iter_traffic(self):
+        """Nothing is stored before the run"""
+        yield []
+
+    def add_delta(self, delta, reset=False):
+        """Deltas are not needed"""
+
+    def write_traffic(self, rows):
+        """Store rows"""
+        started = time.perf_counter()
+        self.last_flush_rows = len(rows)
+        self.last_flush_latency = time.perf_counter() - started
+        self.flushes += 1
+        return 0, "OK!"
+
+    def write_history(self, tables, cutoffs=None):
+        """History is not measured"""
+        return 0, "OK!"
+
+    def close(self):
+        """Nothing to close"""
+
+
+class ProbeWriter:
+    """Wraps a writer, keeps persisted counters and records when rows
+    of probe users were persisted"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.persisted = {}
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def write_traffic(self, rows):
+        """Write rows, note probe users"""
+        result = self.inner.write_traffic(rows)
+        if result[0] == 0:
+            now = time.perf_counter()
+            with self.lock:
+                for username, outgoing, incoming in rows:
+                    if username.startswith(PROBE_PREFIX):
+                        self.persisted.setdefault(username, now)
+                    else:
+                        self.rows[username] = outgoing + incoming
+        return result
+
+    def persisted_bytes(self):
+        """Sum of persisted counters, probe users excluded"""
+        with self.lock:
+            return sum(self.rows.values())
+
+
+def free_port():
+    """Find free TCP port on loopback"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def send_feed(port, payload, start_event):
+    """Sender process, one dante server feed"""
+    conn = socket.create_connection(("127.0.0.1", port))
+    start_event.wait()
+    conn.sendall(payload)
+    conn.close()
+
+
+def send_probes(port, interval, stop_event, sent):
+    """Send probe lines with unique usernames, recording send time"""
+    conn = socket.create_connection(("127.0.0.1", port))
+    index = 0
+    while not stop_event.is_set():
+        username = PROBE_PREFIX + "%06d" % index
+        line = ioop_line(time.time(), username, "10.1.1.1.40000", "1.2.3.4.80", True, 1)
+        sent[username] = time.perf_counter()
+        conn.sendall((line + "\n").encode("utf-8"))
+        index += 1
+        stop_event.wait(interval)
+    conn.close()
+
+
+def percentile(values, share):
+    """Nearest-rank percentile"""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def rss_kb():
+    """Current resident set size, KiB"""
+    try:
+        with open("/proc/self/statm") as handler:
+            return int(handler.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return 0
+
+
+def run(args, workdir):
+    """Run one benchmark, returns dict of results"""
+    app = trafmon.Application()
+    app.verbose = 0
+    app.listen_port = free_port()
+    app.write_period = args.write_period
+    app.state_directory = workdir
+    if args.config:
+        app.parse_config_file(args.config)
+        app.verbose = 0
+        app.listen_port = free_port()
+        app.write_period = args.write_period
+        app.state_directory = workdir
+    if args.database in ("sqlite", "file"):
+        app.db_backend = args.database
+        app.db_path = os.path.join(workdir, "traffic.db")
+
+    generator = LogGenerator(users=args.users, incoming_ratio=args.incoming,
+                             noise_ratio=args.noise, seed=args.seed)
+    per_sender = args.lines // args.senders
+    payloads = [generator.payload(per_sender) for _ in range(args.senders)]
+    expected = generator.bytes_total
+
+    probe_writers = []
+    real_storage = app.create_storage
+
+    def make_writer():
+        inner = FakeDatabaseWriter(app) if args.database == "fake" else real_storage()
+        writer = ProbeWriter(inner)
+        probe_writers.append(writer)
+        return writer
+    app.create_storage = make_writer
+
+    rss_before = rss_kb()
+    thread = trafmon.LogThread("BENCH", trafmon.LogThread.LOG_TYPE_DANTE, app)
+    thread.start()
+    time.sleep(0.5)
+
+    start_event = multiprocessing.Event()
+    senders = [multiprocessing.Process(target=send_feed,
+                                       args=(app.listen_port, payload, start_event))
+               for payload in payloads]
+    for sender in senders:
+        sender.start()
+    time.sleep(0.5)
+
+    probes_sent = {}
+    probes_stop = threading.Event()
+    prober = threading.Thread(target=send_probes,
+                              args=(app.listen_port, args.probe_interval, probes_stop,
+                                    probes_sent))
+    prober.start()
+    start_event.set()
+    started = time.perf_counter()
+
+    # Wait until feeds are fully persisted, or nothing moves anymore
+    writer = None
+    persisted, last_change, elapsed = 0, started, 0
+    while time.perf_counter() - last_change < max(3, 3 * args.write_period):
+        writer = probe_writers[0] if probe_writers else None
+        current = writer.persisted_bytes() if writer is not None else 0
+        if current != persisted:
+            persisted, last_change = current, time.perf_counter()
+            elapsed = last_change - started
+        if persisted >= expected:
+            break
+        time.sleep(0.01)
+
+    probes_stop.set()
+    prober.join()
+    time.sleep(2 * args.write_period + 0.5)
+    for sender in senders:
+        sender.join()
+    rss_after = rss_kb()
+    malformed, oversized = thread.framing_counters()
+    thread.stop()
+    thread.join()
+    thread.timer.join()
+
+    latencies = [writer.persisted[name] - probes_sent[name]
+                 for name in writer.persisted if name in probes_sent] if writer else []
+    return {
+        "parameters": vars(args),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "lines": per_sender * args.senders,
+        "seconds": elapsed,
+        "lines_per_sec": per_sender * args.senders / elapsed if elapsed else 0,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "probes": len(latencies),
+        "rss_growth_kb": rss_after - rss_before,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "expected_bytes": expected,
+        "persisted_bytes": persisted,
+        "dropped_bytes": expected - persisted,
+        "malformed_lines": malformed,
+        "oversized_lines": oversized,
+        "flushes": writer.flushes if writer else 0,
+    }
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="dante_trafmon end-to-end benchmark")
+    parser.add_argument("--lines", type=int, default=400000, help="Total ioop lines to send.")
+    parser.add_argument("--senders", type=int, default=8, help="Concurrent dante feeds.")
+    parser.add_argument("--users", type=int, default=10000, help="Distinct proxy users.")
+    parser.add_argument("--incoming", type=float, default=0.7,
+                        help="Share of incoming traffic lines.")
+    parser.add_argument("--noise", type=float, default=0.1, help="Share of non-ioop lines.")
+    parser.add_argument("--seed", type=int, default=1, help="Generator seed.")
+    parser.add_argument("--write-period", type=float, default=0.5,
+                        help="TimerThread write period, seconds.")
+    parser.add_argument("--probe-interval", type=float, default=0.05,
+                        help="Latency probe interval, seconds.")
+    parser.add_argument("--database", choices=("fake", "sqlite", "file", "pgsql"),
+                        default="fake",
+                        help="In-process fake, embedded storage in a temporary directory, "
+                             "or real PostgreSQL from --config.")
+    parser.add_argument("--config", default=None,
+                        help="dante_trafmon config with [database] of throwaway PostgreSQL.")
+    parser.add_argument("--json", default=None, help="Save results to this file.")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull, tempfile.TemporaryDirectory() as workdir:
+        sys.stdout = devnull
+        try:
+            results = run(args, workdir)
+        finally:
+            sys.stdout = stdout
+
+    for key in ("lines", "seconds", "lines_per_sec", "latency_p50_ms", "latency_p99_ms",
+                "probes", "rss_growth_kb", "max_rss_kb", "expected_bytes", "persisted_bytes",
+                "dropped_bytes", "malformed_lines", "oversized_lines", "flushes"):
+        value = results[key]
+        print("%-16s %s" % (key, ("%.2f" % value) if isinstance(value, float) else value))
+
+    if args.json:
+        with open(args.json, "w") as handler:
+            json.dump(results, handler, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
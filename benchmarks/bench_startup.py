@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: how soon dante feeds are accepted and counters are served
+after start, with a large traffic table.
+
+Database is embedded SQLite in a temporary directory (--database sqlite), or a
+throwaway local PostgreSQL with empty "traffic" table, configured with --config
+(--database pgsql). The table is filled with --users rows, then traffic monitor
+is started twice: cold (no local snapshot) and warm (snapshot saved by clean
+shutdown of the cold run). Reported, from thread start:
+  bind_ms      - listen socket accepts connections
+  counters_ms  - all users are in counters (read API and quotas see them)
+  database_ms  - totals are loaded from database
+  rss_kb       - resident memory growth of the run
+
+Usage: python3 benchmarks/bench_startup.py [--users 200000] [--database sqlite|pgsql]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+# pylint: enable=C0413
+
+
+def free_port():
+    """Find free TCP port on loopback"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_kb():
+    """Current resident set size, KiB"""
+    try:
+        with open("/proc/self/statm") as handler:
+            return int(handler.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return 0
+
+
+def make_app(args, workdir):
+    """Application over benchmark database"""
+    app = trafmon.Application()
+    if args.config:
+        app.parse_config_file(args.config)
+    app.verbose = 0
+    app.listen_port = free_port()
+    app.write_period = 0.2
+    app.state_directory = workdir
+    if args.database == "sqlite":
+        app.db_backend = "sqlite"
+        app.db_path = os.path.join(workdir, "traffic.db")
+    return app
+
+
+def fill(app, users):
+    """Store users rows in traffic table"""
+    writer = app.create_storage()
+    rows = [("user%07d" % i, i * 1000, i * 3000) for i in range(users)]
+    result, result_msg = writer.bulk_load_traffic(rows)
+    writer.close()
+    if result != 0:
+        raise RuntimeError(result_msg)
+
+
+def start_once(app, users):
+    """Start listener with timer, returns dict of timings"""
+    rss_before = rss_kb()
+    thread = trafmon.LogThread("BENCH", trafmon.LogThread.LOG_TYPE_DANTE, app)
+    started = time.perf_counter()
+    thread.start()
+
+    bind = None
+    while bind is None:
+        try:
+            socket.create_connection(("127.0.0.1", app.listen_port)).close()
+            bind = time.perf_counter() - started
+        except ConnectionRefusedError:
+            time.sleep(0.001)
+
+    while thread.timer is None:
+        time.sleep(0.001)
+    while len(app.counters.totals) < users:
+        time.sleep(0.001)
+    counters = time.perf_counter() - started
+    thread.timer.loaded.wait()
+    database = time.perf_counter() - started
+    rss = rss_kb() - rss_before
+
+    thread.stop()
+    thread.join()
+    thread.timer.join()
+    return {"bind_ms": bind * 1000, "counters_ms": counters * 1000,
+            "database_ms": database * 1000, "rss_kb": rss}
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="dante_trafmon startup benchmark")
+    parser.add_argument("--users", type=int, default=200000, help="Rows in traffic table.")
+    parser.add_argument("--database", choices=("sqlite", "pgsql"), default="sqlite",
+                        help="Embedded SQLite in a temporary directory, "
+                             "or real PostgreSQL from --config.")
+    parser.add_argument("--config", default=None,
+                        help="dante_trafmon config with [database] of throwaway PostgreSQL.")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    results = []
+    with open(os.devnull, "w") as devnull, tempfile.TemporaryDirectory() as workdir:
+        sys.stdout = devnull
+        try:
+            fill(make_app(args, workdir), args.users)
+            for name in ("cold", "warm"):
+                app = make_app(args, workdir)
+                results.append((name, start_once(app, args.users)))
+        finally:
+            sys.stdout = stdout
+
+    print("users: %d, database: %s" % (args.users, args.database))
+    for name, result in results:
+        print("%-5s bind_ms=%8.1f counters_ms=%8.1f database_ms=%8.1f rss_kb=%8d" %
+              (name, result["bind_ms"], result["counters_ms"], result["database_ms"],
+               result["rss_kb"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Wire benchmark: plain "tail > /dev/tcp" lines against compressed FrameProtocol.LINES
+frames of FrameSender.
+
+Offline part frames the same synthetic log at several zlib levels and batch sizes
+(small batches are what a quiet dante server sends every FLUSH_INTERVAL), and reports
+bytes on wire, sender CPU to compress and listener CPU to decompress, per line.
+Listener part sends the log to a running listener once plain and once framed
+(frames are built in advance, from another process) and reports lines/sec.
+
+Usage: python3 benchmarks/bench_wire.py [--lines N] [--levels 1,6,9] [--blocks 4096,65536]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+from loggen import LogGenerator
+# pylint: enable=C0413
+
+
+class NullTimer(threading.Thread):
+    """Timer thread replacement, benchmark measures ingestion only"""
+    def __init__(self, application, log_thread):
+        super(NullTimer, self).__init__(daemon=True)
+
+    def run(self):
+        pass
+
+
+def free_port():
+    """Find free TCP port on loopback"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def split_blocks(payload, block_size):
+    """Cut log into blocks of complete lines, as FrameSender does"""
+    blocks = []
+    start = 0
+    while start < len(payload):
+        end = payload.rfind(b"\n", start, start + block_size) + 1
+        if end <= start:
+            end = payload.find(b"\n", start) + 1 or len(payload)
+        blocks.append(payload[start:end - 1])
+        start = end
+    return blocks
+
+
+def frame_blocks(blocks, level):
+    """FrameProtocol.LINES frames of one connection, returns (frames, seconds)"""
+    compressor = zlib.compressobj(level)
+    started = time.process_time()
+    frames = [trafmon.FrameProtocol.pack_lines(compressor, "dante1", 1, sequence, block)
+              for sequence, block in enumerate(blocks, 1)]
+    return frames, time.process_time() - started
+
+
+def unframe(frames):
+    """Listener side: split, decompress and decode frames, returns (lines, seconds)"""
+    reader = trafmon.FrameReader()
+    decompressor = zlib.decompressobj()
+    framer = trafmon.LineFramer()
+    lines = 0
+    started = time.process_time()
+    for _, payload in reader.feed(b"".join(frames)):
+        data = trafmon.FrameProtocol.unpack_lines(decompressor, payload)[3]
+        lines += len(framer.decode(data))
+    return lines, time.process_time() - started
+
+
+def decode_plain(blocks):
+    """Listener side of plain feed: decoding only, returns seconds"""
+    framer = trafmon.LineFramer()
+    started = time.process_time()
+    for block in blocks:
+        framer.decode(block)
+    return time.process_time() - started
+
+
+def send_data(port, data, start_event):
+    """Sender process, one connection"""
+    conn = socket.create_connection(("127.0.0.1", port))
+    start_event.wait()
+    conn.sendall(data)
+    conn.close()
+
+
+def listener_rate(data, expected):
+    """Send data to a fresh listener, return lines/sec once every byte is counted"""
+    app = trafmon.Application()
+    app.verbose = 0
+    app.listen_port = free_port()
+    thread = trafmon.LogThread("BENCH", trafmon.LogThread.LOG_TYPE_DANTE, app)
+    thread.start()
+    time.sleep(0.2)
+
+    start_event = multiprocessing.Event()
+    sender = multiprocessing.Process(target=send_data, args=(app.listen_port, data, start_event))
+    sender.start()
+    time.sleep(0.2)
+    start_event.set()
+    started = time.perf_counter()
+
+    received, last_change, elapsed = 0, started, 0
+    while time.perf_counter() - last_change < 2:
+        current = sum(v[0] + v[1] for v in app.counters.snapshot().values())
+        if current != received:
+            received, last_change = current, time.perf_counter()
+            elapsed = last_change - started
+        if received >= expected:
+            break
+        time.sleep(0.005)
+
+    sender.join()
+    thread.stop()
+    thread.join()
+    return elapsed, received == expected
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="Plain against compressed log feed")
+    parser.add_argument("--lines", type=int, default=200000, help="Log lines to send.")
+    parser.add_argument("--users", type=int, default=1000, help="Distinct proxy users.")
+    parser.add_argument("--levels", default="1,6,9", help="Comma-separated zlib levels.")
+    parser.add_argument("--blocks", default="4096,65536",
+                        help="Comma-separated batch sizes, bytes of lines per frame.")
+    parser.add_argument("--seed", type=int, default=1, help="Generator seed.")
+    args = parser.parse_args()
+
+    generator = LogGenerator(users=args.users, seed=args.seed)
+    payload = generator.payload(args.lines)
+    expected = generator.bytes_total
+    print("lines %d, plain bytes on wire %d (%.1f per line)" %
+          (args.lines, len(payload), len(payload) / args.lines))
+    print("%-6s %-7s %12s %7s %14s %16s" % ("level", "block", "wire bytes", "ratio",
+                                            "sender us/line", "listener us/line"))
+
+    framed = None
+    for block_size in [int(x) for x in args.blocks.split(",")]:
+        blocks = split_blocks(payload, block_size)
+        plain_seconds = decode_plain(blocks)
+        for level in [int(x) for x in args.levels.split(",")]:
+            frames, sender_seconds = frame_blocks(blocks, level)
+            lines, listener_seconds = unframe(frames)
+            assert lines == args.lines
+            wire = len(trafmon.FrameProtocol.MAGIC) + sum(len(frame) for frame in frames)
+            print("%-6d %-7d %12d %6.1fx %14.2f %16.2f" %
+                  (level, block_size, wire, len(payload) / wire,
+                   sender_seconds / args.lines * 1e6,
+                   (listener_seconds - plain_seconds) / args.lines * 1e6))
+            if level == trafmon.FrameSender.COMPRESS_LEVEL and \
+                    block_size == trafmon.FrameSender.BLOCK_SIZE:
+                framed = trafmon.FrameProtocol.MAGIC + b"".join(frames)
+    print("listener us/line is decompression on top of plain line decoding")
+
+    if framed is None:
+        framed = trafmon.FrameProtocol.MAGIC + b"".join(
+            frame_blocks(split_blocks(payload, trafmon.FrameSender.BLOCK_SIZE),
+                         trafmon.FrameSender.COMPRESS_LEVEL)[0])
+    trafmon.TimerThread = NullTimer
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        results = []
+        for name, data in (("plain", payload), ("framed", framed)):
+            sys.stdout = devnull
+            try:
+                elapsed, complete = listener_rate(data, expected)
+            finally:
+                sys.stdout = stdout
+            results.append((name, elapsed, complete))
+    for name, elapsed, complete in results:
+        print("listener %-7s lines/sec=%12.0f %s" %
+              (name, args.lines / elapsed if elapsed else 0, "" if complete else "(INCOMPLETE)"))
+
+
+if __name__ == "__main__":
+    main()
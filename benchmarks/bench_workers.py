@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Multi-process scaling benchmark: total lines/sec for 1/2/4/8 ingest workers.
+
+Log feeds are sent by separate processes, so the benchmark process itself
+only hosts the aggregator. Database writes are not included.
+
+Usage: python3 benchmarks/bench_workers.py [--lines N] [--feeds 32] [--workers 1,2,4,8]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=C0413
+from dante_trafmon import dante_trafmon as trafmon
+from loggen import LogGenerator
+# pylint: enable=C0413
+
+
+class NullTimer(threading.Thread):
+    """Timer thread replacement, benchmark measures ingestion only"""
+    def __init__(self, application, log_thread):
+        super(NullTimer, self).__init__(daemon=True)
+
+    def run(self):
+        pass
+
+
+def free_port():
+    """Find free TCP port on loopback"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def send_feeds(port, payloads, start_event):
+    """Sender process, opens one connection per payload and sends them all"""
+    conns = [socket.create_connection(("127.0.0.1", port)) for _ in payloads]
+    start_event.wait()
+    threads = [threading.Thread(target=conn.sendall, args=(payload,))
+               for conn, payload in zip(conns, payloads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for conn in conns:
+        conn.close()
+
+
+def run_once(workers, feeds, lines_total):
+    """Run aggregator with given number of workers, return lines/sec"""
+    app = trafmon.Application()
+    app.verbose = 0
+    app.workers = workers
+    app.listen_port = free_port()
+
+    generator = LogGenerator(users=1000, seed=workers)
+    per_feed = lines_total // feeds
+    payloads = [generator.payload(per_feed) for _ in range(feeds)]
+    expected = generator.bytes_total
+
+    if workers > 1:
+        aggregator = trafmon.AggregatorThread("BENCH", app)
+    else:
+        aggregator = trafmon.LogThread("BENCH", trafmon.LogThread.LOG_TYPE_DANTE, app)
+    aggregator.start()
+    time.sleep(0.5)
+
+    start_event = multiprocessing.Event()
+    senders = [multiprocessing.Process(target=send_feeds,
+                                       args=(app.listen_port, payloads[i::4], start_event))
+               for i in range(min(4, feeds))]
+    for sender in senders:
+        sender.start()
+    time.sleep(0.5)
+    start_event.set()
+    started = time.perf_counter()
+
+    received, last_change, elapsed = 0, started, 0
+    while time.perf_counter() - last_change < 3:
+        current = sum(v[0] + v[1] for v in app.counters.snapshot().values())
+        if current != received:
+            received, last_change = current, time.perf_counter()
+            elapsed = last_change - started
+        if received >= expected:
+            break
+        time.sleep(0.01)
+
+    for sender in senders:
+        sender.join()
+    aggregator.stop()
+    aggregator.join()
+    return per_feed * feeds / elapsed, received == expected
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="Ingest worker processes scaling benchmark")
+    parser.add_argument("--lines", type=int, default=400000, help="Total lines per run.")
+    parser.add_argument("--feeds", type=int, default=32, help="Concurrent log feeds.")
+    parser.add_argument("--workers", default="1,2,4,8",
+                        help="Comma-separated list of worker counts.")
+    args = parser.parse_args()
+
+    print("CPU cores: %d" % os.cpu_count())
+    trafmon.TimerThread = NullTimer
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        for workers in [int(x) for x in args.workers.split(",")]:
+            sys.stdout = devnull
+            try:
+                rate, complete = run_once(workers, args.feeds, args.lines)
+            finally:
+                sys.stdout = stdout
+            print("workers=%-3d lines/sec=%12.0f %s" %
+                  (workers, rate, "" if complete else "(INCOMPLETE)"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Synthetic dante "ioop" log generator, used by the benchmarks"""
+
+import random
+import time
+from collections import defaultdict
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+PROXY_ADDRESS = "10.0.0.1"
+PROXY_PORT = 1080
+
+
+def ioop_line(timestamp, username, client, target, outgoing, nbytes, pid=4242):
+    """Format one dante ioop log line.
+    Outgoing lines have username on the left side of "->", incoming on the right."""
+    tm = time.gmtime(timestamp)
+    prefix = "%s %2d %02d:%02d:%02d (%.6f) danted[%d]: info: pass(1): tcp/connect -: " % (
+        MONTHS[tm.tm_mon - 1], tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec,
+        timestamp, pid)
+    user_ep = "username%" + username + "@" + client
+    if outgoing:
+        return (prefix + user_ep + " " + PROXY_ADDRESS + "." + str(PROXY_PORT) +
+                " -> " + PROXY_ADDRESS + ".52113 " + target + " (" + str(nbytes) + ")")
+    return (prefix + target + " " + PROXY_ADDRESS + ".52113 -> " +
+            PROXY_ADDRESS + "." + str(PROXY_PORT) + " " + user_ep +
+            " (" + str(nbytes) + ")")
+
+
+def noise_line(timestamp, client, pid=4242):
+    """Format non-ioop dante log line, which should be ignored by parser"""
+    tm = time.gmtime(timestamp)
+    return "%s %2d %02d:%02d:%02d (%.6f) danted[%d]: info: pass(1): tcp/accept [: %s %s.%d" % (
+        MONTHS[tm.tm_mon - 1], tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec,
+        timestamp, pid, client, PROXY_ADDRESS, PROXY_PORT)
+
+
+class LogGenerator:
+    """
+    Generates realistic dante log traffic for configurable number of users.
+    Keeps expected per-user totals, so benchmarks can verify nothing was lost.
+    """
+
+    def __init__(self, users=100, targets=500, incoming_ratio=0.7, noise_ratio=0.1,
+                 seed=1, start_time=None, lines_per_second=1000):
+        self.random = random.Random(seed)
+        self.users = ["proxyuser%05d" % i for i in range(users)]
+        self.clients = ["192.168.%d.%d.%d" % (i // 250, i % 250 + 1, 40000 + i)
+                        for i in range(users)]
+        self.targets = ["%d.%d.%d.%d.%d" % (self.random.randint(1, 223),
+                                            self.random.randint(0, 255),
+                                            self.random.randint(0, 255),
+                                            self.random.randint(1, 254),
+                                            self.random.choice((80, 443, 8080)))
+                        for _ in range(targets)]
+        self.incoming_ratio = incoming_ratio
+        self.noise_ratio = noise_ratio
+        self.timestamp = time.time() if start_time is None else start_time
+        self.time_step = 1.0 / lines_per_second
+        # username -> [outgoing, incoming]
+        self.expected = defaultdict(lambda: [0, 0])
+        self.bytes_total = 0
+
+    def line(self):
+        """Generate next log line"""
+        rnd = self.random
+        self.timestamp += self.time_step
+        # Skewed user popularity, few users make most of traffic
+        idx = min(int(rnd.paretovariate(1.2)) - 1, len(self.users) - 1)
+        if rnd.random() < self.noise_ratio:
+            return noise_line(self.timestamp, self.clients[idx])
+        incoming = rnd.random() < self.incoming_ratio
+        nbytes = rnd.randint(1, 16384) if incoming else rnd.randint(1, 2048)
+        username = self.users[idx]
+        self.expected[username][1 if incoming else 0] += nbytes
+        self.bytes_total += nbytes
+        return ioop_line(self.timestamp, username, self.clients[idx],
+                         rnd.choice(self.targets), not incoming, nbytes)
+
+    def lines(self, count):
+        """Generate list of log lines"""
+        return [self.line() for _ in range(count)]
+
+    def payload(self, count):
+        """Generate log lines as one bytes block, ready to be sent to socket"""
+        return ("\n".join(self.lines(count)) + "\n").encode("utf-8")
@@ -5,6 +5,7 @@ PACKAGE_NAME="dante-trafmon"
 TARGET_DIR="/usr/local/sbin/dante_trafmon"
 BINARY_DIR="/usr/sbin"
 LOG_DIR="/var/log/dante_trafmon"
+DATA_DIR="/var/lib/dante_trafmon"
 
 VERSION="1.0.0"
 
@@ -37,6 +38,8 @@ cat > $PACKAGE_NAME/DEBIAN/postinst <<EOL
 useradd dante_trafmon -s /bin/false
 mkdir $LOG_DIR
 chown dante_trafmon:dante_trafmon $LOG_DIR
+mkdir -p $DATA_DIR/spool
+chown -R dante_trafmon:dante_trafmon $DATA_DIR
 chown dante_trafmon:dante_trafmon $TARGET_DIR
 ln -s $TARGET_DIR/scripts/dante-trafmon-start /usr/sbin/dante-trafmon-start
 ln -s $TARGET_DIR/scripts/dante-trafmon-stop /usr/sbin/dante-trafmon-stop
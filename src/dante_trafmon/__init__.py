@@ -1 +1,8 @@
-from .dante_trafmon import Application, LogThread, TimerThread
+from .dante_trafmon import Application, LogThread, TimerThread, \
+    TrafficCounters, TrafficHistory, IoopParser, IoopRecord, LineFramer, SourceConnection, \
+    IngestWorker, AggregatorThread, DeltaJournal, LogFollower, Backfill, \
+    StorageBackend, PgsqlBackend, SqliteBackend, SnapshotBackend, DimensionCounters, \
+    QuotaEngine, QuotaNotifier, ReadSnapshot, HttpThread, ReadApiThread, \
+    Metrics, Histogram, RateLimitedLog, MetricsThread, SamplingProfiler, \
+    IngestQueue, ParserThread, FrameProtocol, FrameReader, EdgeBackend, RateEstimator, \
+    FrameSender, CounterStore
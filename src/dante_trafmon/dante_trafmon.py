@@ -5,17 +5,35 @@
 
 import os
 import argparse
+import bisect
+import bz2
+import gzip
+import heapq
+import io
+import lzma
+import math
+import json
 import configparser
 import datetime
 import socket
+import sqlite3
 import sys
 import threading
 import time
+import urllib.parse
 import signal
-import re
-from collections import defaultdict
+import struct
+import selectors
+import shlex
+import subprocess
+import multiprocessing
+import queue
+import zlib
+from array import array
+from collections import defaultdict, deque, namedtuple
 import daemon
 import psycopg2
+import psycopg2.extras
 import setproctitle
 
 # pylint: enable=R0902
@@ -113,6 +131,48 @@ class Application:
         """ Listen port setter"""
         self._listen_port = value
 
+    # ----                           Listen backlog                      ---- #
+    # How many pending feed connections kernel keeps before accept()
+    _listen_backlog = 128
+
+    @property
+    def listen_backlog(self):
+        """ Listen backlog getter"""
+        return self._listen_backlog
+
+    @listen_backlog.setter
+    def listen_backlog(self, value):
+        """ Listen backlog setter"""
+        self._listen_backlog = value
+
+    # ----                         Receive buffer size                   ---- #
+    # Per-connection buffer, data is received straight into it
+    _recv_buffer_size = 262144
+
+    @property
+    def recv_buffer_size(self):
+        """ Receive buffer size getter"""
+        return self._recv_buffer_size
+
+    @recv_buffer_size.setter
+    def recv_buffer_size(self, value):
+        """ Receive buffer size setter"""
+        self._recv_buffer_size = value
+
+    # ----                          Max line length                      ---- #
+    # Longer log lines are dropped and counted as oversized
+    _max_line_length = 16384
+
+    @property
+    def max_line_length(self):
+        """ Max line length getter"""
+        return self._max_line_length
+
+    @max_line_length.setter
+    def max_line_length(self, value):
+        """ Max line length setter"""
+        self._max_line_length = value
+
     # ----                            Write period                       ---- #
     # How often to write results out
     _write_period = 2
@@ -141,6 +201,573 @@ class Application:
         """ Daemon log setter"""
         self._daemon_log = value
 
+    # ----                          History enabled                      ---- #
+    # Keep per-user per-minute traffic history with hourly and daily rollups
+    _history_enabled = False
+
+    @property
+    def history_enabled(self):
+        """ History enabled getter"""
+        return self._history_enabled
+
+    @history_enabled.setter
+    def history_enabled(self, value):
+        """ History enabled setter"""
+        self._history_enabled = value
+
+    # ----                     Minute history retention                  ---- #
+    # How long to keep history tables, in days
+    _history_minute_retention = 2
+
+    @property
+    def history_minute_retention(self):
+        """ Minute history retention getter"""
+        return self._history_minute_retention
+
+    @history_minute_retention.setter
+    def history_minute_retention(self, value):
+        """ Minute history retention setter"""
+        self._history_minute_retention = value
+
+    # ----                      Hour history retention                   ---- #
+    _history_hour_retention = 62
+
+    @property
+    def history_hour_retention(self):
+        """ Hour history retention getter"""
+        return self._history_hour_retention
+
+    @history_hour_retention.setter
+    def history_hour_retention(self, value):
+        """ Hour history retention setter"""
+        self._history_hour_retention = value
+
+    # ----                       Day history retention                   ---- #
+    _history_day_retention = 732
+
+    @property
+    def history_day_retention(self):
+        """ Day history retention getter"""
+        return self._history_day_retention
+
+    @history_day_retention.setter
+    def history_day_retention(self, value):
+        """ Day history retention setter"""
+        self._history_day_retention = value
+
+    # ----                          Ingest workers                       ---- #
+    # Number of ingest worker processes sharing the listen port (SO_REUSEPORT).
+    # 0 or 1 - everything runs in one process
+    _workers = 0
+
+    @property
+    def workers(self):
+        """ Ingest workers getter"""
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        """ Ingest workers setter"""
+        self._workers = value
+
+    # ----                           Spool enabled                       ---- #
+    # Journal counter deltas to local disk until they are written to database
+    _spool_enabled = False
+
+    @property
+    def spool_enabled(self):
+        """ Spool enabled getter"""
+        return self._spool_enabled
+
+    @spool_enabled.setter
+    def spool_enabled(self, value):
+        """ Spool enabled setter"""
+        self._spool_enabled = value
+
+    # ----                          Spool directory                      ---- #
+    _spool_directory = '/var/lib/dante_trafmon/spool'
+
+    @property
+    def spool_directory(self):
+        """ Spool directory getter"""
+        return self._spool_directory
+
+    @spool_directory.setter
+    def spool_directory(self, value):
+        """ Spool directory setter"""
+        self._spool_directory = value
+
+    # ----                        Followed log files                     ---- #
+    # Dante log files read directly by trafmon, instead of "tail > /dev/tcp/..."
+    _follow_files = []
+
+    @property
+    def follow_files(self):
+        """ Followed log files getter"""
+        return self._follow_files
+
+    @follow_files.setter
+    def follow_files(self, value):
+        """ Followed log files setter"""
+        self._follow_files = value
+
+    # ----                          State directory                      ---- #
+    # Offset checkpoints of followed files are kept here
+    _state_directory = '/var/lib/dante_trafmon'
+
+    @property
+    def state_directory(self):
+        """ State directory getter"""
+        return self._state_directory
+
+    @state_directory.setter
+    def state_directory(self, value):
+        """ State directory setter"""
+        self._state_directory = value
+
+    # ----                          Storage backend                      ---- #
+    # pgsql - PostgreSQL server, sqlite - embedded SQLite database file,
+    # file - atomically replaced snapshot file
+    _db_backend = 'pgsql'
+
+    @property
+    def db_backend(self):
+        """ Storage backend getter"""
+        return self._db_backend
+
+    @db_backend.setter
+    def db_backend(self, value):
+        """ Storage backend setter"""
+        self._db_backend = value
+
+    # ----                         Storage file path                     ---- #
+    # Database or snapshot file of sqlite and file backends
+    _db_path = '/var/lib/dante_trafmon/traffic.db'
+
+    @property
+    def db_path(self):
+        """ Storage file path getter"""
+        return self._db_path
+
+    @db_path.setter
+    def db_path(self, value):
+        """ Storage file path setter"""
+        self._db_path = value
+
+    # ----                        Dimensions enabled                     ---- #
+    # Per-source counters and per-user top destinations
+    _dimensions_enabled = False
+
+    @property
+    def dimensions_enabled(self):
+        """ Dimensions enabled getter"""
+        return self._dimensions_enabled
+
+    @dimensions_enabled.setter
+    def dimensions_enabled(self, value):
+        """ Dimensions enabled setter"""
+        self._dimensions_enabled = value
+
+    # ----                     Top destinations per user                 ---- #
+    _dimensions_top_k = 10
+
+    @property
+    def dimensions_top_k(self):
+        """ Top destinations per user getter"""
+        return self._dimensions_top_k
+
+    @dimensions_top_k.setter
+    def dimensions_top_k(self, value):
+        """ Top destinations per user setter"""
+        self._dimensions_top_k = value
+
+    # ----                   Destination sketch slots cap                ---- #
+    # Hard cap on memory used by destination sketches, over all users
+    _dimensions_max_entries = 200000
+
+    @property
+    def dimensions_max_entries(self):
+        """ Destination sketch slots cap getter"""
+        return self._dimensions_max_entries
+
+    @dimensions_max_entries.setter
+    def dimensions_max_entries(self, value):
+        """ Destination sketch slots cap setter"""
+        self._dimensions_max_entries = value
+
+    # ----                           Quota enabled                       ---- #
+    # Check per-user quotas inline and run hooks when thresholds are crossed
+    _quota_enabled = False
+
+    @property
+    def quota_enabled(self):
+        """ Quota enabled getter"""
+        return self._quota_enabled
+
+    @quota_enabled.setter
+    def quota_enabled(self, value):
+        """ Quota enabled setter"""
+        self._quota_enabled = value
+
+    # ----                           Quota source                        ---- #
+    # file - quota_file, database - "traffic_quota" table
+    _quota_source = 'file'
+
+    @property
+    def quota_source(self):
+        """ Quota source getter"""
+        return self._quota_source
+
+    @quota_source.setter
+    def quota_source(self, value):
+        """ Quota source setter"""
+        self._quota_source = value
+
+    # ----                            Quota file                         ---- #
+    _quota_file = '/etc/dante_trafmon.quota'
+
+    @property
+    def quota_file(self):
+        """ Quota file getter"""
+        return self._quota_file
+
+    @quota_file.setter
+    def quota_file(self, value):
+        """ Quota file setter"""
+        self._quota_file = value
+
+    # ----                         Quota thresholds                      ---- #
+    # Percents of quota which fire hooks, ascending
+    _quota_thresholds = [100]
+
+    @property
+    def quota_thresholds(self):
+        """ Quota thresholds getter"""
+        return self._quota_thresholds
+
+    @quota_thresholds.setter
+    def quota_thresholds(self, value):
+        """ Quota thresholds setter"""
+        self._quota_thresholds = value
+
+    # ----                        Quota reload period                    ---- #
+    # Seconds
+    _quota_reload_period = 60
+
+    @property
+    def quota_reload_period(self):
+        """ Quota reload period getter"""
+        return self._quota_reload_period
+
+    @quota_reload_period.setter
+    def quota_reload_period(self, value):
+        """ Quota reload period setter"""
+        self._quota_reload_period = value
+
+    # ----                           Quota command                       ---- #
+    # Run with username, percent, usage and quota as arguments
+    _quota_command = ''
+
+    @property
+    def quota_command(self):
+        """ Quota command getter"""
+        return self._quota_command
+
+    @quota_command.setter
+    def quota_command(self, value):
+        """ Quota command setter"""
+        self._quota_command = value
+
+    # ----                           Quota socket                        ---- #
+    # Unix datagram socket path, JSON message per event
+    _quota_socket = ''
+
+    @property
+    def quota_socket(self):
+        """ Quota socket getter"""
+        return self._quota_socket
+
+    @quota_socket.setter
+    def quota_socket(self, value):
+        """ Quota socket setter"""
+        self._quota_socket = value
+
+    # ----                        Quota database flag                    ---- #
+    # Set "exceeded" column of "traffic_quota" table
+    _quota_database_flag = False
+
+    @property
+    def quota_database_flag(self):
+        """ Quota database flag getter"""
+        return self._quota_database_flag
+
+    @quota_database_flag.setter
+    def quota_database_flag(self, value):
+        """ Quota database flag setter"""
+        self._quota_database_flag = value
+
+    # ----                         Read API enabled                      ---- #
+    # Serve live counters over HTTP
+    _api_enabled = False
+
+    @property
+    def api_enabled(self):
+        """ Read API enabled getter"""
+        return self._api_enabled
+
+    @api_enabled.setter
+    def api_enabled(self, value):
+        """ Read API enabled setter"""
+        self._api_enabled = value
+
+    # ----                         Read API address                      ---- #
+    _api_address = '127.0.0.1'
+
+    @property
+    def api_address(self):
+        """ Read API address getter"""
+        return self._api_address
+
+    @api_address.setter
+    def api_address(self, value):
+        """ Read API address setter"""
+        self._api_address = value
+
+    # ----                           Read API port                       ---- #
+    _api_port = 35532
+
+    @property
+    def api_port(self):
+        """ Read API port getter"""
+        return self._api_port
+
+    @api_port.setter
+    def api_port(self, value):
+        """ Read API port setter"""
+        self._api_port = value
+
+    # ----                          Read API socket                      ---- #
+    # Unix socket path, used instead of TCP address if set
+    _api_socket = ''
+
+    @property
+    def api_socket(self):
+        """ Read API socket getter"""
+        return self._api_socket
+
+    @api_socket.setter
+    def api_socket(self, value):
+        """ Read API socket setter"""
+        self._api_socket = value
+
+    # ----                             Log rate                          ---- #
+    # Per-line debug messages per second, at verbose level 3
+    _log_rate = 10
+
+    @property
+    def log_rate(self):
+        """ Log rate getter"""
+        return self._log_rate
+
+    @log_rate.setter
+    def log_rate(self, value):
+        """ Log rate setter"""
+        self._log_rate = value
+
+    # ----                          Metrics enabled                      ---- #
+    # Serve metrics in Prometheus text format
+    _metrics_enabled = False
+
+    @property
+    def metrics_enabled(self):
+        """ Metrics enabled getter"""
+        return self._metrics_enabled
+
+    @metrics_enabled.setter
+    def metrics_enabled(self, value):
+        """ Metrics enabled setter"""
+        self._metrics_enabled = value
+
+    # ----                          Metrics address                      ---- #
+    _metrics_address = '127.0.0.1'
+
+    @property
+    def metrics_address(self):
+        """ Metrics address getter"""
+        return self._metrics_address
+
+    @metrics_address.setter
+    def metrics_address(self, value):
+        """ Metrics address setter"""
+        self._metrics_address = value
+
+    # ----                           Metrics port                        ---- #
+    _metrics_port = 35533
+
+    @property
+    def metrics_port(self):
+        """ Metrics port getter"""
+        return self._metrics_port
+
+    @metrics_port.setter
+    def metrics_port(self, value):
+        """ Metrics port setter"""
+        self._metrics_port = value
+
+    # ----                         Profile duration                      ---- #
+    # How long SIGUSR2 sampling profiler runs, in seconds
+    _profile_duration = 30
+
+    @property
+    def profile_duration(self):
+        """ Profile duration getter"""
+        return self._profile_duration
+
+    @profile_duration.setter
+    def profile_duration(self, value):
+        """ Profile duration setter"""
+        self._profile_duration = value
+
+    # ----                         Profile interval                      ---- #
+    # Sampling interval, in seconds
+    _profile_interval = 0.01
+
+    @property
+    def profile_interval(self):
+        """ Profile interval getter"""
+        return self._profile_interval
+
+    @profile_interval.setter
+    def profile_interval(self, value):
+        """ Profile interval setter"""
+        self._profile_interval = value
+
+    # ----                       Ingest parser threads                   ---- #
+    # Parser threads behind the ingest queue, 0 parses in receiver loop
+    _ingest_parser_threads = 1
+
+    @property
+    def ingest_parser_threads(self):
+        """ Ingest parser threads getter"""
+        return self._ingest_parser_threads
+
+    @ingest_parser_threads.setter
+    def ingest_parser_threads(self, value):
+        """ Ingest parser threads setter"""
+        self._ingest_parser_threads = value
+
+    # ----                       Ingest queue batches                    ---- #
+    # Received line batches which may wait for parsers
+    _ingest_queue_batches = 1024
+
+    @property
+    def ingest_queue_batches(self):
+        """ Ingest queue batches getter"""
+        return self._ingest_queue_batches
+
+    @ingest_queue_batches.setter
+    def ingest_queue_batches(self, value):
+        """ Ingest queue batches setter"""
+        self._ingest_queue_batches = value
+
+    # ----                           Ingest policy                       ---- #
+    # What to do when ingest queue is full: block, drop_oldest, spill
+    _ingest_policy = 'block'
+
+    @property
+    def ingest_policy(self):
+        """ Ingest policy getter"""
+        return self._ingest_policy
+
+    @ingest_policy.setter
+    def ingest_policy(self, value):
+        """ Ingest policy setter"""
+        self._ingest_policy = value
+
+    # ----                      Ingest spill directory                   ---- #
+    # Where "spill" policy keeps batches which do not fit in memory
+    _ingest_spill_directory = '/var/lib/dante_trafmon/ingest_spill'
+
+    @property
+    def ingest_spill_directory(self):
+        """ Ingest spill directory getter"""
+        return self._ingest_spill_directory
+
+    @ingest_spill_directory.setter
+    def ingest_spill_directory(self, value):
+        """ Ingest spill directory setter"""
+        self._ingest_spill_directory = value
+
+    # ----                         Snapshot enabled                      ---- #
+    # Save counters to state_directory on clean shutdown, restore them at start
+    _snapshot_enabled = True
+
+    @property
+    def snapshot_enabled(self):
+        """ Snapshot enabled getter"""
+        return self._snapshot_enabled
+
+    @snapshot_enabled.setter
+    def snapshot_enabled(self, value):
+        """ Snapshot enabled setter"""
+        self._snapshot_enabled = value
+
+    # ----                          Edge collector                       ---- #
+    # Collector "host:port" which edge forwards deltas to, with backend = edge
+    _edge_collector = ''
+
+    @property
+    def edge_collector(self):
+        """ Edge collector getter"""
+        return self._edge_collector
+
+    @edge_collector.setter
+    def edge_collector(self, value):
+        """ Edge collector setter"""
+        self._edge_collector = value
+
+    # ----                              Edge ID                          ---- #
+    # Name of this edge node at collector, host name if empty
+    _edge_id = ''
+
+    @property
+    def edge_id(self):
+        """ Edge ID getter"""
+        return self._edge_id
+
+    @edge_id.setter
+    def edge_id(self, value):
+        """ Edge ID setter"""
+        self._edge_id = value
+
+    # ----                           Rates enabled                       ---- #
+    # Per-user live bandwidth over 10s/1m/5m windows, by dante log time
+    _rates_enabled = False
+
+    @property
+    def rates_enabled(self):
+        """ Rates enabled getter"""
+        return self._rates_enabled
+
+    @rates_enabled.setter
+    def rates_enabled(self, value):
+        """ Rates enabled setter"""
+        self._rates_enabled = value
+
+    # ----                            Rates top K                        ---- #
+    # Fastest users kept ranked per window, upper limit of top-N query
+    _rates_top_k = 100
+
+    @property
+    def rates_top_k(self):
+        """ Rates top K getter"""
+        return self._rates_top_k
+
+    @rates_top_k.setter
+    def rates_top_k(self, value):
+        """ Rates top K setter"""
+        self._rates_top_k = value
+
     # ------------------------------------------------------------------------#
     dante_thread = None
 
@@ -153,23 +780,31 @@ class Application:
     # Daemonize the program or not?
     do_daemonize = False
 
-    # File to write results out
-    OUTFILE = 'dante_trafmon.data'
-
-    # Log structure:
-    #  username_1,out,in
-    #  username_2,out,in
-    #  ...
-    #  username_n,out,in
-
-    lock = threading.Lock()
-
     def __init__(self):
         # Setting process name
         setproctitle.setproctitle("dante_trafmon")
 
         self.do_daemonize = False
 
+        # Traffic counters, shared by ingest and database write paths
+        self.counters = TrafficCounters()
+
+        self.metrics = Metrics()
+        self.metrics.add_histogram("counters_lock_wait_seconds", self.counters.lock_wait)
+        self.metrics.add_histogram("counters_lock_hold_seconds", self.counters.lock_hold)
+        self.metrics.add_histogram("flush_seconds", Histogram())
+
+        # SamplingProfiler, while it runs
+        self.profiler = None
+        # DimensionCounters, None unless [dimensions] are enabled
+        self.dimensions = None
+        # QuotaEngine, None unless [quota] is enabled
+        self.quota = None
+        # RateEstimator, None unless [rates] are enabled
+        self.rates = None
+        # Running LogFollower threads, timer saves their offsets once lines are stored
+        self.followers = []
+
     def parse_config_file(self, configfile):
         """Parse the configuration file"""
         config = configparser.ConfigParser()
@@ -180,12 +815,101 @@ class Application:
             self.daemon_log = str(config["general"]["trafmon_log"])
             self.listen_address = str(config["general"]["listen_address"])
             self.listen_port = int(config["general"]["listen_port"])
+            self.listen_backlog = int(config["general"].get("listen_backlog",
+                                                            self.listen_backlog))
+            self.recv_buffer_size = int(config["general"].get("recv_buffer_size",
+                                                              self.recv_buffer_size))
+            self.max_line_length = int(config["general"].get("max_line_length",
+                                                             self.max_line_length))
+            self.workers = int(config["general"].get("workers", self.workers))
+            self.log_rate = int(config["general"].get("log_rate", self.log_rate))
 
         if "database" in config:
-            self.db_name = config["database"]["db_name"]
-            self.db_username = config["database"]["db_username"]
-            self.db_hostname = config["database"]["db_hostname"]
-            self.db_password = config["database"]["db_password"]
+            self.db_backend = str(config["database"].get("backend", self.db_backend))
+            self.db_path = str(config["database"].get("path", self.db_path))
+            self.db_name = config["database"].get("db_name", self.db_name)
+            self.db_username = config["database"].get("db_username", self.db_username)
+            self.db_hostname = config["database"].get("db_hostname", self.db_hostname)
+            self.db_password = config["database"].get("db_password", self.db_password)
+
+        if "follow" in config:
+            self.follow_files = [path.strip() for path in
+                                 config["follow"].get("files", "").split(",") if path.strip()]
+            self.state_directory = str(config["follow"].get("state_directory",
+                                                            self.state_directory))
+
+        if "spool" in config:
+            self.spool_enabled = config["spool"].getboolean("enabled", self.spool_enabled)
+            self.spool_directory = str(config["spool"].get("directory", self.spool_directory))
+
+        if "history" in config:
+            self.history_enabled = config["history"].getboolean("enabled", self.history_enabled)
+            self.history_minute_retention = int(config["history"].get(
+                "minute_retention", self.history_minute_retention))
+            self.history_hour_retention = int(config["history"].get(
+                "hour_retention", self.history_hour_retention))
+            self.history_day_retention = int(config["history"].get(
+                "day_retention", self.history_day_retention))
+
+        if "dimensions" in config:
+            self.dimensions_enabled = config["dimensions"].getboolean(
+                "enabled", self.dimensions_enabled)
+            self.dimensions_top_k = int(config["dimensions"].get(
+                "top_k", self.dimensions_top_k))
+            self.dimensions_max_entries = int(config["dimensions"].get(
+                "max_entries", self.dimensions_max_entries))
+
+        if "quota" in config:
+            self.quota_enabled = config["quota"].getboolean("enabled", self.quota_enabled)
+            self.quota_source = str(config["quota"].get("source", self.quota_source))
+            self.quota_file = str(config["quota"].get("file", self.quota_file))
+            if config["quota"].get("thresholds", "").strip():
+                self.quota_thresholds = [int(value) for value in
+                                         config["quota"]["thresholds"].split(",")]
+            self.quota_reload_period = int(config["quota"].get(
+                "reload_period", self.quota_reload_period))
+            self.quota_command = str(config["quota"].get("command", self.quota_command))
+            self.quota_socket = str(config["quota"].get("socket", self.quota_socket))
+            self.quota_database_flag = config["quota"].getboolean(
+                "database_flag", self.quota_database_flag)
+
+        if "rates" in config:
+            self.rates_enabled = config["rates"].getboolean("enabled", self.rates_enabled)
+            self.rates_top_k = int(config["rates"].get("top_k", self.rates_top_k))
+
+        if "edge" in config:
+            self.edge_collector = str(config["edge"].get("collector", self.edge_collector))
+            self.edge_id = str(config["edge"].get("id", self.edge_id))
+
+        if "startup" in config:
+            self.snapshot_enabled = config["startup"].getboolean("snapshot", self.snapshot_enabled)
+
+        if "ingest" in config:
+            self.ingest_parser_threads = int(config["ingest"].get("parser_threads",
+                                                                  self.ingest_parser_threads))
+            self.ingest_queue_batches = int(config["ingest"].get("queue_batches",
+                                                                 self.ingest_queue_batches))
+            self.ingest_policy = str(config["ingest"].get("policy", self.ingest_policy))
+            self.ingest_spill_directory = str(config["ingest"].get("spill_directory",
+                                                                   self.ingest_spill_directory))
+
+        if "profiler" in config:
+            self.profile_duration = float(config["profiler"].get("duration",
+                                                                 self.profile_duration))
+            self.profile_interval = float(config["profiler"].get("interval",
+                                                                 self.profile_interval))
+
+        if "metrics" in config:
+            self.metrics_enabled = config["metrics"].getboolean("enabled", self.metrics_enabled)
+            self.metrics_address = str(config["metrics"].get("listen_address",
+                                                             self.metrics_address))
+            self.metrics_port = int(config["metrics"].get("listen_port", self.metrics_port))
+
+        if "api" in config:
+            self.api_enabled = config["api"].getboolean("enabled", self.api_enabled)
+            self.api_address = str(config["api"].get("listen_address", self.api_address))
+            self.api_port = int(config["api"].get("listen_port", self.api_port))
+            self.api_socket = str(config["api"].get("socket", self.api_socket))
 
         if self.verbose >= 2:
             print("\nINFO : " + str(datetime.datetime.now()) +
@@ -194,12 +918,57 @@ class Application:
             print("  trafmon_log    =", str(self.daemon_log))
             print("  listen_address =", str(self.listen_address))
             print("  listen_port    =", str(self.listen_port))
+            print("  listen_backlog =", str(self.listen_backlog))
+            print("  recv_buffer_size =", str(self.recv_buffer_size))
+            print("  max_line_length  =", str(self.max_line_length))
+            print("  workers          =", str(self.workers))
+            print("  log_rate         =", str(self.log_rate))
             print("")
+            print("  db_backend     = ", str(self.db_backend))
+            print("  db_path        = ", str(self.db_path))
             print("  db_hostname    = ", str(self.db_hostname))
             print("  db_name        = ", str(self.db_name))
             print("  db_username    = ", str(self.db_username))
             print("  db_password    = ", str(self.db_password))
             print("")
+            print("  follow_files             =", ", ".join(self.follow_files))
+            print("  state_directory          =", str(self.state_directory))
+            print("  spool_enabled            =", str(self.spool_enabled))
+            print("  spool_directory          =", str(self.spool_directory))
+            print("  history_enabled          =", str(self.history_enabled))
+            print("  history_minute_retention =", str(self.history_minute_retention))
+            print("  history_hour_retention   =", str(self.history_hour_retention))
+            print("  history_day_retention    =", str(self.history_day_retention))
+            print("  dimensions_enabled       =", str(self.dimensions_enabled))
+            print("  dimensions_top_k         =", str(self.dimensions_top_k))
+            print("  dimensions_max_entries   =", str(self.dimensions_max_entries))
+            print("  quota_enabled            =", str(self.quota_enabled))
+            print("  quota_source             =", str(self.quota_source))
+            print("  quota_file               =", str(self.quota_file))
+            print("  quota_thresholds         =", ", ".join(map(str, self.quota_thresholds)))
+            print("  quota_reload_period      =", str(self.quota_reload_period))
+            print("  quota_command            =", str(self.quota_command))
+            print("  quota_socket             =", str(self.quota_socket))
+            print("  quota_database_flag      =", str(self.quota_database_flag))
+            print("  rates_enabled            =", str(self.rates_enabled))
+            print("  rates_top_k              =", str(self.rates_top_k))
+            print("  edge_collector           =", str(self.edge_collector))
+            print("  edge_id                  =", str(self.edge_id))
+            print("  snapshot_enabled         =", str(self.snapshot_enabled))
+            print("  ingest_parser_threads    =", str(self.ingest_parser_threads))
+            print("  ingest_queue_batches     =", str(self.ingest_queue_batches))
+            print("  ingest_policy            =", str(self.ingest_policy))
+            print("  ingest_spill_directory   =", str(self.ingest_spill_directory))
+            print("  profile_duration         =", str(self.profile_duration))
+            print("  profile_interval         =", str(self.profile_interval))
+            print("  metrics_enabled          =", str(self.metrics_enabled))
+            print("  metrics_address          =", str(self.metrics_address))
+            print("  metrics_port             =", str(self.metrics_port))
+            print("  api_enabled              =", str(self.api_enabled))
+            print("  api_address              =", str(self.api_address))
+            print("  api_port                 =", str(self.api_port))
+            print("  api_socket               =", str(self.api_socket))
+            print("")
 
     @staticmethod
     def basic_test():
@@ -212,7 +981,9 @@ class Application:
         print("\nINFO : " + str(datetime.datetime.now()) +
               " SIGINT signal received! Program will be terminated.")
         self.dante_thread.stop()
-        self.dante_thread.timer.join()
+        # Timer is not started when listener failed to bind or has no timer (worker)
+        if self.dante_thread.timer is not None:
+            self.dante_thread.timer.join()
         self.dante_thread.join()
 
     def sigterm_handler(self, signl, frame):
@@ -225,11 +996,74 @@ class Application:
         # pylint: disable=W0612,W0613
         print("\nINFO : " + str(datetime.datetime.now()) + " SIGUSR1 signal received!")
         print("INFO: " + str(datetime.datetime.now()) + " Resetting stored counters.")
-        self.lock.acquire()
-        self.dante_thread.traffic_dict = defaultdict(lambda: [0, 0])
-        self.lock.release()
+        self.counters.reset()
         print("INFO : " + str(datetime.datetime.now()) + " Traffic counters were reset.")
 
+    def sigusr2_handler(self, signl, frame):
+        """SIGUSR2 Handler"""
+        # pylint: disable=W0612,W0613
+        print("\nINFO : " + str(datetime.datetime.now()) + " SIGUSR2 signal received!")
+        self.start_profiler()
+        if isinstance(self.dante_thread, AggregatorThread):
+            self.dante_thread.signal_workers(signal.SIGUSR2)
+
+    def start_profiler(self, name="main"):
+        """Start sampling profiler for profile_duration seconds, unless it already runs.
+        Profile is written next to trafmon_log. Returns profile path or None."""
+        if self.profiler is not None and self.profiler.is_alive():
+            print("INFO : " + str(datetime.datetime.now()) + " Profiler is already running.")
+            return None
+        path = os.path.join(os.path.dirname(os.path.abspath(self.daemon_log)),
+                            "dante_trafmon.profile." +
+                            datetime.datetime.now().strftime("%Y%m%d-%H%M%S") +
+                            "." + name + ".collapsed")
+        print("INFO : " + str(datetime.datetime.now()) + " Profiling for " +
+              str(self.profile_duration) + " s, profile will be written to " + path)
+        self.profiler = SamplingProfiler(path, self.profile_duration, self.profile_interval)
+        self.profiler.start()
+        return path
+
+    def create_storage(self):
+        """Storage backend selected in [database] section"""
+        backends = {"pgsql": PgsqlBackend, "sqlite": SqliteBackend, "file": SnapshotBackend,
+                    "edge": EdgeBackend}
+        if self.db_backend not in backends:
+            raise ValueError("Unknown storage backend: " + str(self.db_backend))
+        return backends[self.db_backend](self)
+
+    def enable_dimensions(self):
+        """Start per-source and per-destination accounting"""
+        if self.dimensions is None:
+            self.dimensions = DimensionCounters(self.dimensions_top_k,
+                                                self.dimensions_max_entries)
+
+    def enable_rates(self, top_k=None):
+        """Start estimating per-user live bandwidth"""
+        if self.rates is None:
+            self.rates = RateEstimator(self.rates_top_k if top_k is None else top_k)
+
+    def enable_quota(self):
+        """Start checking quotas as counters are updated"""
+        if self.quota is None:
+            self.quota = QuotaEngine(self.quota_thresholds)
+            self.counters.quota = self.quota
+
+    def start_followers(self):
+        """Start LogFollower thread for every configured dante log file"""
+        followers = [LogFollower(self, path) for path in self.follow_files]
+        self.followers = followers
+        for follower in followers:
+            follower.start()
+        return followers
+
+    @staticmethod
+    def stop_followers(followers):
+        """Stop LogFollower threads, their offsets are saved by the final database write"""
+        for follower in followers:
+            follower.stop()
+        for follower in followers:
+            follower.join()
+
     def do_main_program(self):
         """
         Launch the tread to listen for incoming data about dante traffic,
@@ -240,10 +1074,14 @@ class Application:
         signal.signal(signal.SIGINT, self.sigint_handler)
         signal.signal(signal.SIGTERM, self.sigterm_handler)
         signal.signal(signal.SIGUSR1, self.sigusr1_handler)
+        signal.signal(signal.SIGUSR2, self.sigusr2_handler)
 
-        self.dante_thread = LogThread("DANTE",
-                                      LogThread.LOG_TYPE_DANTE,
-                                      self)
+        if self.workers > 1:
+            self.dante_thread = AggregatorThread("AGGREGATOR", self)
+        else:
+            self.dante_thread = LogThread("DANTE",
+                                          LogThread.LOG_TYPE_DANTE,
+                                          self)
         self.dante_thread.start()
 
         while self.dante_thread.thread_running:
@@ -262,10 +1100,41 @@ class Application:
         parser.add_argument("--config", default=self._default_config,
                             help="Configuration file.")
 
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Number of ingest worker processes, "
+                                 "overrides config file value.")
+
+        parser.add_argument("--backfill", nargs="+", metavar="LOGFILE", default=None,
+                            help="Rebuild traffic totals from archived dante logs "
+                                 "(plain, .gz, .bz2, .xz) and exit.")
+
+        parser.add_argument("--processes", type=int, default=None,
+                            help="Number of parser processes for --backfill, "
+                                 "default is number of CPU cores.")
+
+        parser.add_argument("--send", default=None, metavar="HOST:PORT",
+                            help="Read dante log lines from standard input and send them "
+                                 "compressed to traffic monitor at HOST:PORT, "
+                                 "config file is not needed.")
+
+        parser.add_argument("--source", default=None,
+                            help="Source name for --send, default is host name.")
+
         args = parser.parse_args()
         if args.daemon:
             self.do_daemonize = True
 
+        if args.send:
+            host, _, port = args.send.rpartition(":")
+            if not host or not port.isdigit():
+                print("ERROR: " + str(datetime.datetime.now()) + " --send requires " +
+                      "HOST:PORT (" + args.send + ")")
+                sys.exit(1)
+            sender = FrameSender((host, int(port)), args.source)
+            signal.signal(signal.SIGINT, sender.sigterm_handler)
+            signal.signal(signal.SIGTERM, sender.sigterm_handler)
+            sys.exit(sender.run())
+
         # Read configuration file
         if not os.path.isfile(args.config):
             print("ERROR: " + str(datetime.datetime.now()) + " config file not found " +
@@ -276,6 +1145,36 @@ class Application:
             pass
             self.parse_config_file(args.config)
 
+        if args.workers is not None:
+            self.workers = args.workers
+
+        if self.db_backend not in ("pgsql", "sqlite", "file", "edge"):
+            print("ERROR: " + str(datetime.datetime.now()) + " unknown storage backend " +
+                  "(" + str(self.db_backend) + "), expected pgsql, sqlite, file or edge")
+            print("       Terminating the program.")
+            sys.exit(1)
+
+        if self.db_backend == "edge" and ":" not in self.edge_collector:
+            print("ERROR: " + str(datetime.datetime.now()) + " edge backend requires " +
+                  "collector = host:port in [edge] section")
+            print("       Terminating the program.")
+            sys.exit(1)
+
+        if self.ingest_policy not in IngestQueue.POLICIES:
+            print("ERROR: " + str(datetime.datetime.now()) + " unknown ingest policy " +
+                  "(" + str(self.ingest_policy) + "), expected " + ", ".join(IngestQueue.POLICIES))
+            print("       Terminating the program.")
+            sys.exit(1)
+
+        if args.backfill:
+            if self.db_backend == "edge":
+                print("ERROR: " + str(datetime.datetime.now()) + " --backfill can not " +
+                      "replace totals through edge backend, run it on the collector")
+                print("       Terminating the program.")
+                sys.exit(1)
+            result, _ = Backfill(self, args.backfill, args.processes).run()
+            sys.exit(result)
+
         # Prepare daemon context
         if self.do_daemonize:
             logfile = open(self.daemon_log, 'w')
@@ -290,104 +1189,3791 @@ class Application:
 # ---------------------------------------------------------------------------------------- #
 
 
-class TimerThread(threading.Thread):
-    """
-    Timer thread class, will write data to database every write_period seconds
-    """
-    log_thread = None
-    app = None
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to be observed on ingest path"""
 
-    def __init__(self, application, log_thread):
-        super(TimerThread, self).__init__()
-        self.log_thread = log_thread
-        self.app = application
+    # Seconds, from 10 us to 10 s
+    LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10)
 
-    def data_init_from_db(self):
-        """Initialize data from database. This is important, if script cannot receive data
-        from database if should halt.
-        TODO: This behaviour should probably be changed later."""
-        result = 0
-        result_msg = "OK!"
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.bounds = tuple(buckets)
+        # Per bucket counts, not cumulative, last one is +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
 
-        if self.app.verbose >= 3:
-            print("INFO : " + str(datetime.datetime.now()) +
-                  " Database: '" + self.app.db_name +
-                  " Hostname: " + self.app.db_hostname +
-                  " User: " + self.app.db_name +
-                  " Password: " + self.app.db_password)
+    def observe(self, value):
+        """Add one observation"""
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
 
-        try:
-            conn = psycopg2.connect(host=self.app.db_hostname,
-                                    database=self.app.db_name,
-                                    user=self.app.db_username,
-                                    password=self.app.db_password,
-                                    connect_timeout=5)
-        # pylint: disable=C0103
-        except psycopg2.OperationalError as e:
-            print("ERROR: " + str(datetime.datetime.now()) +
-                  " Unable to connect to database (data_init_from_db)")
-            print("ERROR: " + str(datetime.datetime.now()) + " " + str(e))
-            result = 1
-            result_msg = str(e)
-        # pylint: enable=C0103
-        else:
-            if conn is not None:
-                cur = conn.cursor()
+    def state(self):
+        """Consistent copy: (cumulative counts per bound and +Inf, sum, count)"""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        running = 0
+        for value in counts:
+            running += value
+            cumulative.append(running)
+        return cumulative, total, count
 
-                cur.execute("SELECT * FROM traffic")
-                res = cur.fetchall()
-                for row in res:
-                    if self.app.verbose >= 3: print(row)
-                    self.log_thread.traffic_dict[row[0]] = [row[2], row[1]]
 
-                cur.close()
-                conn.close()
-            else:
-                print("ERROR: " + str(datetime.datetime.now()) +
-                      " Failed to obtain PSQL cursor (data_init_from_db)")
+class Metrics:
+    """
+    Application metrics: counters, gauges and histograms with optional labels,
+    rendered in Prometheus text format. Hot path code updates them once per
+    batch of lines, not per line. Gauges which are cheaper to read than to
+    maintain are filled by collectors right before rendering.
+    """
+
+    PREFIX = "dante_trafmon_"
+
+    # name -> (type, help)
+    DEFINITIONS = {
+        "lines_total": ("counter", "Log lines received, per dante server"),
+        "received_bytes_total": ("counter", "Log bytes received, per dante server"),
+        "records_total": ("counter", "Parsed ioop records, per direction"),
+        "unmatched_lines_total": ("counter", "Received lines which are not ioop records"),
+        "malformed_lines_total": ("counter", "Lines dropped as not valid UTF-8"),
+        "oversized_lines_total": ("counter", "Lines dropped as longer than max_line_length"),
+        "connections": ("gauge", "Connected log feeds"),
+        "users": ("gauge", "Users in traffic totals"),
+        "counters_lock_wait_seconds": ("histogram", "Wait for counters lock, per batch"),
+        "counters_lock_hold_seconds": ("histogram", "Counters lock held by ingest, per batch"),
+        "flush_seconds": ("histogram", "Database write of changed traffic totals"),
+        "flush_rows_total": ("counter", "Traffic rows written to database"),
+        "flushes_total": ("counter", "Database writes of traffic totals, per result"),
+        "edge_deltas_total": ("counter", "Delta frames from edge nodes, per result"),
+        "line_frames_total": ("counter", "Compressed line frames from senders, per result"),
+        "decompressed_bytes_total": ("counter", "Log bytes of compressed line frames, "
+                                                "per source"),
+        "ingest_queue_depth": ("gauge", "Received line batches waiting for parsers"),
+        "ingest_dropped_batches_total": ("counter", "Line batches dropped as ingest queue was full"),
+        "ingest_dropped_lines_total": ("counter", "Lines dropped as ingest queue was full"),
+        "ingest_spilled_batches_total": ("counter", "Line batches spilled to disk"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels is tuple of (label, value) pairs
+        self.values = {}
+        # name -> Histogram
+        self.histograms = {}
+        # Functions called before rendering, they set gauges
+        self.collectors = []
+
+    def inc(self, name, value=1, labels=()):
+        """Add to counter"""
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def count_lines(self, source, lines, records):
+        """Account one parsed batch: number of lines and list of IoopRecords"""
+        incoming = sum(record[0] for record in records)
+        updates = ((("lines_total", (("source", source),)), lines),
+                   (("records_total", (("direction", "in"),)), incoming),
+                   (("records_total", (("direction", "out"),)), len(records) - incoming),
+                   (("unmatched_lines_total", ()), lines - len(records)))
+        with self.lock:
+            values = self.values
+            for key, value in updates:
+                values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        """Set gauge"""
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def add_histogram(self, name, histogram):
+        """Register histogram owned by someone else"""
+        self.histograms[name] = histogram
+
+    def add_collector(self, function):
+        """Register function to be called before rendering"""
+        self.collectors.append(function)
+
+    def remove_collector(self, function):
+        """Forget collector function"""
+        if function in self.collectors:
+            self.collectors.remove(function)
+
+    def swap_counters(self):
+        """Take counters out, for ingest worker to ship. Returns [(name, labels, value)]"""
+        with self.lock:
+            values, self.values = self.values, {}
+        return [(name, labels, value) for (name, labels), value in values.items()
+                if self.DEFINITIONS.get(name, ("counter",))[0] == "counter"]
+
+    def add_counters(self, rows):
+        """Add counters shipped by ingest worker"""
+        with self.lock:
+            for name, labels, value in rows:
+                key = (name, tuple(labels))
+                self.values[key] = self.values.get(key, 0) + value
+
+    @staticmethod
+    def format_labels(labels):
+        """Prometheus label set, {a="1",b="2"}"""
+        if not labels:
+            return ""
+        return "{" + ",".join(
+            key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n") + '"' for key, value in labels) + "}"
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+        for function in list(self.collectors):
+            function()
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            if name not in described:
+                described.add(name)
+                kind, text = self.DEFINITIONS.get(name, ("untyped", name))
+                lines.append("# HELP " + self.PREFIX + name + " " + text)
+                lines.append("# TYPE " + self.PREFIX + name + " " + kind)
+            lines.append(self.PREFIX + name + self.format_labels(labels) + " " + str(value))
+        for name, histogram in sorted(self.histograms.items()):
+            kind, text = self.DEFINITIONS.get(name, ("histogram", name))
+            cumulative, total, count = histogram.state()
+            lines.append("# HELP " + self.PREFIX + name + " " + text)
+            lines.append("# TYPE " + self.PREFIX + name + " " + kind)
+            for bound, value in zip([repr(b) for b in histogram.bounds] + ["+Inf"], cumulative):
+                lines.append(self.PREFIX + name + '_bucket{le="' + bound + '"} ' + str(value))
+            lines.append(self.PREFIX + name + "_sum " + repr(total))
+            lines.append(self.PREFIX + name + "_count " + str(count))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class RateLimitedLog:
+    """
+    Prints at most rate messages per second, the rest are counted
+    and reported as one line when the next second starts.
+    """
+
+    def __init__(self, rate=10):
+        self.rate = rate
+        self.window = 0
+        self.printed = 0
+        self.suppressed = 0
+
+    def write(self, *args):
+        """Print message, unless rate is exceeded"""
+        now = time.monotonic()
+        if now - self.window >= 1:
+            if self.suppressed:
+                print("INFO : " + str(datetime.datetime.now()) + " " +
+                      str(self.suppressed) + " log messages suppressed")
+            self.window = now
+            self.printed = 0
+            self.suppressed = 0
+        if self.printed < self.rate:
+            self.printed += 1
+            print(*args)
+        else:
+            self.suppressed += 1
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Statistical profiler of all threads of this process, started on demand
+    (SIGUSR2) for a fixed time. Every interval it takes stacks of other threads
+    from sys._current_frames() and counts them; nothing runs while it is idle.
+    Result is written in collapsed stacks format ("thread;outer;...;inner count"
+    per line), which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, path, duration=30, interval=0.01):
+        super(SamplingProfiler, self).__init__(name="PROFILER", daemon=True)
+        self.path = path
+        self.duration = duration
+        self.interval = interval
+        # collapsed stack -> number of samples
+        self.stacks = defaultdict(int)
+        self.samples = 0
+
+    @staticmethod
+    def frame_name(frame):
+        """Flame graph frame label: function (file.py:first line)"""
+        code = frame.f_code
+        return (code.co_name + " (" + os.path.basename(code.co_filename) + ":" +
+                str(code.co_firstlineno) + ")")
+
+    def sample(self):
+        """Take one sample of every other thread"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():  # pylint: disable=W0212
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        """Profiler thread "run" function"""
+        finish = time.monotonic() + self.duration
+        next_sample = time.monotonic()
+        while next_sample < finish:
+            self.sample()
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            self.write()
+        # pylint: disable=C0103
+        except OSError as e:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to write profile: " + str(e))
+            return
+        # pylint: enable=C0103
+        print("INFO : " + str(datetime.datetime.now()) + " Profile of " +
+              str(self.samples) + " samples written to " + self.path)
+
+    def write(self):
+        """Write collapsed stacks, heaviest first"""
+        with open(self.path, "w") as handler:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                handler.write(stack + " " + str(count) + "\n")
+
+
+class CounterStore:
+    """
+    Compact per-user [outgoing, incoming] counters for large user populations.
+    Usernames are interned to integer slots on first sight, counters of a slot are
+    outgoing[slot] and incoming[slot], two array("Q") columns which grow geometrically.
+    Unlike a dict of [out, in] lists there are no list and counter objects per user,
+    and nothing per user for garbage collector to traverse.
+    Slots are never freed, counters reset replaces the whole store.
+
+    Totals and the delta buffer filled by ingest are both stores. Columns are indexed
+    by IoopRecord direction on ingest, and swapped delta is handed over as column
+    slices, so merging it does not create per-user objects either.
+    """
+
+    def __init__(self, capacity=1024):
+        # username -> slot
+        self.slots = {}
+        # slot -> username
+        self.names = []
+        capacity = max(capacity, 1)
+        self.outgoing = array("Q", bytes(8 * capacity))
+        self.incoming = array("Q", bytes(8 * capacity))
+
+    @classmethod
+    def from_packed(cls, usernames, values):
+        """Store with packed counters, (usernames, flat array("Q") [out, in, out, in, ...]).
+        Usernames must be unique."""
+        store = cls(len(usernames))
+        store.names = list(usernames)
+        store.slots = dict(zip(store.names, range(len(store.names))))
+        store.outgoing[:len(usernames)] = array("Q", values[0::2])
+        store.incoming[:len(usernames)] = array("Q", values[1::2])
+        return store
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, username):
+        return username in self.slots
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def slot(self, username):
+        """Slot of username, a new zeroed one if username is not known yet"""
+        slot = self.slots.get(username)
+        if slot is None:
+            slot = len(self.names)
+            if slot == len(self.outgoing):
+                # Doubling keeps inserts amortized O(1). Columns grow in place,
+                # references held by callers stay valid.
+                grow = bytes(max(slot, 1) * self.outgoing.itemsize)
+                self.outgoing.frombytes(grow)
+                self.incoming.frombytes(grow)
+            self.slots[username] = slot
+            self.names.append(username)
+        return slot
+
+    def get(self, username):
+        """(outgoing, incoming) of username, None if username is not known"""
+        slot = self.slots.get(username)
+        if slot is None:
+            return None
+        return self.outgoing[slot], self.incoming[slot]
+
+    def add(self, usernames, outgoing, incoming):
+        """Add counters given column by column, usernames may repeat"""
+        slots = self.slots
+        out_column = self.outgoing
+        in_column = self.incoming
+        for username, out_bytes, in_bytes in zip(usernames, outgoing, incoming):
+            slot = slots.get(username)
+            if slot is None:
+                slot = self.slot(username)
+            out_column[slot] += out_bytes
+            in_column[slot] += in_bytes
+
+    def add_packed(self, usernames, values):
+        """Add counters in packed form, flat [out, in, out, in, ...]"""
+        self.add(usernames, values[0::2], values[1::2])
+
+    def add_delta(self, delta):
+        """Add swapped delta buffer, another CounterStore"""
+        self.add(*delta.columns())
+
+    def load(self, rows):
+        """Set counters from iterable of (username, outgoing, incoming) rows"""
+        if not self.names:
+            # Bulk path for database rows and snapshots, their usernames are unique
+            names, outgoing, incoming = [], array("Q"), array("Q")
+            append, out_append, in_append = names.append, outgoing.append, incoming.append
+            for username, out_bytes, in_bytes in rows:
+                append(username)
+                out_append(out_bytes)
+                in_append(in_bytes)
+            slots = dict(zip(names, range(len(names))))
+            if len(slots) == len(names):
+                self.names, self.slots = names, slots
+                self.outgoing, self.incoming = outgoing, incoming
+                return
+            rows = zip(names, outgoing, incoming)
+        slots = self.slots
+        out_column = self.outgoing
+        in_column = self.incoming
+        for username, out_bytes, in_bytes in rows:
+            slot = slots.get(username)
+            if slot is None:
+                slot = self.slot(username)
+            out_column[slot] = out_bytes
+            in_column[slot] = in_bytes
+
+    def update(self, other):
+        """Set counters of other store's users"""
+        self.load(zip(*other.columns()))
+
+    def rows(self, usernames):
+        """Counters of given users as list of (username, outgoing, incoming) rows,
+        unknown users are skipped"""
+        slots = self.slots
+        outgoing = self.outgoing
+        incoming = self.incoming
+        rows = []
+        for username in usernames:
+            slot = slots.get(username)
+            if slot is not None:
+                rows.append((username, outgoing[slot], incoming[slot]))
+        return rows
+
+    def columns(self):
+        """Copy of all counters as columns, (usernames, array("Q") of outgoing,
+        array("Q") of incoming)"""
+        used = len(self.names)
+        return list(self.names), self.outgoing[:used], self.incoming[:used]
+
+    def export(self):
+        """Copy of all counters in packed form, (usernames, flat array("Q") of
+        [out, in] pairs), as shipped by ingest workers and edge nodes"""
+        usernames, outgoing, incoming = self.columns()
+        values = array("Q", bytes(16 * len(usernames)))
+        values[0::2] = outgoing
+        values[1::2] = incoming
+        return usernames, values
+
+
+class TrafficCounters:
+    """
+    Per-user traffic counters, double-buffered so ingest never waits for database I/O.
+
+    Ingest adds parsed byte counts to the delta buffer. Timer thread swaps the delta
+    buffer out in O(1) and merges it into totals, which only timer thread modifies.
+    Lock protects delta buffer only and is never held during I/O.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Counters accumulated since the last swap
+        self.delta = CounterStore()
+        self.reset_requested = False
+
+        # Cumulative counters of every user, same as stored in database
+        self.totals = CounterStore()
+        self.totals_lock = threading.Lock()
+
+        # (minute, username) -> [outgoing, incoming], None if history is disabled
+        self.buckets = None
+
+        # DeltaJournal, every delta is journaled before it's counted. None if spool is disabled
+        self.journal = None
+
+        # QuotaEngine, checks every update against quotas. None if quotas are disabled
+        self.quota = None
+
+        # Ingest side of the lock, per batch
+        self.lock_wait = Histogram()
+        self.lock_hold = Histogram()
+
+    def enable_buckets(self):
+        """Start collecting per-minute buckets for traffic history"""
+        with self.lock:
+            if self.buckets is None:
+                self.buckets = defaultdict(lambda: [0, 0])
+
+    def add_records(self, records):
+        """Add list of parsed IoopRecords to the delta buffer"""
+        if not records:
+            return
+        now = int(time.time())
+        minute = now - now % TrafficHistory.MINUTE
+        journal = self.journal
+        if journal is not None:
+            entries = journal.pack_records(records)
+        started = time.perf_counter()
+        with self.lock:
+            locked = time.perf_counter()
+            delta = self.delta
+            slots = delta.slots
+            # Indexed by record direction, columns grow in place
+            columns = (delta.outgoing, delta.incoming)
+            for record in records:
+                slot = slots.get(record.username)
+                if slot is None:
+                    slot = delta.slot(record.username)
+                columns[record.direction][slot] += record.nbytes
+            buckets = self.buckets
+            if buckets is not None:
+                for record in records:
+                    buckets[(minute, record.username)][record.direction] += record.nbytes
+            if journal is not None:
+                segment = journal.reserve()
+            # Under the lock, so quota rearm sees every update either in usage or after
+            if self.quota is not None:
+                self.quota.check_records(records)
+        self.lock_hold.observe(time.perf_counter() - locked)
+        self.lock_wait.observe(locked - started)
+        if journal is not None:
+            journal.write(segment, entries)
+
+    def add_delta(self, usernames, values, edge=None):
+        """Add delta shipped by ingest worker or edge node, values are flat
+        [out, in, out, in, ...]. Edge frame's (edge_id, epoch, sequence) is
+        journaled with it."""
+        journal = self.journal
+        if journal is not None:
+            entries = journal.pack_delta(usernames, values, edge)
+        with self.lock:
+            if journal is not None:
+                segment = journal.reserve()
+            self.delta.add_packed(usernames, values)
+            if self.quota is not None:
+                self.quota.check_delta(usernames, values)
+        if journal is not None:
+            journal.write(segment, entries)
+
+    def add_buckets(self, rows):
+        """Add per-minute buckets shipped by ingest worker,
+        rows are (minute, username, outgoing, incoming)"""
+        with self.lock:
+            buckets = self.buckets
+            if buckets is None:
+                return
+            for minute, username, outgoing, incoming in rows:
+                value = buckets[(minute, username)]
+                value[0] += outgoing
+                value[1] += incoming
+
+    def swap(self):
+        """Take accumulated delta buffer out, replacing it with an empty one.
+        Returns (delta, reset), reset is True if counters reset was requested."""
+        # Sized for as many users as the last period had, without the lock
+        fresh = CounterStore(len(self.delta))
+        segment = None
+        with self.lock:
+            delta, self.delta = self.delta, fresh
+            reset, self.reset_requested = self.reset_requested, False
+            if self.journal is not None:
+                # Swapped delta and sealed journal segments contain the same data
+                segment = self.journal.rotate()
+        if segment is not None:
+            self.journal.seal(segment)
+        return delta, reset
+
+    def swap_buckets(self):
+        """Take accumulated per-minute buckets out, replacing them with empty ones.
+        History is not affected by counters reset."""
+        fresh = defaultdict(lambda: [0, 0])
+        with self.lock:
+            buckets, self.buckets = self.buckets, fresh
+        return buckets
+
+    def merge(self, delta, reset=False):
+        """Merge swapped delta buffer into totals"""
+        with self.totals_lock:
+            if reset:
+                self.totals = CounterStore()
+            self.totals.add_delta(delta)
+
+    def load(self, rows, replace=False):
+        """Set totals from iterable of (username, outgoing, incoming) rows.
+        With replace, users which are not in rows are dropped. Rows are
+        consumed before the lock is taken, so they may be streamed from database."""
+        loaded = CounterStore()
+        loaded.load(rows)
+        self.load_store(loaded, replace)
+
+    def load_packed(self, usernames, values):
+        """Set totals from packed form, as exported by CounterStore.export"""
+        self.load_store(CounterStore.from_packed(usernames, values))
+
+    def load_store(self, loaded, replace=False):
+        """Set totals from CounterStore"""
+        with self.totals_lock:
+            if replace or not self.totals:
+                self.totals = loaded
+            else:
+                self.totals.update(loaded)
+
+    def rows(self, usernames):
+        """Totals of given users as list of (username, outgoing, incoming) rows"""
+        with self.totals_lock:
+            return self.totals.rows(usernames)
+
+    def reset(self):
+        """Drop all counters, totals are cleared on the next swap"""
+        with self.lock:
+            self.delta = CounterStore()
+            self.reset_requested = True
+            if self.journal is not None:
+                self.journal.append_reset()
+
+    def rearm_quota(self, quotas):
+        """Rebuild quota threshold index from {username: quota} and current usage.
+        Lock is held over both, so no update falls between usage and the new index.
+        Must be called by timer thread, swapped delta is not merged otherwise."""
+        with self.lock:
+            delta = self.delta
+            usage = {}
+            with self.totals_lock:
+                for username in quotas:
+                    used = 0
+                    if not self.reset_requested:
+                        total = self.totals.get(username)
+                        if total is not None:
+                            used = total[0] + total[1]
+                    # get() does not add users to the store
+                    value = delta.get(username)
+                    if value is not None:
+                        used += value[0] + value[1]
+                    usage[username] = used
+            self.quota.rearm(quotas, usage)
+
+    def snapshot(self):
+        """Copy of current counters including not yet merged delta,
+        username -> [outgoing, incoming]"""
+        with self.lock:
+            delta = self.delta.columns()
+            reset = self.reset_requested
+        usernames, values = [], array("Q")
+        if not reset:
+            with self.totals_lock:
+                usernames, values = self.totals.export()
+        result = {username: [outgoing, incoming] for username, outgoing, incoming
+                  in zip(usernames, values[0::2], values[1::2])}
+        for username, outgoing, incoming in zip(*delta):
+            value = result.setdefault(username, [0, 0])
+            value[0] += outgoing
+            value[1] += incoming
+        return result
+
+
+class JournalSegment:
+    """One segment file of DeltaJournal and appends to it which are still in flight"""
+
+    def __init__(self, path, handler):
+        self.path = path
+        # None if segment file could not be opened
+        self.handler = handler
+        # Segment misses deltas after disk error
+        self.failed = handler is None
+        # Appends reserved under counters lock and not written yet
+        self.writers = 0
+
+
+class DeltaJournal:
+    """
+    Append-only on-disk journal of counter deltas which are not in database yet.
+
+    Ingest appends every batch of deltas to the current segment file with one write()
+    call. Each counters swap seals current segment and starts the next one, so sealed
+    segments hold exactly what was swapped out for database write. When write succeeds
+    sealed segments are deleted, while database is unavailable they are compacted.
+    On start segments left by previous run are replayed into counters.
+
+    Counters lock only picks the segment (reserve, rotate), file I/O happens after
+    it is released, so a slow spool disk never holds up ingest on the counters lock.
+    Next segment is opened ahead, sealing waits for appends still in flight.
+
+    Segment is a sequence of entries: struct ENTRY followed by username in utf-8.
+    Edge entry follows the delta of an edge frame: edge_id, epoch and sequence
+    in place of username, outgoing and incoming. History buckets are not journaled.
+
+    Disk errors (full disk, I/O error) never stop ingestion: they are logged, the
+    failed segment is not written anymore and journal is degraded until sealed
+    segments with missing deltas are in database.
+    """
+    ENTRY = struct.Struct("<BHQQ")
+    MAX_USERNAME = 65535
+
+    KIND_DELTA = 0
+    KIND_RESET = 1
+    KIND_EDGE = 2
+
+    PREFIX = "journal."
+    SUFFIX = ".seg"
+
+    # Compact sealed segments into one when there are more of them
+    COMPACT_SEGMENTS = 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sequence = 0
+        self.current = None
+        # Segment current one is rotated to, opened ahead of time
+        self.spare = None
+        # Sealed segment paths, oldest first
+        self.sealed = []
+        self.unsynced = []
+        # One of sealed segments misses deltas after disk error
+        self.sealed_failed = False
+        # edge_id -> (epoch, sequence) of the last edge frame in sealed segments, by replay
+        self.edges = {}
+        # Guards writers of segments
+        self.condition = threading.Condition()
+        # Appends to the same segment do not interleave
+        self.write_lock = threading.Lock()
+        self.error_log = RateLimitedLog()
+
+    @property
+    def degraded(self):
+        """Journal misses some deltas which are not in database yet"""
+        return self.current.failed or self.sealed_failed
+
+    def fail(self, segment, message, error):
+        """Log disk error, segment is not written anymore"""
+        segment.failed = True
+        self.error_log.write("ERROR: " + str(datetime.datetime.now()) + " Journal " +
+                             message + ", spool is degraded: " + str(error))
+
+    def segment_path(self, sequence):
+        """Path of segment file with given sequence number"""
+        return os.path.join(self.directory, self.PREFIX + "%012d" % sequence + self.SUFFIX)
+
+    def open_segment(self):
+        """Open the next segment file"""
+        path = self.segment_path(self.sequence)
+        self.sequence += 1
+        try:
+            return JournalSegment(path, open(path, "ab", buffering=0))
+        # pylint: disable=C0103
+        except OSError as e:
+            segment = JournalSegment(path, None)
+            self.fail(segment, "segment open failed", e)
+            return segment
+        # pylint: enable=C0103
+
+    def open(self):
+        """Pick up segments left by previous run as sealed and open new segments"""
+        os.makedirs(self.directory, exist_ok=True)
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.startswith(self.PREFIX) and filename.endswith(self.SUFFIX):
+                sequence = int(filename[len(self.PREFIX):-len(self.SUFFIX)])
+                self.sealed.append(os.path.join(self.directory, filename))
+                self.sequence = max(self.sequence, sequence + 1)
+            elif filename.endswith(".tmp"):
+                # Unfinished compaction
+                os.remove(os.path.join(self.directory, filename))
+        self.current = self.open_segment()
+        self.spare = self.open_segment()
+
+    def close(self):
+        """Close segment files, data stays on disk for the next run"""
+        for segment in (self.current, self.spare):
+            if segment is not None and segment.handler is not None:
+                segment.handler.close()
+        self.current = None
+        self.spare = None
+
+    def pack_records(self, records):
+        """Entries of list of parsed IoopRecords"""
+        batch = {}
+        for record in records:
+            value = batch.get(record.username)
+            if value is None:
+                value = batch[record.username] = [0, 0]
+            value[record.direction] += record.nbytes
+        return self.pack_entries((username, value[0], value[1])
+                                 for username, value in batch.items())
+
+    def pack_delta(self, usernames, values, edge=None):
+        """Entries of delta in flat form, values are [out, in, out, in, ...],
+        followed by entry of edge frame (edge_id, epoch, sequence) it came with"""
+        entries = self.pack_entries(zip(usernames, values[0::2], values[1::2]))
+        if edge is None:
+            return entries
+        return entries + self.pack_edges([edge])
+
+    def pack_edges(self, edges):
+        """Edge entries of (edge_id, epoch, sequence) rows, edge ids come from
+        frames, their length fits ENTRY"""
+        chunks = []
+        for edge_id, epoch, sequence in edges:
+            raw = edge_id.encode("utf-8")
+            chunks.append(self.ENTRY.pack(self.KIND_EDGE, len(raw), epoch, sequence))
+            chunks.append(raw)
+        return b"".join(chunks)
+
+    def pack_entries(self, rows):
+        """Delta entries of (username, outgoing, incoming) rows. Usernames too long
+        for ENTRY are skipped, cutting them could split a character."""
+        pack = self.ENTRY.pack
+        chunks = []
+        skipped = 0
+        for username, outgoing, incoming in rows:
+            raw = username.encode("utf-8")
+            if len(raw) > self.MAX_USERNAME:
+                skipped += 1
+                continue
+            chunks.append(pack(self.KIND_DELTA, len(raw), outgoing, incoming))
+            chunks.append(raw)
+        if skipped:
+            self.error_log.write("ERROR: " + str(datetime.datetime.now()) + " " + str(skipped) +
+                                 " usernames longer than " + str(self.MAX_USERNAME) +
+                                 " bytes are not journaled")
+        return b"".join(chunks)
+
+    def reserve(self):
+        """Segment for the next append, counters lock must be held,
+        so the append lands in the segment of its swap period"""
+        segment = self.current
+        with self.condition:
+            segment.writers += 1
+        return segment
+
+    def write(self, segment, data):
+        """Append data to reserved segment, counters lock must not be held"""
+        try:
+            if not segment.failed:
+                with self.write_lock:
+                    segment.handler.write(data)
+        # pylint: disable=C0103
+        except OSError as e:
+            self.fail(segment, "write failed", e)
+        # pylint: enable=C0103
+        finally:
+            with self.condition:
+                segment.writers -= 1
+                if not segment.writers:
+                    self.condition.notify_all()
+
+    def append_reset(self):
+        """Journal counters reset, counters lock must be held. Appends in flight are
+        written first, replay must not count them after the reset. Resets are rare,
+        this is the only journal write under counters lock."""
+        with self.condition:
+            while self.current.writers:
+                self.condition.wait()
+        self.write(self.reserve(), self.ENTRY.pack(self.KIND_RESET, 0, 0, 0))
+
+    def rotate(self):
+        """Switch appends to the next segment, counters lock must be held.
+        Returns the previous segment, to be sealed once the lock is released."""
+        segment, self.current = self.current, self.spare
+        self.spare = None
+        return segment
+
+    def seal(self, segment):
+        """Close rotated segment once appends in flight are written,
+        and open the segment of the next rotate"""
+        with self.condition:
+            while segment.writers:
+                self.condition.wait()
+        if segment.handler is not None:
+            try:
+                segment.handler.close()
+            # pylint: disable=C0103
+            except OSError as e:
+                self.fail(segment, "close failed", e)
+            # pylint: enable=C0103
+            self.sealed.append(segment.path)
+            self.unsynced.append(segment.path)
+        self.sealed_failed = self.sealed_failed or segment.failed
+        self.spare = self.open_segment()
+
+    def sync(self):
+        """Flush sealed segments to disk.
+        Returns True if sealed segments hold every swapped delta."""
+        for path in self.unsynced:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            # pylint: disable=C0103
+            except OSError as e:
+                self.sealed_failed = True
+                self.error_log.write("ERROR: " + str(datetime.datetime.now()) +
+                                     " Journal sync failed, spool is degraded: " + str(e))
+                continue
+            # pylint: enable=C0103
+            try:
+                os.fsync(fd)
+            # pylint: disable=C0103
+            except OSError as e:
+                self.sealed_failed = True
+                self.error_log.write("ERROR: " + str(datetime.datetime.now()) +
+                                     " Journal sync failed, spool is degraded: " + str(e))
+            # pylint: enable=C0103
+            finally:
+                os.close(fd)
+        self.unsynced = []
+        return not self.sealed_failed
+
+    def commit(self):
+        """Sealed segments are in database now, delete them"""
+        for path in self.sealed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            # pylint: disable=C0103
+            except OSError as e:
+                self.error_log.write("ERROR: " + str(datetime.datetime.now()) +
+                                     " Journal segment remove failed: " + str(e))
+            # pylint: enable=C0103
+        self.sealed = []
+        self.unsynced = []
+        self.sealed_failed = False
+
+    @classmethod
+    def read_segment(cls, path):
+        """Yield (kind, username, outgoing, incoming) entries of one segment file.
+        Entry truncated by a crash ends the segment."""
+        with open(path, "rb") as handler:
+            data = handler.read()
+        size = cls.ENTRY.size
+        unpack_from = cls.ENTRY.unpack_from
+        offset = 0
+        while offset + size <= len(data):
+            kind, length, outgoing, incoming = unpack_from(data, offset)
+            offset += size
+            if offset + length > len(data):
+                break
+            username = data[offset:offset + length].decode("utf-8", errors="replace")
+            offset += length
+            yield kind, username, outgoing, incoming
+
+    def replay(self):
+        """Sum up sealed segments. Returns (delta, reset): username -> [outgoing, incoming]
+        accumulated after the last reset, and whether there was a reset.
+        The last sequences of edge runs are left in edges."""
+        delta = defaultdict(lambda: [0, 0])
+        reset = False
+        self.edges = {}
+        for path in self.sealed:
+            for kind, username, outgoing, incoming in self.read_segment(path):
+                if kind == self.KIND_RESET:
+                    delta = defaultdict(lambda: [0, 0])
+                    reset = True
+                elif kind == self.KIND_EDGE:
+                    self.edges[username] = max(self.edges.get(username, (0, 0)),
+                                               (outgoing, incoming))
+                else:
+                    value = delta[username]
+                    value[0] += outgoing
+                    value[1] += incoming
+        return delta, reset
+
+    def compact(self):
+        """Merge sealed segments into one, if there are too many of them.
+        Segments stay as they are when it fails."""
+        if len(self.sealed) <= self.COMPACT_SEGMENTS:
+            return
+        try:
+            self.merge_sealed()
+        # pylint: disable=C0103
+        except OSError as e:
+            self.error_log.write("ERROR: " + str(datetime.datetime.now()) +
+                                 " Journal compaction failed: " + str(e))
+
+        # pylint: enable=C0103
+    def merge_sealed(self):
+        """Replace sealed segments by one with their sum"""
+        delta, reset = self.replay()
+        target = self.sealed[-1]
+        tmp_path = target + ".tmp"
+        with open(tmp_path, "wb") as handler:
+            if reset:
+                handler.write(self.ENTRY.pack(self.KIND_RESET, 0, 0, 0))
+            handler.write(self.pack_entries((username, value[0], value[1])
+                                            for username, value in delta.items()))
+            handler.write(self.pack_edges((edge_id, epoch, sequence) for edge_id,
+                                          (epoch, sequence) in self.edges.items()))
+            handler.flush()
+            os.fsync(handler.fileno())
+        os.replace(tmp_path, target)
+        for path in self.sealed[:-1]:
+            os.remove(path)
+        self.sealed = [target]
+        self.unsynced = []
+
+
+class TrafficHistory:
+    """
+    Per-user traffic history. Collects per-minute buckets swapped out of TrafficCounters
+    and turns them into rows for minute, hour and day tables. Rollups are incremental:
+    only new deltas are added to hour and day rows, nothing is recomputed.
+    """
+    MINUTE = 60
+    HOUR = 3600
+    DAY = 86400
+
+    # How often to delete expired history rows, in seconds
+    EXPIRE_PERIOD = 3600
+
+    TABLES = (("traffic_minute", MINUTE), ("traffic_hour", HOUR), ("traffic_day", DAY))
+
+    def __init__(self, application):
+        self.app = application
+        # (minute, username) -> [outgoing, incoming], not yet written to database
+        self.pending = defaultdict(lambda: [0, 0])
+        self.last_expire = 0
+
+    def add(self, buckets):
+        """Add per-minute buckets swapped out of counters"""
+        pending = self.pending
+        for key, value in buckets.items():
+            bucket = pending[key]
+            bucket[0] += value[0]
+            bucket[1] += value[1]
+
+    def rows(self):
+        """Pending deltas rolled up for every history table,
+        returns {table: [(bucket, username, outgoing, incoming), ...]}"""
+        result = {}
+        for table, period in self.TABLES:
+            if period == self.MINUTE:
+                rolled = self.pending
+            else:
+                rolled = defaultdict(lambda: [0, 0])
+                for (minute, username), value in self.pending.items():
+                    bucket = rolled[(minute - minute % period, username)]
+                    bucket[0] += value[0]
+                    bucket[1] += value[1]
+            result[table] = [(bucket, username, value[0], value[1])
+                             for (bucket, username), value in rolled.items()]
+        return result
+
+    def clear(self):
+        """Drop pending deltas after they were written"""
+        self.pending = defaultdict(lambda: [0, 0])
+
+    def expire_cutoffs(self, now=None):
+        """If it's time to apply retention policy, returns {table: oldest bucket to keep},
+        otherwise None"""
+        now = time.time() if now is None else now
+        if now - self.last_expire < self.EXPIRE_PERIOD:
+            return None
+        self.last_expire = now
+        retention = {"traffic_minute": self.app.history_minute_retention,
+                     "traffic_hour": self.app.history_hour_retention,
+                     "traffic_day": self.app.history_day_retention}
+        return {table: int(now) - days * self.DAY for table, days in retention.items()}
+
+
+class DimensionCounters:
+    """
+    Optional per-source and per-destination traffic accounting.
+
+    Exact counters are kept per (user, source), source being the dante server
+    which sent the log line (log feed peer address, or "local" for followed files).
+    They are deltas, swapped out and added to "traffic_source" table like history.
+
+    Destinations per user are tracked with a weighted space-saving sketch of
+    SLOTS_PER_K * top_k slots: heavy destinations stay, a new one evicts the lightest
+    and inherits its count, which is kept as the overcount bound ("error").
+    Total number of slots is capped by max_entries, bytes of users who do not fit
+    are not tracked per destination and only counted in untracked_bytes.
+    """
+
+    SLOTS_PER_K = 2
+
+    def __init__(self, top_k=10, max_entries=200000):
+        self.lock = threading.Lock()
+        self.top_k = top_k
+        self.slots = self.SLOTS_PER_K * top_k
+        self.max_users = max(1, max_entries // self.slots)
+
+        # (username, source) -> [outgoing, incoming], accumulated since the last swap
+        self.sources = defaultdict(lambda: [0, 0])
+        # username -> {destination: [bytes, error]}, cumulative
+        self.sketches = {}
+        # Users whose sketch changed since the last swap
+        self.dirty = set()
+        self.untracked_bytes = 0
+
+    @staticmethod
+    def destination(target):
+        """Destination host of dante endpoint, e.g. 93.184.216.34.80 -> 93.184.216.34"""
+        return target.rpartition(".")[0] or target
+
+    def offer(self, username, destination, nbytes):
+        """Count bytes to destination in user's sketch, lock must be held"""
+        sketch = self.sketches.get(username)
+        if sketch is None:
+            if len(self.sketches) >= self.max_users:
+                self.untracked_bytes += nbytes
+                return
+            sketch = self.sketches[username] = {}
+        entry = sketch.get(destination)
+        if entry is not None:
+            entry[0] += nbytes
+        elif len(sketch) < self.slots:
+            sketch[destination] = [nbytes, 0]
+        else:
+            lightest = min(sketch, key=lambda key: sketch[key][0])
+            count = sketch.pop(lightest)[0]
+            sketch[destination] = [count + nbytes, count]
+        self.dirty.add(username)
+
+    def add_records(self, records, source):
+        """Add list of parsed IoopRecords received from given source"""
+        destination = self.destination
+        with self.lock:
+            sources = self.sources
+            for record in records:
+                sources[(record.username, source)][record.direction] += record.nbytes
+                self.offer(record.username, destination(record.target), record.nbytes)
+
+    def add_rows(self, source_rows, destination_rows):
+        """Add rows shipped by ingest worker, (username, source, outgoing, incoming)
+        and (username, destination, bytes)"""
+        with self.lock:
+            for username, source, outgoing, incoming in source_rows:
+                value = self.sources[(username, source)]
+                value[0] += outgoing
+                value[1] += incoming
+            for username, destination, nbytes in destination_rows:
+                self.offer(username, destination, nbytes)
+
+    def drain(self):
+        """Take everything out, for ingest worker to ship.
+        Returns (source_rows, destination_rows), same as add_rows takes."""
+        with self.lock:
+            sources, self.sources = self.sources, defaultdict(lambda: [0, 0])
+            sketches, self.sketches = self.sketches, {}
+            self.dirty = set()
+        return ([(key[0], key[1], value[0], value[1]) for key, value in sources.items()],
+                [(username, destination, entry[0])
+                 for username, sketch in sketches.items()
+                 for destination, entry in sketch.items()])
+
+    def swap(self):
+        """Take per-source deltas and set of users with changed sketches out"""
+        fresh = defaultdict(lambda: [0, 0])
+        with self.lock:
+            sources, self.sources = self.sources, fresh
+            dirty, self.dirty = self.dirty, set()
+        return sources, dirty
+
+    def destination_rows(self, usernames):
+        """Top-K destinations of given users as (username, destination, bytes, error) rows"""
+        rows = []
+        with self.lock:
+            for username in usernames:
+                sketch = self.sketches.get(username)
+                if not sketch:
+                    continue
+                top = sorted(sketch.items(), key=lambda item: item[1][0], reverse=True)
+                rows.extend((username, destination, entry[0], entry[1])
+                            for destination, entry in top[:self.top_k])
+        return rows
+
+    def load_destinations(self, rows):
+        """Restore sketches from stored (username, destination, bytes, error) rows"""
+        with self.lock:
+            for username, destination, nbytes, error in rows:
+                sketch = self.sketches.get(username)
+                if sketch is None:
+                    if len(self.sketches) >= self.max_users:
+                        continue
+                    sketch = self.sketches[username] = {}
+                if len(sketch) < self.slots:
+                    sketch[destination] = [nbytes, error]
+
+
+class RateEstimator:
+    """
+    Live per-user bandwidth over sliding windows (WINDOWS, seconds), by dante log time.
+
+    Every window is an exponentially decayed byte count, kept with forward decay:
+    n bytes logged at time t add n * exp((t - landmark) / window) to user's sum, and
+    the rate now is sum * exp((landmark - now) / window) / window bytes per second.
+    Sums change only when user's traffic arrives and all of them decay alike, so
+    order of sums is order of current rates. top_k users with the largest sums are
+    kept per window in a heap updated with every batch, top-N never scans all users.
+
+    Landmark moves every REBASE windows, then all sums are rescaled and users who
+    went idle are forgotten. Landmarks follow wall clock, so sums of ingest workers
+    are simply added to aggregator's ones. Memory is one list of len(WINDOWS)
+    floats per recently active user.
+    """
+
+    WINDOWS = (10, 60, 300)
+    LABELS = ("10s", "1m", "5m")
+    # Landmark is moved that many windows later, exp(REBASE) must fit in a float
+    REBASE = 200
+    # Log time of records in one batch is grouped to that resolution, in seconds
+    RESOLUTION = 0.1
+    # Users slower than that over the longest window are forgotten, bytes/sec
+    MIN_RATE = 0.01
+
+    def __init__(self, top_k=100):
+        self.top_k = top_k
+        self.lock = threading.Lock()
+        # username -> [sum of every window]
+        self.sums = {}
+        now = time.time()
+        self.landmarks = [self.landmark(window, now) for window in self.WINDOWS]
+        # Per window: username -> sum of top_k users with the largest sums, and min-heap
+        # of (sum, username) over them. Heap entries which do not match members are stale.
+        self.members = [{} for _ in self.WINDOWS]
+        self.heaps = [[] for _ in self.WINDOWS]
+
+    @classmethod
+    def landmark(cls, window, now):
+        """Landmark of window at given time"""
+        period = window * cls.REBASE
+        return now - now % period
+
+    def add_records(self, records, now=None):
+        """Add list of parsed IoopRecords, records without log time are counted now"""
+        if now is None:
+            now = time.time()
+        resolution = self.RESOLUTION
+        # Log time ahead of our clock is counted as now
+        now_tick = int(now / resolution)
+        with self.lock:
+            self.check_landmarks(now)
+            increments = {}
+            # Log time mostly goes up within a batch: bytes of a run of records with
+            # the same tick are summed per user first, and weighted once per run
+            run = defaultdict(int)
+            run_tick = None
+            for _, username, nbytes, _, _, timestamp in records:
+                tick = int(timestamp / resolution) if timestamp else now_tick
+                if tick != run_tick:
+                    self.weigh_run(run, run_tick, now_tick, increments)
+                    run_tick = tick
+                run[username] += nbytes
+            self.weigh_run(run, run_tick, now_tick, increments)
+            self.add_sums(increments)
+
+    def weigh_run(self, run, tick, now_tick, increments):
+        """Add weighted bytes of one run to increments and empty the run, lock must be held"""
+        if not run:
+            return
+        moment = min(tick, now_tick) * self.RESOLUTION
+        weights = [math.exp((moment - landmark) / window)
+                   for landmark, window in zip(self.landmarks, self.WINDOWS)]
+        for username, nbytes in run.items():
+            increment = increments.get(username)
+            if increment is None:
+                increments[username] = [nbytes * weight for weight in weights]
+            else:
+                for i, weight in enumerate(weights):
+                    increment[i] += nbytes * weight
+        run.clear()
+
+    def add_rows(self, landmarks, rows):
+        """Add sums drained from ingest worker: landmarks they refer to,
+        and rows of (username, sum of every window)"""
+        with self.lock:
+            self.check_landmarks(time.time())
+            factors = [math.exp((landmark - own) / window) for landmark, own, window
+                       in zip(landmarks, self.landmarks, self.WINDOWS)]
+            self.add_sums({row[0]: [x * factor for x, factor in zip(row[1:], factors)]
+                           for row in rows})
+
+    def drain(self):
+        """Take sums out for shipping to aggregator, returns (landmarks, rows)"""
+        with self.lock:
+            sums, self.sums = self.sums, {}
+            self.members = [{} for _ in self.WINDOWS]
+            self.heaps = [[] for _ in self.WINDOWS]
+            return list(self.landmarks), [(username,) + tuple(value)
+                                          for username, value in sums.items()]
+
+    def add_sums(self, increments):
+        """Add to users' sums and update top users, lock must be held"""
+        sums = self.sums
+        top_k = self.top_k
+        windows = range(len(self.WINDOWS))
+        ranked = list(zip(windows, self.members, self.heaps)) if top_k else []
+        for username, increment in increments.items():
+            value = sums.get(username)
+            if value is None:
+                value = sums[username] = increment
+            else:
+                for i in windows:
+                    value[i] += increment[i]
+            for i, members, heap in ranked:
+                # Heap top is at most the smallest member sum, slower users are skipped
+                if len(members) < top_k or value[i] > heap[0][0] or username in members:
+                    self.rank(i, username, value[i])
+
+    def rank(self, index, username, value):
+        """User's sum of one window went up, update top users, lock must be held"""
+        members = self.members[index]
+        heap = self.heaps[index]
+        if username in members or len(members) < self.top_k:
+            members[username] = value
+            heapq.heappush(heap, (value, username))
+            if len(heap) > 4 * self.top_k:
+                # Too many stale entries
+                heap[:] = [(total, name) for name, total in members.items()]
+                heapq.heapify(heap)
+            return
+        while members.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if value > heap[0][0]:
+            del members[heapq.heapreplace(heap, (value, username))[1]]
+            members[username] = value
+
+    def check_landmarks(self, now):
+        """Move landmarks which are due, lock must be held"""
+        for i, window in enumerate(self.WINDOWS):
+            landmark = self.landmark(window, now)
+            if landmark > self.landmarks[i]:
+                self.rebase(i, landmark)
+                if i == 0:
+                    self.expire(now)
+
+    def rebase(self, index, landmark):
+        """Rescale sums of one window to a new landmark, lock must be held"""
+        factor = math.exp((self.landmarks[index] - landmark) / self.WINDOWS[index])
+        self.landmarks[index] = landmark
+        for value in self.sums.values():
+            value[index] *= factor
+        members = self.members[index]
+        for username in members:
+            members[username] *= factor
+        heap = [(value, username) for username, value in members.items()]
+        heapq.heapify(heap)
+        self.heaps[index] = heap
+
+    def expire(self, now):
+        """Forget users who went idle, unless they are among top users, lock must be held"""
+        last = len(self.WINDOWS) - 1
+        window = self.WINDOWS[last]
+        limit = self.MIN_RATE * window / math.exp((self.landmarks[last] - now) / window)
+        idle = [username for username, value in self.sums.items() if value[last] < limit and
+                not any(username in members for members in self.members)]
+        for username in idle:
+            del self.sums[username]
+
+    def rates(self, username, now=None):
+        """Current rates of one user, bytes/sec for every window, None if user is idle"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            value = self.sums.get(username)
+            if value is None:
+                return None
+            return [total * math.exp((landmark - now) / window) / window for total, landmark,
+                    window in zip(value, self.landmarks, self.WINDOWS)]
+
+    def top(self, count, index, now=None):
+        """count fastest users over window WINDOWS[index], list of (username, bytes/sec)"""
+        if now is None:
+            now = time.time()
+        window = self.WINDOWS[index]
+        with self.lock:
+            members = sorted(self.members[index].items(), key=lambda item: item[1],
+                             reverse=True)[:count]
+            decay = math.exp((self.landmarks[index] - now) / window) / window
+        return [(username, total * decay) for username, total in members]
+
+
+class QuotaEngine:
+    """
+    Per-user traffic quotas, checked inline as counters are updated.
+
+    Threshold index keeps, for every user with a quota, how many bytes are left
+    until the next threshold, so a parsed record costs one dict lookup and one
+    subtraction, and users without quota cost one failed lookup. Crossing puts
+    an event to the events queue, hooks are run by QuotaNotifier thread,
+    so ingest never waits for them.
+
+    Event is (username, percent, usage, quota), usage is incoming plus outgoing
+    bytes, percent is the highest threshold crossed, or 0 when usage went back
+    under all thresholds (counters reset, quota raised).
+    """
+
+    # Quota file size suffixes
+    UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+    def __init__(self, thresholds=(100,)):
+        self.lock = threading.Lock()
+        # Percents of quota, ascending
+        self.thresholds = sorted(thresholds)
+        # username -> quota, bytes
+        self.quotas = {}
+        # username -> bytes left until the next threshold, users over the last one are absent
+        self.remaining = {}
+        # username -> number of thresholds crossed
+        self.levels = {}
+        self.events = queue.SimpleQueue()
+
+    @classmethod
+    def read_file(cls, path):
+        """Read quota file, "username quota" per line, quota in bytes or with K/M/G/T suffix.
+        Returns {username: quota}"""
+        quotas = {}
+        with open(path) as handler:
+            for number, line in enumerate(handler, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    username, value = line.split()
+                    unit = cls.UNITS.get(value[-1].upper(), 1)
+                    quotas[username] = int(value[:-1] if unit > 1 else value) * unit
+                except ValueError:
+                    raise ValueError(path + ":" + str(number) + ": bad quota line: " + line)
+        return quotas
+
+    def limit(self, quota, level):
+        """Bytes of threshold number level"""
+        return quota * self.thresholds[level] // 100
+
+    def cross(self, username, left):
+        """User went left bytes over the next threshold, lock must be held"""
+        quota = self.quotas[username]
+        level = self.levels.get(username, 0)
+        usage = self.limit(quota, level) - left
+        while level < len(self.thresholds) and self.limit(quota, level) <= usage:
+            level += 1
+        self.levels[username] = level
+        self.events.put((username, self.thresholds[level - 1], usage, quota))
+        if level < len(self.thresholds):
+            self.remaining[username] = self.limit(quota, level) - usage
+        else:
+            del self.remaining[username]
+
+    def check_records(self, records):
+        """Account list of parsed IoopRecords"""
+        if not self.remaining:
+            return
+        with self.lock:
+            remaining = self.remaining
+            for record in records:
+                left = remaining.get(record.username)
+                if left is not None:
+                    left -= record.nbytes
+                    if left > 0:
+                        remaining[record.username] = left
+                    else:
+                        self.cross(record.username, left)
+
+    def check_delta(self, usernames, values):
+        """Account delta shipped by ingest worker, values are flat [out, in, out, in, ...]"""
+        if not self.remaining:
+            return
+        with self.lock:
+            remaining = self.remaining
+            for i, username in enumerate(usernames):
+                left = remaining.get(username)
+                if left is not None:
+                    left -= values[2 * i] + values[2 * i + 1]
+                    if left > 0:
+                        remaining[username] = left
+                    else:
+                        self.cross(username, left)
+
+    def rearm(self, quotas, usage):
+        """Rebuild threshold index from {username: quota} and current {username: usage}.
+        Users whose crossed thresholds changed get an event."""
+        with self.lock:
+            levels = {}
+            remaining = {}
+            for username, quota in quotas.items():
+                used = usage.get(username, 0)
+                level = 0
+                while level < len(self.thresholds) and self.limit(quota, level) <= used:
+                    level += 1
+                if level != self.levels.get(username, 0):
+                    self.events.put((username, self.thresholds[level - 1] if level else 0,
+                                     used, quota))
+                levels[username] = level
+                if level < len(self.thresholds):
+                    remaining[username] = self.limit(quota, level) - used
+            self.quotas = dict(quotas)
+            self.levels = levels
+            self.remaining = remaining
+
+
+class QuotaNotifier(threading.Thread):
+    """
+    Runs quota hooks for events of QuotaEngine: command, unix datagram socket
+    notification and quota flag in database. Events which arrived together
+    are flagged in database with one transaction.
+    """
+
+    def __init__(self, application, events):
+        super(QuotaNotifier, self).__init__(name="QUOTA", daemon=True)
+        self.app = application
+        self.events = events
+        self.writer = application.create_storage() if application.quota_database_flag else None
+        self.children = []
+        self.notified = 0
+
+    def run(self):
+        """Quota notifier thread "run" function"""
+        while True:
+            batch = [self.events.get()]
+            while True:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            batch = [event for event in batch if event is not None]
+            for event in batch:
+                self.notify(event)
+            if self.writer is not None and batch:
+                result, result_msg = self.writer.write_quota_flags(
+                    [(username, percent) for username, percent, _, _ in batch])
+                if result != 0:
+                    print("ERROR: " + str(datetime.datetime.now()) +
+                          " Unable to write quota flags: " + result_msg)
+            # Finished hook commands are reaped here
+            self.children = [child for child in self.children if child.poll() is None]
+            if stopping:
+                break
+        if self.writer is not None:
+            self.writer.close()
+
+    def notify(self, event):
+        """Run command and socket hooks for one event"""
+        username, percent, usage, quota = event
+        print("INFO : " + str(datetime.datetime.now()) + " Quota: user " + username +
+              (" crossed " + str(percent) + "%" if percent else " is under quota") +
+              " (" + str(usage) + " of " + str(quota) + " bytes)")
+        if self.app.quota_command:
+            try:
+                self.children.append(subprocess.Popen(
+                    shlex.split(self.app.quota_command) +
+                    [username, str(percent), str(usage), str(quota)]))
+            # pylint: disable=C0103
+            except OSError as e:
+                print("ERROR: " + str(datetime.datetime.now()) +
+                      " Unable to run quota command: " + str(e))
+            # pylint: enable=C0103
+        if self.app.quota_socket:
+            message = json.dumps({"username": username, "percent": percent,
+                                  "usage": usage, "quota": quota})
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                    sock.sendto(message.encode("utf-8"), self.app.quota_socket)
+            # pylint: disable=C0103
+            except OSError as e:
+                print("ERROR: " + str(datetime.datetime.now()) +
+                      " Unable to notify quota socket: " + str(e))
+            # pylint: enable=C0103
+        self.notified += 1
+
+    def stop(self):
+        """Stop after events queued so far are handled"""
+        self.events.put(None)
+
+
+class ReadSnapshot:
+    """
+    Immutable view of traffic counters for read API. Built by timer thread once
+    per write period and shared by every request until the next one, so readers
+    never touch live counters. Response with all users is serialized right away,
+    other queries work on pre-sorted lists.
+    """
+
+    # How many different top-N responses to keep serialized
+    TOP_CACHE_SIZE = 16
+
+    def __init__(self, counters, created=None):
+        self.created = time.time() if created is None else created
+        # username -> [outgoing, incoming]
+        self.counters = counters
+        self.usernames = sorted(counters)
+        self.by_total = sorted(self.usernames, reverse=True,
+                               key=lambda username: counters[username][0] +
+                               counters[username][1])
+        self.all_body = self.serialize(self.usernames)
+        self.top_cache = {}
+
+    def row(self, username):
+        """JSON object of one user"""
+        value = self.counters[username]
+        return {"username": username, "outgoing": value[0], "incoming": value[1]}
+
+    def serialize(self, usernames):
+        """Response body with given users"""
+        return json.dumps({"time": self.created,
+                           "users": [self.row(username) for username in usernames]},
+                          separators=(",", ":")).encode("utf-8")
+
+    def user(self, username):
+        """Response body of one user, None if user is unknown"""
+        if username not in self.counters:
+            return None
+        return self.serialize([username])
+
+    def prefix(self, prefix):
+        """Response body of users whose name starts with prefix"""
+        usernames = self.usernames
+        start = bisect.bisect_left(usernames, prefix)
+        end = start
+        while end < len(usernames) and usernames[end].startswith(prefix):
+            end += 1
+        return self.serialize(usernames[start:end])
+
+    def top(self, count):
+        """Response body of count users with most traffic, incoming plus outgoing"""
+        body = self.top_cache.get(count)
+        if body is None:
+            body = self.serialize(self.by_total[:count])
+            if len(self.top_cache) < self.TOP_CACHE_SIZE:
+                self.top_cache[count] = body
+        return body
+
+
+class HttpThread(threading.Thread):
+    """
+    Minimal read-only HTTP/1.0 server: one selector loop with non-blocking sockets,
+    so a slow client only waits for itself, never blocks ingest or other clients.
+    Listens on TCP address and port, or on unix socket if path is given.
+    Subclasses route requests in handle().
+    """
+
+    SELECT_TIMEOUT = 1
+    # Longer requests are rejected
+    MAX_REQUEST = 8192
+    # Connections which did not finish in time are closed, in seconds
+    REQUEST_TIMEOUT = 10
+
+    CONTENT_TYPE = "application/json"
+    STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+
+    def __init__(self, name, application, address, port, path=""):
+        super(HttpThread, self).__init__(name=name, daemon=True)
+        self.app = application
+        self.address = address
+        self.port = port
+        self.path = path
+        self.thread_running = True
+        self.sock = None
+        self.selector = None
+        # socket -> [request bytearray, response memoryview or None, accept time]
+        self.clients = {}
+        self.requests_served = 0
+
+    def listen(self):
+        """Open listening socket, unix or TCP"""
+        if self.path:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.path)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.address, self.port))
+        sock.listen(self.app.listen_backlog)
+        sock.setblocking(False)
+        self.sock = sock
+
+    def run(self):
+        """HTTP thread "run" function"""
+        try:
+            self.listen()
+        # pylint: disable=C0103
+        except OSError as e:
+            print("ERROR: " + str(datetime.datetime.now()) + " " + self.name +
+                  " socket bind failed: " + str(e))
+            return
+        # pylint: enable=C0103
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+        while self.thread_running:
+            for key, events in self.selector.select(timeout=self.SELECT_TIMEOUT):
+                if key.data is None:
+                    self.accept()
+                elif events & selectors.EVENT_WRITE:
+                    self.send(key.fileobj)
+                else:
+                    self.receive(key.fileobj)
+            expired = time.monotonic() - self.REQUEST_TIMEOUT
+            for conn in [conn for conn, state in self.clients.items() if state[2] < expired]:
+                self.close(conn)
+
+        for conn in list(self.clients):
+            self.close(conn)
+        self.selector.close()
+        self.sock.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def accept(self):
+        """Accept new client"""
+        try:
+            conn, _ = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        self.clients[conn] = [bytearray(), None, time.monotonic()]
+        self.selector.register(conn, selectors.EVENT_READ, True)
+
+    def close(self, conn):
+        """Forget client"""
+        self.selector.unregister(conn)
+        del self.clients[conn]
+        conn.close()
+
+    def receive(self, conn):
+        """Read request, answer it once headers are complete"""
+        state = self.clients[conn]
+        try:
+            data = conn.recv(self.MAX_REQUEST)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close(conn)
+            return
+        state[0] += data
+        if b"\r\n\r\n" not in state[0] and b"\n\n" not in state[0]:
+            if len(state[0]) > self.MAX_REQUEST:
+                self.close(conn)
+            return
+        status, body = self.route(bytes(state[0].split(b"\n", 1)[0]))
+        head = ("HTTP/1.0 " + str(status) + " " + self.STATUS[status] + "\r\n" +
+                "Content-Type: " + self.CONTENT_TYPE + "\r\n" +
+                "Content-Length: " + str(len(body)) + "\r\n" +
+                "Connection: close\r\n\r\n").encode("ascii")
+        state[1] = memoryview(head + body)
+        self.selector.modify(conn, selectors.EVENT_WRITE, True)
+        self.send(conn)
+
+    def send(self, conn):
+        """Send as much of response as socket takes"""
+        state = self.clients[conn]
+        try:
+            sent = conn.send(state[1])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close(conn)
+            return
+        state[1] = state[1][sent:]
+        if not state[1]:
+            self.requests_served += 1
+            self.close(conn)
+
+    def route(self, request_line):
+        """Parse request line and pass it to handle(), returns (status, body)"""
+        parts = request_line.decode("latin-1").split()
+        if len(parts) < 2 or parts[0] != "GET":
+            return 400, b'{"error":"only GET is supported"}'
+        url = urllib.parse.urlsplit(parts[1])
+        return self.handle(urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query))
+
+    def handle(self, path, query):
+        """Answer GET request, returns (status, body)"""
+        raise NotImplementedError
+
+    def stop(self):
+        """Set the thread to stop"""
+        self.thread_running = False
+
+
+class ReadApiThread(HttpThread):
+    """
+    Read-only HTTP API over live traffic counters, served from ReadSnapshot
+    published by timer thread.
+
+    GET /traffic             all users
+    GET /traffic?prefix=P    users whose name starts with P
+    GET /traffic/USER        one user
+    GET /top?n=N             N users with most traffic
+
+    Every response is {"time": snapshot time, "users": [{"username", "outgoing",
+    "incoming"}, ...]}. Listens on TCP address, or on unix socket if configured.
+
+    With [rates] enabled, live bandwidth in bytes/sec comes straight from RateEstimator:
+    GET /rates/USER                  {"time", "username", "rates": {"10s", "1m", "5m"}}
+    GET /rates?n=N&window=1m         {"time", "window", "users": [{"username", "rate"}, ...]},
+                                     N fastest users over window
+    """
+
+    # Upper limit of top-N
+    MAX_TOP = 10000
+
+    def __init__(self, application):
+        super(ReadApiThread, self).__init__("API", application, application.api_address,
+                                            application.api_port, application.api_socket)
+        self.snapshot = ReadSnapshot({})
+
+    def publish(self, snapshot):
+        """Replace snapshot served to new requests"""
+        self.snapshot = snapshot
+
+    def handle(self, path, query):
+        """Route one request, returns (status, body)"""
+        snapshot = self.snapshot
+        if path == "/traffic":
+            if "prefix" in query:
+                return 200, snapshot.prefix(query["prefix"][0])
+            return 200, snapshot.all_body
+        if path.startswith("/traffic/"):
+            body = snapshot.user(path[len("/traffic/"):])
+            if body is None:
+                return 404, b'{"error":"unknown user"}'
+            return 200, body
+        if path == "/top":
+            try:
+                count = int(query.get("n", ["10"])[0])
+            except ValueError:
+                return 400, b'{"error":"n must be a number"}'
+            return 200, snapshot.top(max(0, min(count, self.MAX_TOP)))
+        if path == "/rates" or path.startswith("/rates/"):
+            return self.handle_rates(path, query)
+        return 404, b'{"error":"unknown path"}'
+
+    def handle_rates(self, path, query):
+        """Live bandwidth requests, returns (status, body)"""
+        rates = self.app.rates
+        if rates is None:
+            return 404, b'{"error":"rates are disabled"}'
+        now = time.time()
+        if path.startswith("/rates/"):
+            username = path[len("/rates/"):]
+            values = rates.rates(username, now)
+            if values is None:
+                return 404, b'{"error":"unknown user"}'
+            return 200, json.dumps({"time": now, "username": username,
+                                    "rates": dict(zip(rates.LABELS, values))},
+                                   separators=(",", ":")).encode("utf-8")
+        window = query.get("window", ["1m"])[0]
+        if window not in rates.LABELS:
+            return 400, ('{"error":"window must be one of ' + ", ".join(rates.LABELS) +
+                         '"}').encode("utf-8")
+        try:
+            count = int(query.get("n", ["10"])[0])
+        except ValueError:
+            return 400, b'{"error":"n must be a number"}'
+        users = rates.top(max(0, count), rates.LABELS.index(window), now)
+        return 200, json.dumps({"time": now, "window": window,
+                                "users": [{"username": username, "rate": rate}
+                                          for username, rate in users]},
+                               separators=(",", ":")).encode("utf-8")
+
+
+class MetricsThread(HttpThread):
+    """Serves application metrics in Prometheus text format, GET /metrics"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self, application):
+        super(MetricsThread, self).__init__("METRICS", application, application.metrics_address,
+                                            application.metrics_port)
+
+    def handle(self, path, query):
+        """Route one request, returns (status, body)"""
+        if path == "/metrics":
+            return 200, self.app.metrics.render()
+        return 404, b"Not found, try /metrics\n"
+
+
+class StorageBackend:
+    """
+    Base class of traffic counters storage, selected by "backend" in [database] section.
+    Subclasses implement load_traffic, store_traffic, store_history and close,
+    raising one of ERRORS on failure. Public write_* methods never raise,
+    they return (result, result_msg) and keep flush statistics.
+    """
+
+    # Exceptions which mean storage is not available right now
+    ERRORS = ()
+
+    # Rows read at once while totals are loaded at start
+    LOAD_BATCH_ROWS = 10000
+
+    def __init__(self, application):
+        self.app = application
+
+        # edge_id -> (epoch, sequence) of edge frames merged into totals, stored
+        # in the same transaction as traffic rows, so a collector restart never
+        # applies a resent frame twice
+        self.edge_sequences = {}
+
+        # Flush statistics
+        self.flushes = 0
+        self.rows_total = 0
+        self.last_flush_rows = 0
+        self.last_flush_latency = 0.0
+
+    def load_traffic(self):
+        """Read all stored counters, returns list of (username, incoming, outgoing)"""
+        raise NotImplementedError
+
+    def load_edge_sequences(self):
+        """Read stored sequences of edge runs, list of (edge_id, epoch, sequence)"""
+        return []
+
+    def edge_rows(self):
+        """Edge sequences to store with traffic rows, list of (edge_id, epoch, sequence)"""
+        return [(edge_id, epoch, sequence)
+                for edge_id, (epoch, sequence) in self.edge_sequences.items()]
+
+    def add_delta(self, delta, reset=False):
+        """Deltas swapped out of counters, before totals of changed users are written.
+        Only storage which forwards deltas instead of totals needs them."""
+
+    def iter_traffic(self):
+        """Read all stored counters in batches of up to LOAD_BATCH_ROWS,
+        yields lists of (username, incoming, outgoing). Reads them at once by default."""
+        yield self.load_traffic()
+
+    def store_traffic(self, rows):
+        """Upsert list of (username, outgoing, incoming) rows, and edge_sequences,
+        in one transaction"""
+        raise NotImplementedError
+
+    def replace_traffic(self, rows):
+        """Replace totals of given users, large batch"""
+        self.store_traffic(rows)
+
+    def store_history(self, tables, cutoffs):
+        """Add history deltas and delete rows older than cutoffs in one transaction"""
+        raise NotImplementedError
+
+    def load_destinations(self):
+        """Read stored top destinations, list of (username, destination, bytes, error)"""
+        raise NotImplementedError
+
+    def store_dimensions(self, sources, destinations):
+        """Add per-source deltas and replace top destinations of users in destinations"""
+        raise NotImplementedError
+
+    def load_quotas(self):
+        """Read per-user quotas, list of (username, quota)"""
+        raise NotImplementedError
+
+    def store_quota_flags(self, rows):
+        """Set crossed quota threshold of users, rows are (username, percent)"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release storage, if anything is held"""
+
+    def reset(self):
+        """Drop storage handle after error, next call will reopen it"""
+        try:
+            self.close()
+        except self.ERRORS:
+            pass
+
+    def write_traffic(self, rows):
+        """Upsert list of (username, outgoing, incoming) rows in one batched transaction.
+        Returns (result, result_msg), result is 0 on success."""
+        started = time.perf_counter()
+        if not rows:
+            self.last_flush_rows = 0
+            self.last_flush_latency = 0.0
+            return 0, "Nothing to write"
+        try:
+            self.store_traffic(rows)
+        # pylint: disable=C0103
+        except self.ERRORS as e:
+            self.reset()
+            return 1, str(e)
+        # pylint: enable=C0103
+
+        self.last_flush_latency = time.perf_counter() - started
+        self.last_flush_rows = len(rows)
+        self.flushes += 1
+        self.rows_total += len(rows)
+        return 0, "OK!"
+
+    def bulk_load_traffic(self, rows):
+        """Replace totals of given users, rows are (username, outgoing, incoming).
+        Returns (result, result_msg)."""
+        started = time.perf_counter()
+        try:
+            self.replace_traffic(rows)
+        # pylint: disable=C0103
+        except self.ERRORS as e:
+            self.reset()
+            return 1, str(e)
+        # pylint: enable=C0103
+        self.last_flush_latency = time.perf_counter() - started
+        self.last_flush_rows = len(rows)
+        return 0, "OK!"
+
+    def write_history(self, tables, cutoffs=None):
+        """Add history deltas, {table: [(bucket, username, outgoing, incoming), ...]},
+        and delete rows older than cutoffs, {table: bucket}, in one transaction.
+        Returns (result, result_msg), result is 0 on success."""
+        try:
+            self.store_history(tables, cutoffs or {})
+        # pylint: disable=C0103
+        except self.ERRORS as e:
+            self.reset()
+            return 1, str(e)
+        # pylint: enable=C0103
+        return 0, "OK!"
+
+    def write_dimensions(self, sources, destinations):
+        """Add per-source deltas, [(username, source, outgoing, incoming), ...],
+        and replace top destinations of users found in destinations,
+        [(username, destination, bytes, error), ...], in one transaction.
+        Returns (result, result_msg), result is 0 on success."""
+        try:
+            self.store_dimensions(sources, destinations)
+        # pylint: disable=C0103
+        except self.ERRORS as e:
+            self.reset()
+            return 1, str(e)
+        # pylint: enable=C0103
+        return 0, "OK!"
+
+    def write_quota_flags(self, rows):
+        """Set "exceeded" column of quota table to crossed threshold percent,
+        rows are (username, percent). Returns (result, result_msg)."""
+        try:
+            self.store_quota_flags(rows)
+        # pylint: disable=C0103
+        except self.ERRORS as e:
+            self.reset()
+            return 1, str(e)
+        # pylint: enable=C0103
+        return 0, "OK!"
+
+
+class PgsqlBackend(StorageBackend):
+    """
+    Keeps one persistent PostgreSQL connection for the whole application lifetime.
+    Connection is re-established on the next call after any database error.
+    """
+
+    ERRORS = (psycopg2.Error,)
+
+    # Rows per one multi-row INSERT statement
+    PAGE_SIZE = 1000
+
+    UPSERT_SQL = ("INSERT INTO traffic(username, outgoing, incoming) VALUES %s "
+                  "ON CONFLICT(username) DO UPDATE "
+                  "SET outgoing=EXCLUDED.outgoing, incoming=EXCLUDED.incoming")
+
+    HISTORY_SQL = ("INSERT INTO {table}(bucket, username, outgoing, incoming) VALUES %s "
+                   "ON CONFLICT(bucket, username) DO UPDATE "
+                   "SET outgoing={table}.outgoing+EXCLUDED.outgoing, "
+                   "incoming={table}.incoming+EXCLUDED.incoming")
+
+    SOURCE_SQL = ("INSERT INTO traffic_source(username, source, outgoing, incoming) VALUES %s "
+                  "ON CONFLICT(username, source) DO UPDATE "
+                  "SET outgoing=traffic_source.outgoing+EXCLUDED.outgoing, "
+                  "incoming=traffic_source.incoming+EXCLUDED.incoming")
+
+    EDGE_SQL = ("INSERT INTO traffic_edge(edge_id, epoch, sequence) VALUES %s "
+                "ON CONFLICT(edge_id) DO UPDATE "
+                "SET epoch=EXCLUDED.epoch, sequence=EXCLUDED.sequence")
+
+    def __init__(self, application):
+        super(PgsqlBackend, self).__init__(application)
+        self.conn = None
+
+    def connect(self):
+        """Return open connection, connecting if required.
+        Raises psycopg2.OperationalError if database is not available."""
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(host=self.app.db_hostname,
+                                         database=self.app.db_name,
+                                         user=self.app.db_username,
+                                         password=self.app.db_password,
+                                         connect_timeout=5)
+        return self.conn
+
+    def close(self):
+        """Close connection, if any"""
+        conn, self.conn = self.conn, None
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def load_traffic(self):
+        """Read all stored counters, returns list of (username, incoming, outgoing)"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT username, incoming, outgoing FROM traffic")
+                rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.Error:
+            self.reset()
+            raise
+        return rows
+
+    def iter_traffic(self):
+        """Stream stored counters with server-side cursor, table is never
+        held in memory as a whole"""
+        conn = self.connect()
+        try:
+            with conn.cursor(name="dante_trafmon_load") as cur:
+                cur.itersize = self.LOAD_BATCH_ROWS
+                cur.execute("SELECT username, incoming, outgoing FROM traffic")
+                while True:
+                    rows = cur.fetchmany(self.LOAD_BATCH_ROWS)
+                    if not rows:
+                        break
+                    yield rows
+            conn.commit()
+        except psycopg2.Error:
+            self.reset()
+            raise
+
+    def load_edge_sequences(self):
+        """Read traffic_edge table, it is only required on collectors"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('traffic_edge')")
+                rows = []
+                if cur.fetchone()[0] is not None:
+                    cur.execute("SELECT edge_id, epoch, sequence FROM traffic_edge")
+                    rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.Error:
+            self.reset()
+            raise
+        return rows
+
+    def store_traffic(self, rows):
+        """Upsert rows with multi-row INSERT statements"""
+        conn = self.connect()
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, self.UPSERT_SQL, rows,
+                                           page_size=self.PAGE_SIZE)
+            if self.edge_sequences:
+                psycopg2.extras.execute_values(cur, self.EDGE_SQL, self.edge_rows())
+        conn.commit()
+
+    @staticmethod
+    def copy_escape(value):
+        """Escape text value for COPY text format"""
+        return (value.replace("\\", "\\\\").replace("\t", "\\t")
+                .replace("\n", "\\n").replace("\r", "\\r"))
+
+    def replace_traffic(self, rows):
+        """One COPY into staging table and one upsert"""
+        data = io.StringIO()
+        for username, outgoing, incoming in rows:
+            data.write(self.copy_escape(username) + "\t" + str(outgoing) + "\t" +
+                       str(incoming) + "\n")
+        data.seek(0)
+        conn = self.connect()
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE traffic_staging "
+                        "(username varchar, outgoing bigint, incoming bigint) "
+                        "ON COMMIT DROP")
+            cur.copy_expert("COPY traffic_staging(username, outgoing, incoming) "
+                            "FROM STDIN", data)
+            cur.execute("INSERT INTO traffic(username, outgoing, incoming) "
+                        "SELECT username, outgoing, incoming FROM traffic_staging "
+                        "ON CONFLICT(username) DO UPDATE "
+                        "SET outgoing=EXCLUDED.outgoing, incoming=EXCLUDED.incoming")
+        conn.commit()
+
+    def store_history(self, tables, cutoffs):
+        """Additive upserts of history buckets, then retention deletes"""
+        conn = self.connect()
+        with conn.cursor() as cur:
+            for table, rows in tables.items():
+                if rows:
+                    psycopg2.extras.execute_values(cur,
+                                                   self.HISTORY_SQL.format(table=table),
+                                                   rows, page_size=self.PAGE_SIZE)
+            for table, bucket in cutoffs.items():
+                cur.execute("DELETE FROM " + table + " WHERE bucket < %s", (bucket,))
+        conn.commit()
+
+    def load_destinations(self):
+        """Read stored top destinations, list of (username, destination, bytes, error)"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT username, destination, bytes, error FROM traffic_destination")
+                rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.Error:
+            self.reset()
+            raise
+        return rows
+
+    def store_dimensions(self, sources, destinations):
+        """Additive upserts of per-source counters, top destinations are replaced"""
+        conn = self.connect()
+        with conn.cursor() as cur:
+            if sources:
+                psycopg2.extras.execute_values(cur, self.SOURCE_SQL, sources,
+                                               page_size=self.PAGE_SIZE)
+            if destinations:
+                cur.execute("DELETE FROM traffic_destination WHERE username = ANY(%s)",
+                            (list({row[0] for row in destinations}),))
+                psycopg2.extras.execute_values(
+                    cur, "INSERT INTO traffic_destination(username, destination, bytes, error) "
+                         "VALUES %s", destinations, page_size=self.PAGE_SIZE)
+        conn.commit()
+
+    def load_quotas(self):
+        """Read per-user quotas, list of (username, quota)"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT username, quota FROM traffic_quota")
+                rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.Error:
+            self.reset()
+            raise
+        return rows
+
+    def store_quota_flags(self, rows):
+        """Update "exceeded" column of quota table"""
+        conn = self.connect()
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_batch(
+                cur, "UPDATE traffic_quota SET exceeded=%s WHERE username=%s",
+                [(percent, username) for username, percent in rows])
+        conn.commit()
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Embedded storage in SQLite database file, for single-box setups.
+    Tables are created on first use. Database runs in WAL mode, so every
+    flush is one batched transaction with a single sequential log write,
+    and reports can read the file while trafmon writes it.
+    """
+
+    ERRORS = (sqlite3.Error,)
+
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS traffic(username text PRIMARY KEY, "
+              "incoming integer DEFAULT 0, outgoing integer DEFAULT 0)",
+              "CREATE TABLE IF NOT EXISTS traffic_source(username text, source text, "
+              "incoming integer DEFAULT 0, outgoing integer DEFAULT 0, "
+              "PRIMARY KEY (username, source))",
+              "CREATE TABLE IF NOT EXISTS traffic_destination(username text, "
+              "destination text, bytes integer, error integer DEFAULT 0, "
+              "PRIMARY KEY (username, destination))",
+              "CREATE TABLE IF NOT EXISTS traffic_quota(username text PRIMARY KEY, "
+              "quota integer, exceeded integer DEFAULT 0)",
+              "CREATE TABLE IF NOT EXISTS traffic_edge(edge_id text PRIMARY KEY, "
+              "epoch integer, sequence integer)")
+
+    HISTORY_SCHEMA = ("CREATE TABLE IF NOT EXISTS {table}(bucket integer, username text, "
+                      "incoming integer DEFAULT 0, outgoing integer DEFAULT 0, "
+                      "PRIMARY KEY (bucket, username))")
+
+    UPSERT_SQL = ("INSERT INTO traffic(username, outgoing, incoming) VALUES (?, ?, ?) "
+                  "ON CONFLICT(username) DO UPDATE "
+                  "SET outgoing=excluded.outgoing, incoming=excluded.incoming")
+
+    HISTORY_SQL = ("INSERT INTO {table}(bucket, username, outgoing, incoming) "
+                   "VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT(bucket, username) DO UPDATE "
+                   "SET outgoing={table}.outgoing+excluded.outgoing, "
+                   "incoming={table}.incoming+excluded.incoming")
+
+    SOURCE_SQL = ("INSERT INTO traffic_source(username, source, outgoing, incoming) "
+                  "VALUES (?, ?, ?, ?) "
+                  "ON CONFLICT(username, source) DO UPDATE "
+                  "SET outgoing=traffic_source.outgoing+excluded.outgoing, "
+                  "incoming=traffic_source.incoming+excluded.incoming")
+
+    EDGE_SQL = ("INSERT INTO traffic_edge(edge_id, epoch, sequence) VALUES (?, ?, ?) "
+                "ON CONFLICT(edge_id) DO UPDATE "
+                "SET epoch=excluded.epoch, sequence=excluded.sequence")
+
+    def __init__(self, application):
+        super(SqliteBackend, self).__init__(application)
+        self.conn = None
+
+    def connect(self):
+        """Return open connection, creating database file and tables if required"""
+        if self.conn is None:
+            # Connection is opened by one thread and used by another one
+            # (timer thread), never concurrently
+            conn = sqlite3.connect(self.app.db_path, timeout=5, check_same_thread=False)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                # WAL is synced on checkpoints only, committed flush survives
+                # process crash, power loss may take the last flushes away
+                conn.execute("PRAGMA synchronous=NORMAL")
+                with conn:
+                    for statement in self.SCHEMA:
+                        conn.execute(statement)
+                    for table, _ in TrafficHistory.TABLES:
+                        conn.execute(self.HISTORY_SCHEMA.format(table=table))
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self.conn = conn
+        return self.conn
+
+    def close(self):
+        """Close connection, if any"""
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+
+    def load_traffic(self):
+        """Read all stored counters, returns list of (username, incoming, outgoing)"""
+        try:
+            return self.connect().execute(
+                "SELECT username, incoming, outgoing FROM traffic").fetchall()
+        except sqlite3.Error:
+            self.reset()
+            raise
+
+    def iter_traffic(self):
+        """Read stored counters in batches from one cursor"""
+        try:
+            cur = self.connect().execute("SELECT username, incoming, outgoing FROM traffic")
+            while True:
+                rows = cur.fetchmany(self.LOAD_BATCH_ROWS)
+                if not rows:
+                    break
+                yield rows
+        except sqlite3.Error:
+            self.reset()
+            raise
+
+    def load_edge_sequences(self):
+        """Read traffic_edge table"""
+        try:
+            return self.connect().execute(
+                "SELECT edge_id, epoch, sequence FROM traffic_edge").fetchall()
+        except sqlite3.Error:
+            self.reset()
+            raise
+
+    def store_traffic(self, rows):
+        """Upsert rows in one transaction"""
+        with self.connect() as conn:
+            conn.executemany(self.UPSERT_SQL, rows)
+            if self.edge_sequences:
+                conn.executemany(self.EDGE_SQL, self.edge_rows())
+
+    def store_history(self, tables, cutoffs):
+        """Additive upserts of history buckets, then retention deletes"""
+        with self.connect() as conn:
+            for table, rows in tables.items():
+                if rows:
+                    conn.executemany(self.HISTORY_SQL.format(table=table), rows)
+            for table, bucket in cutoffs.items():
+                conn.execute("DELETE FROM " + table + " WHERE bucket < ?", (bucket,))
+
+    def load_destinations(self):
+        """Read stored top destinations, list of (username, destination, bytes, error)"""
+        try:
+            return self.connect().execute(
+                "SELECT username, destination, bytes, error FROM traffic_destination").fetchall()
+        except sqlite3.Error:
+            self.reset()
+            raise
+
+    def store_dimensions(self, sources, destinations):
+        """Additive upserts of per-source counters, top destinations are replaced"""
+        with self.connect() as conn:
+            conn.executemany(self.SOURCE_SQL, sources)
+            conn.executemany("DELETE FROM traffic_destination WHERE username = ?",
+                             [(username,) for username in {row[0] for row in destinations}])
+            conn.executemany("INSERT INTO traffic_destination(username, destination, bytes, "
+                             "error) VALUES (?, ?, ?, ?)", destinations)
+
+    def load_quotas(self):
+        """Read per-user quotas, list of (username, quota)"""
+        try:
+            return self.connect().execute("SELECT username, quota FROM traffic_quota").fetchall()
+        except sqlite3.Error:
+            self.reset()
+            raise
+
+    def store_quota_flags(self, rows):
+        """Update "exceeded" column of quota table"""
+        with self.connect() as conn:
+            conn.executemany("UPDATE traffic_quota SET exceeded=? WHERE username=?",
+                             [(percent, username) for username, percent in rows])
+
+
+class SnapshotBackend(StorageBackend):
+    """
+    Keeps all totals in one compact binary file, which is written aside
+    and atomically renamed over the old one, so a reader or a crash never
+    sees it half-written. Whole file is rewritten on every flush with changes,
+    which suits a few thousand users. Traffic history and dimensions are not kept.
+
+    File is MAGIC followed by entries: struct ENTRY (username length,
+    outgoing, incoming) and UTF-8 username. Collector's file is EDGE_MAGIC,
+    number of edges (struct EDGE_COUNT) and their entries (edge id length, epoch,
+    sequence, edge id) first, then the same user entries.
+    """
+
+    ERRORS = (OSError, ValueError)
+
+    MAGIC = b"DTMSNAP1"
+    EDGE_MAGIC = b"DTMSNAP2"
+    EDGE_COUNT = struct.Struct("<I")
+    ENTRY = struct.Struct("<HQQ")
+    MAX_USERNAME = 65535
+
+    def __init__(self, application):
+        super(SnapshotBackend, self).__init__(application)
+        # username -> (outgoing, incoming), as stored in the file
+        self.totals = None
+        if self.app.history_enabled or self.app.dimensions_enabled:
+            print("INFO : " + str(datetime.datetime.now()) +
+                  " Snapshot file storage does not keep traffic history and dimensions.")
+
+    @classmethod
+    def read_file(cls, path):
+        """Read snapshot file, returns {username: (outgoing, incoming)}.
+        Missing file is an empty snapshot."""
+        return cls.read_snapshot(path)[0]
+
+    @classmethod
+    def read_snapshot(cls, path):
+        """Read snapshot file, returns ({username: (outgoing, incoming)},
+        [(edge_id, epoch, sequence), ...]). Missing file is an empty snapshot."""
+        try:
+            with open(path, "rb") as handler:
+                data = handler.read()
+        except FileNotFoundError:
+            return {}, []
+        magic = data[:len(cls.MAGIC)]
+        if magic not in (cls.MAGIC, cls.EDGE_MAGIC):
+            raise ValueError("Not a traffic snapshot file: " + path)
+        offset = len(cls.MAGIC)
+        edges = []
+        if magic == cls.EDGE_MAGIC:
+            if offset + cls.EDGE_COUNT.size > len(data):
+                raise ValueError("Truncated traffic snapshot file: " + path)
+            count = cls.EDGE_COUNT.unpack_from(data, offset)[0]
+            offset += cls.EDGE_COUNT.size
+            for _ in range(count):
+                edge_id, epoch, sequence, offset = cls.read_entry(data, offset, path)
+                edges.append((edge_id, epoch, sequence))
+        totals = {}
+        while offset < len(data):
+            username, outgoing, incoming, offset = cls.read_entry(data, offset, path)
+            totals[username] = (outgoing, incoming)
+        return totals, edges
+
+    @classmethod
+    def read_entry(cls, data, offset, path):
+        """Entry at offset, returns (name, first, second, offset of the next entry)"""
+        if offset + cls.ENTRY.size > len(data):
+            raise ValueError("Truncated traffic snapshot file: " + path)
+        length, first, second = cls.ENTRY.unpack_from(data, offset)
+        offset += cls.ENTRY.size
+        if offset + length > len(data):
+            raise ValueError("Truncated traffic snapshot file: " + path)
+        return data[offset:offset + length].decode("utf-8"), first, second, offset + length
+
+    @classmethod
+    def write_file(cls, path, totals, edges=()):
+        """Write snapshot to temporary file, sync it and rename over path.
+        Edges are (edge_id, epoch, sequence) rows."""
+        pack = cls.ENTRY.pack
+        chunks = [cls.MAGIC]
+        if edges:
+            chunks = [cls.EDGE_MAGIC, cls.EDGE_COUNT.pack(len(edges))]
+            for edge_id, epoch, sequence in edges:
+                # Edge ids come from frames, their length fits ENTRY
+                name = edge_id.encode("utf-8")
+                chunks.append(pack(len(name), epoch, sequence))
+                chunks.append(name)
+        skipped = 0
+        for username, (outgoing, incoming) in totals.items():
+            name = username.encode("utf-8")
+            if len(name) > cls.MAX_USERNAME:
+                # Length does not fit ENTRY
+                skipped += 1
+                continue
+            chunks.append(pack(len(name), outgoing, incoming))
+            chunks.append(name)
+        if skipped:
+            print("ERROR: " + str(datetime.datetime.now()) + " " + str(skipped) +
+                  " usernames longer than " + str(cls.MAX_USERNAME) +
+                  " bytes are not stored in snapshot file")
+        cls.replace_file(path, b"".join(chunks))
+
+    @staticmethod
+    def replace_file(path, data):
+        """Write data to temporary file, sync it and rename over path"""
+        temp = path + ".tmp"
+        with open(temp, "wb") as handler:
+            handler.write(data)
+            handler.flush()
+            os.fsync(handler.fileno())
+        os.replace(temp, path)
+        # Rename itself is durable only after directory is synced
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def load_traffic(self):
+        """Read all stored counters, returns list of (username, incoming, outgoing)"""
+        self.totals = self.read_file(self.app.db_path)
+        return [(username, value[1], value[0]) for username, value in self.totals.items()]
+
+    def load_edge_sequences(self):
+        """Read edge sequences of collector's file"""
+        return self.read_snapshot(self.app.db_path)[1]
+
+    def store_traffic(self, rows):
+        """Apply changed rows and replace the file"""
+        if self.totals is None:
+            self.totals = self.read_file(self.app.db_path)
+        totals = dict(self.totals)
+        for username, outgoing, incoming in rows:
+            totals[username] = (outgoing, incoming)
+        self.write_file(self.app.db_path, totals, self.edge_rows())
+        self.totals = totals
+
+    def store_history(self, tables, cutoffs):
+        """History is not kept, buckets are dropped"""
+
+    def load_destinations(self):
+        """Dimensions are not kept"""
+        return []
+
+    def store_dimensions(self, sources, destinations):
+        """Dimensions are not kept, deltas are dropped"""
+
+    def load_quotas(self):
+        """There is no quota table, quotas come from quota file"""
+        return []
+
+    def store_quota_flags(self, rows):
+        """There is no quota table, flags are dropped"""
+
+    def close(self):
+        """Forget loaded totals, file is re-read on next use"""
+        self.totals = None
+
+
+class EdgeBackend(StorageBackend):
+    """
+    Edge mode: traffic is not stored here, but forwarded to a central collector
+    trafmon, which owns the database. Swapped per-user deltas are collected in
+    an outbox and sent as one compressed FrameProtocol.DELTA frame per write period.
+    Each frame has a sequence number and is resent until acknowledged, collector
+    applies every sequence of an edge run once and acknowledges it once stored. Traffic history, dimensions and
+    counters reset are not forwarded.
+    """
+
+    ERRORS = (OSError, ValueError)
+
+    # How long to wait for collector to connect, in seconds
+    TIMEOUT = 5
+    # How long to wait for acknowledgement, collector sends it once the delta is
+    # stored, up to its write period (and database write) later
+    ACK_TIMEOUT = 60
+
+    def __init__(self, application):
+        super(EdgeBackend, self).__init__(application)
+        self.edge_id = application.edge_id or socket.gethostname()
+        # Sequences start over with every run, collector tells runs apart by epoch
+        self.epoch = time.time_ns()
+        self.sequence = 0
+        # Deltas not framed yet
+        self.outbox = CounterStore()
+        # (sequence, frame) sent, but not acknowledged yet
+        self.inflight = None
+        self.sock = None
+        self.reader = None
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    def add_delta(self, delta, reset=False):
+        """Collect swapped deltas for the next frame"""
+        self.outbox.add_delta(delta)
+
+    def connect(self):
+        """Return open connection to collector, connecting if required"""
+        if self.sock is None:
+            host, port = self.app.edge_collector.rsplit(":", 1)
+            self.sock = socket.create_connection((host, int(port)), timeout=self.TIMEOUT)
+            self.sock.settimeout(self.ACK_TIMEOUT)
+            self.sock.sendall(FrameProtocol.MAGIC)
+            self.reader = FrameReader()
+        return self.sock
+
+    def send_frame(self, sequence, frame):
+        """Send frame and wait until collector acknowledges it"""
+        sock = self.connect()
+        sock.sendall(frame)
+        self.frames_sent += 1
+        self.bytes_sent += len(frame)
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionResetError("Collector closed connection")
+            for kind, payload in self.reader.feed(data):
+                if kind == FrameProtocol.ACK and \
+                        FrameProtocol.ACK_BODY.unpack(payload)[0] >= sequence:
+                    return
+
+    def load_traffic(self):
+        """Edge keeps no totals, they are collector's"""
+        return []
+
+    def store_traffic(self, rows):
+        """Forward deltas collected since the last acknowledged frame, rows of totals
+        are only a sign that something changed"""
+        while True:
+            if self.inflight is None:
+                if not self.outbox:
+                    return
+                self.sequence += 1
+                usernames, values = self.outbox.export()
+                self.inflight = (self.sequence, FrameProtocol.pack_delta(
+                    self.edge_id, self.epoch, self.sequence, usernames, values))
+                self.outbox = CounterStore()
+            self.send_frame(*self.inflight)
+            self.inflight = None
+
+    def store_history(self, tables, cutoffs):
+        """History is not forwarded"""
+
+    def load_destinations(self):
+        """Dimensions are not forwarded"""
+        return []
+
+    def store_dimensions(self, sources, destinations):
+        """Dimensions are not forwarded"""
+
+    def load_quotas(self):
+        """Quotas come from quota file on edge"""
+        return []
+
+    def store_quota_flags(self, rows):
+        """Quota flags are not forwarded"""
+
+    def close(self):
+        """Close connection to collector, unacknowledged frame is resent on reconnect"""
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock.close()
+
+
+class TimerThread(threading.Thread):
+    """
+    Timer thread class, will write data to database every write_period seconds
+    """
+    log_thread = None
+    app = None
+
+    # Counters saved on clean shutdown, in state_directory: SNAPSHOT_MAGIC, number
+    # of users (struct SNAPSHOT_HEADER), array("Q") of [outgoing, incoming] pairs in
+    # native byte order, UTF-8 usernames joined with newlines
+    SNAPSHOT_FILE = "traffic.snapshot"
+    SNAPSHOT_MAGIC = b"DTMSTRT1"
+    SNAPSHOT_HEADER = struct.Struct("<Q")
+
+    def __init__(self, application, log_thread):
+        super(TimerThread, self).__init__()
+        self.log_thread = log_thread
+        self.app = application
+        self.writer = application.create_storage()
+        # Users changed since the last successful write
+        self.pending_users = set()
+
+        self.history = None
+        if self.app.history_enabled:
+            self.history = TrafficHistory(application)
+            self.app.counters.enable_buckets()
+
+        self.dimensions = None
+        if self.app.dimensions_enabled:
+            self.app.enable_dimensions()
+            self.dimensions = self.app.dimensions
+        if self.app.rates_enabled:
+            self.app.enable_rates()
+        # Per-source deltas and users with changed top destinations, not written yet
+        self.pending_sources = defaultdict(lambda: [0, 0])
+        self.pending_destinations = set()
+
+        self.quota = None
+        self.quota_notifier = None
+        if self.app.quota_enabled:
+            self.app.enable_quota()
+            self.quota = self.app.quota
+            self.quota_notifier = QuotaNotifier(application, self.quota.events)
+        # When quotas were loaded, 0 to load them as soon as possible
+        self.quota_loaded = 0
+
+        self.read_api = ReadApiThread(application) if self.app.api_enabled else None
+        self.metrics_server = MetricsThread(application) if self.app.metrics_enabled else None
+        self.row_log = RateLimitedLog(application.log_rate)
+
+        # Database was not available at start, totals are not loaded yet.
+        # Until then swapped deltas are kept aside.
+        self.waiting_for_db = False
+        self.backlog = CounterStore()
+        self.backlog_reset = False
+        # (LogFollower, position) at the last swap, saved once swapped lines are stored
+        self.follow_positions = []
+        # (source, sequence) of edge delta frames in swapped deltas, not acknowledged yet
+        self.edge_frames = []
+
+        self.journal = None
+        if self.app.spool_enabled:
+            self.open_journal()
+
+        # Set once totals are loaded from database
+        self.loaded = threading.Event()
+
+    def open_journal(self):
+        """Open spool journal and replay deltas left by previous run"""
+        self.journal = DeltaJournal(self.app.spool_directory)
+        self.journal.open()
+        delta, reset = self.journal.replay()
+        if reset:
+            self.app.counters.reset()
+        self.app.counters.add_delta(list(delta), [n for value in delta.values() for n in value])
+        # Replayed deltas are already journaled in old segments
+        self.app.counters.journal = self.journal
+        if self.journal.sealed:
+            print("INFO : " + str(datetime.datetime.now()) + " Spool: replayed " +
+                  str(len(delta)) + " users from " + str(len(self.journal.sealed)) +
+                  " segments")
+
+    def snapshot_path(self):
+        """Where counters are saved on clean shutdown"""
+        return os.path.join(self.app.state_directory, self.SNAPSHOT_FILE)
+
+    def restore_snapshot(self):
+        """Restore totals saved on clean shutdown, so read API and quotas see them
+        before database is loaded. Snapshot is used once, a crash later on
+        never brings a stale one back. Returns number of restored users."""
+        path = self.snapshot_path()
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "rb") as handler:
+                data = handler.read()
+            os.unlink(path)
+            if data[:len(self.SNAPSHOT_MAGIC)] != self.SNAPSHOT_MAGIC:
+                raise ValueError("Not a counters snapshot file: " + path)
+            offset = len(self.SNAPSHOT_MAGIC)
+            count = self.SNAPSHOT_HEADER.unpack_from(data, offset)[0]
+            offset += self.SNAPSHOT_HEADER.size
+            values = array("Q")
+            values.frombytes(data[offset:offset + count * 2 * values.itemsize])
+            offset += count * 2 * values.itemsize
+            usernames = data[offset:].decode("utf-8").split("\n") if count else []
+            if len(values) != 2 * count or len(usernames) != count:
+                raise ValueError("Truncated counters snapshot file: " + path)
+        # pylint: disable=C0103
+        except (OSError, ValueError, struct.error) as e:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to restore counters snapshot: " + str(e))
+            return 0
+        # pylint: enable=C0103
+        self.app.counters.load_packed(usernames, values)
+        print("INFO : " + str(datetime.datetime.now()) + " Restored " +
+              str(count) + " users from " + path)
+        return count
+
+    def save_snapshot(self):
+        """Save totals for the next start, they are the same as in database now"""
+        counters = self.app.counters
+        with counters.totals_lock:
+            usernames, values = counters.totals.export()
+        data = self.SNAPSHOT_MAGIC + self.SNAPSHOT_HEADER.pack(len(usernames)) + \
+            values.tobytes() + "\n".join(usernames).encode("utf-8")
+        try:
+            os.makedirs(self.app.state_directory, exist_ok=True)
+            SnapshotBackend.replace_file(self.snapshot_path(), data)
+        # pylint: disable=C0103
+        except OSError as e:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to save counters snapshot: " + str(e))
+            return 1, str(e)
+        # pylint: enable=C0103
+        return 0, "OK!"
+
+    def stream_traffic(self):
+        """Stored totals as (username, outgoing, incoming), streamed from database"""
+        verbose = self.app.verbose >= 3
+        for rows in self.writer.iter_traffic():
+            for username, incoming, outgoing in rows:
+                if verbose:
+                    self.row_log.write("  ", username, ':', incoming, '  ', outgoing)
+                yield username, outgoing, incoming
+
+    def data_init_from_db(self):
+        """Initialize data from database. This is important, if script cannot receive data
+        from database if should halt.
+        Totals are streamed in batches and replace whatever was restored from snapshot,
+        database is the source of truth. Ingest keeps counting deltas meanwhile."""
+        result = 0
+        result_msg = "OK!"
+        started = time.perf_counter()
+
+        if self.app.verbose >= 3:
+            print("INFO : " + str(datetime.datetime.now()) +
+                  " Database: '" + self.app.db_name +
+                  " Hostname: " + self.app.db_hostname +
+                  " User: " + self.app.db_name +
+                  " Password: " + self.app.db_password)
+
+        edge_thread = self.log_thread if isinstance(self.log_thread, LogThread) else None
+        try:
+            self.app.counters.load(self.stream_traffic(), replace=True)
+            destinations = self.writer.load_destinations() \
+                if self.dimensions is not None else []
+            edges = self.writer.load_edge_sequences() if edge_thread is not None else []
+        # pylint: disable=C0103
+        except self.writer.ERRORS as e:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to connect to database (data_init_from_db)")
+            print("ERROR: " + str(datetime.datetime.now()) + " " + str(e))
+            result = 1
+            result_msg = str(e)
+        # pylint: enable=C0103
+        else:
+            if self.dimensions is not None:
+                self.dimensions.load_destinations(destinations)
+            if edge_thread is not None:
+                # Journal holds frames applied after the last database write
+                if self.journal is not None:
+                    edges += [(edge_id, epoch, sequence) for edge_id, (epoch, sequence)
+                              in self.journal.edges.items()]
+                edge_thread.restore_edge_sequences(edges)
+            self.loaded.set()
+            if self.app.verbose >= 2:
+                print("INFO : " + str(datetime.datetime.now()) + " Loaded " +
+                      str(len(self.app.counters.totals)) + " users from database in " +
+                      "%.1f ms" % ((time.perf_counter() - started) * 1000))
+
+        return result, result_msg
+
+    def swap_counters(self):
+        """Swap delta buffer out, noting positions of followed files (their lines
+        up to the position are in the swapped delta) and edge frames in it"""
+        locks = [follower.lock for follower in self.app.followers]
+        if isinstance(self.log_thread, LogThread):
+            locks.append(self.log_thread.frame_lock)
+        for lock in locks:
+            lock.acquire()
+        try:
+            delta, reset = self.app.counters.swap()
+            self.follow_positions = [(follower, follower.position)
+                                     for follower in self.app.followers
+                                     if follower.position is not None]
+            if isinstance(self.log_thread, LogThread):
+                self.edge_frames.extend(self.log_thread.unacked)
+                self.log_thread.unacked = []
+                # Sequences of frames merged into swapped delta are stored with it
+                self.writer.edge_sequences = dict(self.log_thread.edge_sequences)
+        finally:
+            for lock in locks:
+                lock.release()
+        return delta, reset
+
+    def confirm_stored(self):
+        """Swapped deltas are safe: save offsets of followed files noted at the
+        last swap and acknowledge edge frames"""
+        positions, self.follow_positions = self.follow_positions, []
+        for follower, position in positions:
+            follower.checkpoint(position)
+        frames, self.edge_frames = self.edge_frames, []
+        LogThread.acknowledge(frames)
+
+    def write_to_pgsql(self):
+        """Merge counters collected since the last call and write changed users"""
+        counters = self.app.counters
+        delta, reset = self.swap_counters()
+        if self.journal is not None and self.journal.sync():
+            # Journal replays swapped deltas after a crash, they are safe already
+            self.confirm_stored()
+
+        if self.waiting_for_db:
+            # Totals are not loaded yet, keep swapped deltas aside
+            if reset:
+                self.backlog = CounterStore()
+                self.backlog_reset = True
+            self.backlog.add_delta(delta)
+            result, result_msg = self.data_init_from_db()
+            if result != 0:
+                self.journal.compact()
+                return result, result_msg
+            self.waiting_for_db = False
+            delta, reset = self.backlog, self.backlog_reset
+            self.backlog = CounterStore()
+            self.backlog_reset = False
+
+        counters.merge(delta, reset)
+        self.writer.add_delta(delta, reset)
+        if reset:
+            self.pending_users = set()
+            # Quota usage went back to zero
+            self.quota_loaded = 0
+        self.pending_users.update(delta)
+
+        rows = counters.rows(self.pending_users)
+        if self.app.verbose >= 3:
+            for username, outgoing, incoming in rows:
+                self.row_log.write("  ", username, ':', incoming, '  ', outgoing)
+
+        result, result_msg = self.writer.write_traffic(rows)
+        metrics = self.app.metrics
+        metrics.set("users", len(counters.totals))
+        if rows:
+            metrics.inc("flushes_total", 1, (("result", "error" if result else "ok"),))
+        if result == 0 and rows:
+            metrics.histograms["flush_seconds"].observe(self.writer.last_flush_latency)
+            metrics.inc("flush_rows_total", len(rows))
+        if result == 0:
+            self.pending_users = set()
+            if self.journal is not None:
+                self.journal.commit()
+            self.confirm_stored()
+        else:
+            if self.journal is not None:
+                self.journal.compact()
+            # Pending users stay, will be retried on the next write
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to write to database (main cycle)")
+            print("ERROR: " + str(datetime.datetime.now()) + " " + result_msg)
+        return result, result_msg
+
+    def write_history(self):
+        """Write per-minute buckets and their hour and day rollups"""
+        self.history.add(self.app.counters.swap_buckets())
+        result, result_msg = self.writer.write_history(self.history.rows(),
+                                                       self.history.expire_cutoffs())
+        if result == 0:
+            self.history.clear()
+        else:
+            # Pending buckets stay, retention will be retried on the next period
+            self.history.last_expire = 0
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to write traffic history (main cycle)")
+            print("ERROR: " + str(datetime.datetime.now()) + " " + result_msg)
+        return result, result_msg
+
+    def write_dimensions(self):
+        """Write per-source deltas and top destinations of changed users"""
+        sources, users = self.dimensions.swap()
+        for key, value in sources.items():
+            pending = self.pending_sources[key]
+            pending[0] += value[0]
+            pending[1] += value[1]
+        self.pending_destinations.update(users)
+
+        result, result_msg = self.writer.write_dimensions(
+            [(key[0], key[1], value[0], value[1]) for key, value in self.pending_sources.items()],
+            self.dimensions.destination_rows(self.pending_destinations))
+        if result == 0:
+            self.pending_sources = defaultdict(lambda: [0, 0])
+            self.pending_destinations = set()
+        else:
+            # Pending deltas stay, will be retried on the next period
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to write traffic dimensions (main cycle)")
+            print("ERROR: " + str(datetime.datetime.now()) + " " + result_msg)
+        return result, result_msg
+
+    def refresh_quota(self):
+        """Load quotas and rebuild threshold index with current usage"""
+        try:
+            if self.app.quota_source == "database":
+                quotas = dict(self.writer.load_quotas())
+            else:
+                quotas = QuotaEngine.read_file(self.app.quota_file)
+        # pylint: disable=C0103
+        except (OSError, ValueError) + self.writer.ERRORS as e:
+            print("ERROR: " + str(datetime.datetime.now()) + " Unable to load quotas: " + str(e))
+            # Retried on the next reload period, thresholds loaded before stay armed
+            self.quota_loaded = time.time()
+            return 1, str(e)
+        # pylint: enable=C0103
+        self.app.counters.rearm_quota(quotas)
+        self.quota_loaded = time.time()
+        return 0, "OK!"
+
+    def publish_snapshot(self):
+        """Give read API a fresh snapshot of counters"""
+        self.read_api.publish(ReadSnapshot(self.app.counters.snapshot()))
+
+    def run(self):
+        """Timer threar "run" function"""
+
+        if self.log_thread is None:
+            return
+
+        if self.quota_notifier is not None:
+            self.quota_notifier.start()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+
+        # Counters of clean shutdown are served right away, database load replaces them
+        if self.app.snapshot_enabled:
+            self.restore_snapshot()
+        if self.read_api is not None:
+            self.publish_snapshot()
+            self.read_api.start()
+
+        # Getting initial data from database
+        result, result_msg = self.data_init_from_db()
+        if result != 0:
+            if self.journal is None:
+                print("ERROR: " + str(datetime.datetime.now()) +
+                      " Database is not available, terminating now.")
+                self.log_thread.stop()
+                if self.quota_notifier is not None:
+                    self.quota_notifier.stop()
+                if self.read_api is not None:
+                    self.read_api.stop()
+                if self.metrics_server is not None:
+                    self.metrics_server.stop()
+                return
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Database is not available, spooling traffic to " +
+                  self.app.spool_directory + " until it is back.")
+        self.waiting_for_db = result != 0
+
+        while self.log_thread.thread_running:
+            # Write to PGSQL, ingest keeps running meanwhile
+            result, result_msg = self.write_to_pgsql()
+            if result == 0 and self.history is not None:
+                result, result_msg = self.write_history()
+            if result == 0 and self.dimensions is not None:
+                result, result_msg = self.write_dimensions()
+
+            if result == 0:
+                if self.app.verbose >= 2:
+                    print("INFO : " + str(datetime.datetime.now()) +
+                          " Data write to database (OK), " +
+                          str(self.writer.last_flush_rows) + " rows in " +
+                          "%.1f ms" % (self.writer.last_flush_latency * 1000))
+            else:
+                print("INFO : " + str(datetime.datetime.now()) + " Data write to database (FAIL)")
+
+            if self.quota is not None and not self.waiting_for_db and \
+                    time.time() - self.quota_loaded >= self.app.quota_reload_period:
+                self.refresh_quota()
+            if self.read_api is not None:
+                self.publish_snapshot()
+
+            time.sleep(self.app.write_period)
+
+        # Listener stops after its parsers are drained, then the last deltas are written
+        if self.log_thread.is_alive():
+            self.log_thread.join()
+        result, result_msg = self.write_to_pgsql()
+        if result == 0 and self.app.snapshot_enabled and not self.waiting_for_db:
+            self.save_snapshot()
+
+        if self.quota_notifier is not None:
+            self.quota_notifier.stop()
+            self.quota_notifier.join()
+        if self.read_api is not None:
+            self.read_api.stop()
+            self.read_api.join()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server.join()
+        self.writer.close()
+        if self.journal is not None:
+            self.journal.close()
+
+
+# timestamp is dante log time, seconds since the epoch, 0.0 if line has none
+IoopRecord = namedtuple("IoopRecord", ["direction", "username", "nbytes", "client", "target",
+                                       "timestamp"], defaults=(0.0,))
+_new_tuple = tuple.__new__
+
+
+class IoopParser:
+    """
+    Parser of dante "ioop" log lines, like these two:
+
+    ... tcp/connect -: username%user@10.0.0.5.52112 10.0.0.1.1080 -> 10.0.0.1.52113 1.2.3.4.80 (517)
+    ... tcp/connect -: 1.2.3.4.80 10.0.0.1.52113 -> 10.0.0.1.1080 username%user@10.0.0.5.52112 (1448)
+
+    Username on the left side of "->" means outgoing traffic, on the right side - incoming.
+    Line is classified in one pass with plain string searches, no backtracking.
+    """
+    DIRECTION_OUT = 0
+    DIRECTION_IN = 1
+
+    # Smaller numbers in the first parentheses are not log time, 2001-09-09
+    MIN_TIMESTAMP = 1e9
+
+    def __init__(self, timestamps=False):
+        # Log time is parsed only if someone needs it, it costs a float() per line
+        self.timestamps = timestamps
+
+    def parse(self, line):
+        """Parse one log line. Returns IoopRecord, or None if it is not an ioop line"""
+        user_pos = line.find("username%")
+        if user_pos < 0:
+            return None
+        arrow = line.rfind("->")
+        open_pos = line.rfind("(")
+        close_pos = line.rfind(")")
+        if arrow < 0 or open_pos < arrow or close_pos < open_pos:
+            return None
+        try:
+            nbytes = int(line[open_pos + 1:close_pos])
+        except ValueError:
+            return None
+        # Endpoints section ends right before " (bytes)"
+        ep_end = open_pos - 1 if line[open_pos - 1] == " " else open_pos
+
+        user_start = user_pos + 9
+        if user_pos < arrow:
+            # Outgoing: client on the left, target is the last endpoint on the right
+            at_pos = line.rfind("@", user_start, arrow)
+            if at_pos < 0:
+                return None
+            direction = self.DIRECTION_OUT
+            client_end = line.find(" ", at_pos, arrow)
+            client = line[at_pos + 1:client_end if client_end >= 0 else arrow]
+            target = line[line.rfind(" ", arrow, ep_end) + 1:ep_end]
+        else:
+            # Incoming: target is the first endpoint on the left, client on the right
+            at_pos = line.rfind("@", user_start, ep_end)
+            if at_pos < 0:
+                return None
+            direction = self.DIRECTION_IN
+            client = line[at_pos + 1:ep_end]
+            target_pos = line.rfind(": ", 0, arrow) + 2
+            target_end = line.find(" ", target_pos, arrow)
+            target = line[target_pos:target_end if target_end >= 0 else arrow]
+
+        # Log time in parentheses goes first: "Oct 18 12:00:01 (1792324801.123456) danted..."
+        timestamp = 0.0
+        ts_open = line.find("(", 0, user_pos) if self.timestamps else -1
+        if ts_open >= 0:
+            try:
+                timestamp = float(line[ts_open + 1:line.find(")", ts_open, user_pos)])
+            except ValueError:
+                pass
+            if timestamp < self.MIN_TIMESTAMP:
+                # "pass(1)" of a line without log time
+                timestamp = 0.0
+
+        # tuple.__new__ skips the pure python namedtuple constructor
+        return _new_tuple(IoopRecord, (direction, line[user_start:at_pos], nbytes, client, target,
+                                       timestamp))
+
+
+class LineFramer:
+    """
+    Splits a byte stream into complete lines. Data is received straight into
+    a reusable buffer, a partial line is kept until the rest of it arrives, and
+    only whole lines are decoded.
+    """
+
+    def __init__(self, buffer_size=262144, max_line_length=16384):
+        # Buffer always has free space: partial line never exceeds max_line_length
+        buffer_size = max(buffer_size, max_line_length * 2)
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        self.max_line_length = max_line_length
+        # Dropping the rest of an oversized line until next newline
+        self.discarding = False
+
+        self.malformed_lines = 0
+        self.oversized_lines = 0
+
+    def recv_into(self, conn):
+        """Receive data from socket into free space of the buffer.
+        Returns number of bytes received, 0 if peer closed the connection."""
+        return conn.recv_into(self.view[self.filled:])
+
+    def read_into(self, handler):
+        """Read data from unbuffered file into free space of the buffer.
+        Returns number of bytes read, 0 at the end of file."""
+        return handler.readinto(self.view[self.filled:]) or 0
+
+    def feed(self, nbytes):
+        """Account nbytes just written into the buffer, return list of complete lines"""
+        self.filled += nbytes
+        buf = self.buffer
+        end = buf.rfind(b"\n", 0, self.filled)
+
+        if end < 0:
+            # No complete line yet
+            if self.filled > self.max_line_length:
+                if not self.discarding:
+                    self.oversized_lines += 1
+                self.discarding = True
+                self.filled = 0
+            return []
+
+        start = 0
+        if self.discarding:
+            start = buf.find(b"\n", 0, end + 1) + 1
+            self.discarding = False
+
+        lines = self.decode(self.view[start:end])
+
+        # Move partial line to the beginning of the buffer
+        tail = self.filled - end - 1
+        if tail > self.max_line_length:
+            self.oversized_lines += 1
+            self.discarding = True
+            tail = 0
+        elif tail:
+            buf[:tail] = self.view[end + 1:self.filled]
+        self.filled = tail
+        return lines
+
+    def flush(self):
+        """Return the last line if stream ended without newline"""
+        lines = []
+        if self.filled and not self.discarding:
+            lines = self.decode(self.view[:self.filled])
+        self.filled = 0
+        self.discarding = False
+        return lines
+
+    def decode(self, chunk):
+        """Decode block of complete lines, skipping malformed and oversized ones"""
+        if not chunk:
+            return []
+        data = bytes(chunk)
+        try:
+            lines = data.decode("utf-8").split("\n")
+        except UnicodeDecodeError:
+            # Slow path, find out which lines are broken
+            lines = []
+            for raw in data.split(b"\n"):
+                try:
+                    lines.append(raw.decode("utf-8"))
+                except UnicodeDecodeError:
+                    self.malformed_lines += 1
+
+        if len(data) > self.max_line_length:
+            count = len(lines)
+            lines = [line for line in lines if len(line) <= self.max_line_length]
+            self.oversized_lines += count - len(lines)
+        return lines
+
 
-        return result, result_msg
+class FrameProtocol:
+    """
+    Binary protocol between trafmon nodes, served on the same port as plain log lines.
+    Connection starts with MAGIC, which no log line does, then frames follow:
+    struct HEADER (frame type, payload length) and payload.
+
+      DELTA - zlib-compressed struct DELTA_HEADER (edge id length, epoch, sequence,
+              number of users), UTF-8 edge id, little-endian array("Q") of
+              [outgoing, incoming] pairs, UTF-8 usernames joined with newlines
+      ACK   - struct ACK_BODY (sequence), everything up to sequence is applied
+      LINES - struct LINES_HEADER (source id length, epoch, sequence), UTF-8 source id
+              and the next block of connection's zlib stream: complete log lines
+              joined with newlines. Every block is sync-flushed, so it decompresses
+              on arrival, while the dictionary is kept over the whole connection.
+    """
+
+    MAGIC = b"DTM1"
+    HEADER = struct.Struct("<BI")
+
+    DELTA = 1
+    ACK = 2
+    LINES = 3
+
+    DELTA_HEADER = struct.Struct("<HQQI")
+    ACK_BODY = struct.Struct("<Q")
+    LINES_HEADER = struct.Struct("<HQQ")
+
+    # Larger frames are a protocol error, in bytes
+    MAX_PAYLOAD = 64 * 1024 * 1024
+
+    @classmethod
+    def frame(cls, kind, payload):
+        """Frame with header"""
+        return cls.HEADER.pack(kind, len(payload)) + payload
+
+    @classmethod
+    def pack_delta(cls, edge_id, epoch, sequence, usernames, values):
+        """DELTA frame of per-user deltas, values are flat array("Q") [out, in, out, in, ...]"""
+        if sys.byteorder == "big":
+            values = array("Q", values)
+            values.byteswap()
+        name = edge_id.encode("utf-8")
+        payload = cls.DELTA_HEADER.pack(len(name), epoch, sequence, len(usernames)) + name + \
+            values.tobytes() + "\n".join(usernames).encode("utf-8")
+        return cls.frame(cls.DELTA, zlib.compress(payload))
+
+    @classmethod
+    def unpack_delta(cls, payload):
+        """Parse DELTA payload, returns (edge_id, epoch, sequence, usernames, values).
+        Raises ValueError if payload is broken."""
+        try:
+            data = zlib.decompress(payload)
+            name_length, epoch, sequence, count = cls.DELTA_HEADER.unpack_from(data)
+        # pylint: disable=C0103
+        except (zlib.error, struct.error) as e:
+            raise ValueError("Broken delta frame: " + str(e))
+        # pylint: enable=C0103
+        offset = cls.DELTA_HEADER.size
+        edge_id = data[offset:offset + name_length].decode("utf-8")
+        offset += name_length
+        values = array("Q")
+        values.frombytes(data[offset:offset + count * 2 * values.itemsize])
+        if sys.byteorder == "big":
+            values.byteswap()
+        offset += count * 2 * values.itemsize
+        usernames = data[offset:].decode("utf-8").split("\n") if count else []
+        if len(values) != 2 * count or len(usernames) != count:
+            raise ValueError("Truncated delta frame")
+        return edge_id, epoch, sequence, usernames, values
+
+    @classmethod
+    def ack(cls, sequence):
+        """ACK frame"""
+        return cls.frame(cls.ACK, cls.ACK_BODY.pack(sequence))
+
+    @classmethod
+    def pack_lines(cls, compressor, source_id, epoch, sequence, data):
+        """LINES frame of complete lines (bytes, no trailing newline),
+        compressed with zlib compressobj of the connection"""
+        name = source_id.encode("utf-8")
+        block = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return cls.frame(cls.LINES, cls.LINES_HEADER.pack(len(name), epoch, sequence) +
+                         name + block)
+
+    @classmethod
+    def unpack_lines(cls, decompressor, payload):
+        """Parse LINES payload with zlib decompressobj of the connection, returns
+        (source_id, epoch, sequence, data). Raises ValueError if payload is broken."""
+        try:
+            name_length, epoch, sequence = cls.LINES_HEADER.unpack_from(payload)
+            offset = cls.LINES_HEADER.size + name_length
+            source_id = payload[cls.LINES_HEADER.size:offset].decode("utf-8")
+            data = decompressor.decompress(memoryview(payload)[offset:], cls.MAX_PAYLOAD)
+        # pylint: disable=C0103
+        except (zlib.error, struct.error, UnicodeDecodeError) as e:
+            raise ValueError("Broken lines frame: " + str(e))
+        # pylint: enable=C0103
+        if decompressor.unconsumed_tail:
+            raise ValueError("Lines frame too large")
+        return source_id, epoch, sequence, data
+
+
+class FrameReader:
+    """Splits a byte stream into (frame type, payload) frames"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes, return list of complete frames.
+        Raises ValueError on oversized frame."""
+        buf = self.buffer
+        buf += data
+        frames = []
+        offset = 0
+        header_size = FrameProtocol.HEADER.size
+        while len(buf) - offset >= header_size:
+            kind, length = FrameProtocol.HEADER.unpack_from(buf, offset)
+            if length > FrameProtocol.MAX_PAYLOAD:
+                raise ValueError("Frame too large: " + str(length) + " bytes")
+            end = offset + header_size + length
+            if end > len(buf):
+                break
+            frames.append((kind, bytes(buf[offset + header_size:end])))
+            offset = end
+        del buf[:offset]
+        return frames
+
+
+class FrameSender:
+    """
+    Replacement for "tail -F danted.log > /dev/tcp/HOST/PORT": reads log lines
+    from a pipe or file, batches them and sends them to trafmon as compressed
+    FrameProtocol.LINES frames. Compression runs over the whole connection, so
+    usernames and addresses repeated between batches cost almost nothing.
+    A batch is sent when it reaches BLOCK_SIZE, or FLUSH_INTERVAL after its first
+    line arrived. While trafmon is unreachable lines are kept, up to MAX_PENDING
+    bytes (older ones are dropped), and sent after reconnect. Like tail, sender
+    does not wait for acknowledgements: frames lost with a broken connection
+    show up as sequence gaps in trafmon metrics.
+    """
+
+    # Uncompressed bytes of lines per frame
+    BLOCK_SIZE = 65536
+    # Longest time a line waits for its batch to fill up, in seconds
+    FLUSH_INTERVAL = 0.5
+    # Pause between connection attempts, in seconds
+    RECONNECT_INTERVAL = 5
+    # How long to wait for trafmon to connect or take data, in seconds
+    TIMEOUT = 10
+    # Lines kept while trafmon is unreachable, in bytes
+    MAX_PENDING = 64 * 1024 * 1024
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, address, source_id=None, handler=None, level=COMPRESS_LEVEL):
+        # (host, port) of trafmon listener
+        self.address = address
+        self.source_id = source_id or socket.gethostname()
+        self.handler = handler if handler is not None else sys.stdin.buffer
+        self.level = level
+        # Sequences start over with every run, trafmon tells runs apart by epoch
+        self.epoch = time.time_ns()
+        self.sequence = 0
+        self.sock = None
+        self.compressor = None
+        # Complete lines not framed yet, every one ends with newline
+        self.pending = bytearray()
+        # (sequence, data) which failed to send, resent first after reconnect
+        self.inflight = None
+        self.retry_at = 0
+        self.thread_running = True
+
+        self.bytes_read = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.dropped_bytes = 0
+
+    def sigterm_handler(self, signl, frame):
+        """SIGTERM and SIGINT Handler, send what was read and exit"""
+        # pylint: disable=W0612,W0613
+        self.thread_running = False
+
+    def connect(self):
+        """Return open connection to trafmon, connecting if required"""
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=self.TIMEOUT)
+            self.sock.sendall(FrameProtocol.MAGIC)
+            self.compressor = zlib.compressobj(self.level)
+            print("INFO : " + str(datetime.datetime.now()) + " Connected to " +
+                  self.address[0] + ":" + str(self.address[1]) + " as " + self.source_id)
+        return self.sock
+
+    def close(self):
+        """Close connection to trafmon"""
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock.close()
+
+    def flush(self):
+        """Frame and send pending lines. Returns False if trafmon is unreachable,
+        lines are kept for the next attempt then."""
+        pending = self.pending
+        while self.inflight is not None or pending:
+            if self.inflight is None:
+                end = len(pending)
+                if end > self.BLOCK_SIZE:
+                    end = pending.rfind(b"\n", 0, self.BLOCK_SIZE) + 1 or \
+                        pending.find(b"\n") + 1
+                self.sequence += 1
+                self.inflight = (self.sequence, bytes(pending[:end - 1]))
+                del pending[:end]
+            sequence, data = self.inflight
+            try:
+                sock = self.connect()
+                frame = FrameProtocol.pack_lines(self.compressor, self.source_id,
+                                                 self.epoch, sequence, data)
+                sock.sendall(frame)
+            # pylint: disable=C0103
+            except OSError as e:
+                print("ERROR: " + str(datetime.datetime.now()) + " Unable to send to " +
+                      self.address[0] + ":" + str(self.address[1]) + ": " + str(e))
+                self.close()
+                self.retry_at = time.monotonic() + self.RECONNECT_INTERVAL
+                return False
+            # pylint: enable=C0103
+            self.inflight = None
+            self.frames_sent += 1
+            self.bytes_sent += len(frame)
+        return True
+
+    def trim(self):
+        """Drop the oldest lines beyond MAX_PENDING"""
+        excess = len(self.pending) - self.MAX_PENDING
+        if excess > 0:
+            end = self.pending.find(b"\n", excess) + 1 or len(self.pending)
+            del self.pending[:end]
+            self.dropped_bytes += end
+            print("ERROR: " + str(datetime.datetime.now()) + " Dropped " + str(end) +
+                  " bytes of log lines, " + self.address[0] + " is unreachable")
 
     def run(self):
-        """Timer threar "run" function"""
+        """Send lines until end of input or signal"""
+        fd = self.handler.fileno()
+        # Select works for regular files as well, they are always readable
+        selector = selectors.SelectSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        partial = bytearray()
+        deadline = None
+        eof = False
+        while self.thread_running and not eof:
+            timeout = self.FLUSH_INTERVAL if deadline is None else \
+                min(self.FLUSH_INTERVAL, max(0, deadline - time.monotonic()))
+            if selector.select(timeout):
+                chunk = os.read(fd, self.BLOCK_SIZE)
+                eof = not chunk
+                self.bytes_read += len(chunk)
+                end = chunk.rfind(b"\n") + 1
+                if end:
+                    self.pending += partial
+                    self.pending += chunk[:end]
+                    partial[:] = chunk[end:]
+                elif chunk:
+                    partial += chunk
+                if len(partial) > self.MAX_PENDING:
+                    # Not log lines, receiver would drop it as oversized anyway
+                    partial.clear()
+                if eof and partial:
+                    self.pending += partial + b"\n"
+            if not self.pending and self.inflight is None:
+                continue
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + self.FLUSH_INTERVAL
+            if (len(self.pending) >= self.BLOCK_SIZE or now >= deadline) and \
+                    now >= self.retry_at:
+                deadline = None if self.flush() else self.retry_at
+            self.trim()
+        selector.close()
+        # Input is over, everything read is delivered unless trafmon stays unreachable
+        while (self.pending or self.inflight is not None) and not self.flush():
+            while self.thread_running and time.monotonic() < self.retry_at:
+                time.sleep(0.1)
+            if not self.thread_running:
+                break
+        self.close()
+        print("INFO : " + str(datetime.datetime.now()) + " Sender stopped: " +
+              str(self.bytes_read) + " bytes read, " + str(self.bytes_sent) + " sent in " +
+              str(self.frames_sent) + " frames, " + str(self.dropped_bytes) + " dropped")
+        return 0 if not self.pending and self.inflight is None else 1
 
-        if self.log_thread is None:
-            return
 
-        # Getting initial data from database
-        result, result_msg = self.data_init_from_db()
-        if result != 0:
-            print("ERROR: " + str(datetime.datetime.now()) +
-                  " Database is not available, terminating now.")
-            self.log_thread.stop()
-            return
+class SourceConnection:
+    """
+    One connected log feed, usually "tail -f danted.log" of one dante server,
+    or an edge trafmon node or a FrameSender speaking FrameProtocol.
+    Keeps per-connection state between reads.
+    """
 
-        while self.log_thread.thread_running:
-            self.app.lock.acquire()
+    def __init__(self, conn, addr, buffer_size=262144, max_line_length=16384):
+        self.conn = conn
+        self.addr = addr
+        self.framer = LineFramer(buffer_size, max_line_length)
+        self.bytes_received = 0
+        self.lines_received = 0
+        # FrameReader once connection started with FrameProtocol.MAGIC
+        self.reader = None
+        # zlib stream of LINES frames, one per connection
+        self.decompressor = None
+        # Received frames, taken by listener after every read
+        self.frames = []
+        # Protocol is not known until enough bytes to tell MAGIC apart arrive
+        self.undecided = True
 
-            # Write to file
-            # ERROR: No write rights under non-root user in Vagrant.
-            #        Suspending for now
-            #self.log_thread.write_to_file(self.app.OUTFILE,
-            #                              self.log_thread.traffic_dict)
+    def receive(self):
+        """Read available data from connection.
+        Returns list of received lines, or None if peer closed the connection.
+        Frames of FrameProtocol connection are collected in frames."""
+        if self.reader is not None:
+            data = self.conn.recv(len(self.framer.buffer))
+            if not data:
+                return None
+            self.bytes_received += len(data)
+            self.frames.extend(self.reader.feed(data))
+            return []
+        nbytes = self.framer.recv_into(self.conn)
+        if not nbytes:
+            return None
+        self.bytes_received += nbytes
+        if self.undecided:
+            magic = FrameProtocol.MAGIC
+            received = self.framer.filled + nbytes
+            if magic.startswith(bytes(self.framer.view[:min(received, len(magic))])):
+                if received < len(magic):
+                    # Magic may come in pieces, keep its start in the buffer
+                    self.framer.filled = received
+                    return []
+                self.undecided = False
+                self.reader = FrameReader()
+                self.decompressor = zlib.decompressobj()
+                self.frames.extend(self.reader.feed(self.framer.view[len(magic):received]))
+                self.framer.filled = 0
+                return []
+            # Plain feed, lines start with bytes kept so far
+            self.undecided = False
+            nbytes = received
+            self.framer.filled = 0
+        lines = self.framer.feed(nbytes)
+        self.lines_received += len(lines)
+        return lines
 
-            # Write to PGSQL
-            result, result_msg = self.log_thread.write_to_pgsql(self.log_thread.traffic_dict)
+    def finish(self):
+        """Return what is left in the framing buffer after peer closed the connection"""
+        lines = self.framer.flush()
+        self.lines_received += len(lines)
+        return lines
 
-            self.app.lock.release()
 
-            if result == 0:
-                print("INFO : "+str(datetime.datetime.now())+" Data write to database (OK)")
-            else:
-                print("INFO : " + str(datetime.datetime.now()) + " Data write to database (FAIL)")
+class IngestQueue:
+    """
+    Bounded queue of received line batches, between receive and parse stages.
 
-            time.sleep(self.app.write_period)
+    When queue is full, policy decides:
+      block       - receiver waits for parsers, so dante servers' TCP buffers fill up
+      drop_oldest - the oldest batch is dropped, its lines are accounted as dropped
+      spill       - batch is appended to a spill file on disk, spill files are parsed
+                    when memory queue drains, and replayed on start after a crash
+
+    Spill file entry: struct SPILL_ENTRY (source length, payload length), UTF-8 source,
+    UTF-8 lines joined with newlines. Disk errors of spill files switch policy to
+    drop_oldest, so receiver never stops on them.
+    """
+
+    POLICIES = ("block", "drop_oldest", "spill")
+
+    SPILL_ENTRY = struct.Struct("<HI")
+    # Spill file is sealed and handed to parsers once it is that large, in bytes
+    SPILL_SEGMENT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, max_batches=1024, policy="block", spill_directory=None, metrics=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown ingest queue policy: " + str(policy))
+        self.max_batches = max_batches
+        self.policy = policy
+        self.spill_directory = spill_directory
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        # (source, lines)
+        self.batches = deque()
+        self.closed = False
+
+        self.dropped_batches = 0
+        self.dropped_lines = 0
+        self.spilled_batches = 0
+        self.error_log = RateLimitedLog()
+
+        self.spill_handler = None
+        self.spill_sequence = 0
+        # Sealed spill files, oldest first
+        self.spill_sealed = []
+        if policy == "spill":
+            try:
+                os.makedirs(spill_directory, exist_ok=True)
+                self.spill_sealed = sorted(
+                    os.path.join(spill_directory, name) for name in os.listdir(spill_directory)
+                    if name.startswith("ingest.") and name.endswith(".spill"))
+            # pylint: disable=C0103
+            except OSError as e:
+                self.fail("spill directory is not usable", e)
+            # pylint: enable=C0103
+            if self.spill_sealed:
+                self.spill_sequence = int(self.spill_sealed[-1].split(".")[-2]) + 1
+
+    def depth(self):
+        """Batches waiting in memory"""
+        return len(self.batches)
+
+    def put(self, source, lines):
+        """Queue batch of lines received from source"""
+        with self.condition:
+            if len(self.batches) >= self.max_batches:
+                if self.policy == "spill" and self.spill(source, lines):
+                    return
+                if self.policy == "block":
+                    while len(self.batches) >= self.max_batches and not self.closed:
+                        self.condition.wait()
+                elif self.policy == "drop_oldest":
+                    _, dropped = self.batches.popleft()
+                    self.dropped_batches += 1
+                    self.dropped_lines += len(dropped)
+                    if self.metrics is not None:
+                        self.metrics.inc("ingest_dropped_batches_total")
+                        self.metrics.inc("ingest_dropped_lines_total", len(dropped))
+            self.batches.append((source, lines))
+            self.condition.notify_all()
+
+    def fail(self, message, error):
+        """Log spill disk error and switch to drop_oldest policy, condition must be held"""
+        self.policy = "drop_oldest"
+        self.error_log.write("ERROR: " + str(datetime.datetime.now()) + " Ingest " + message +
+                             ", dropping the oldest batches instead of spilling: " + str(error))
+        self.seal_spill()
+
+    def spill(self, source, lines):
+        """Append batch to current spill file, condition must be held.
+        Returns False if batch could not be written."""
+        name = source.encode("utf-8")
+        payload = "\n".join(lines).encode("utf-8")
+        try:
+            if self.spill_handler is None:
+                self.spill_handler = open(os.path.join(
+                    self.spill_directory, "ingest.%012d.spill" % self.spill_sequence), "ab")
+                self.spill_sequence += 1
+            self.spill_handler.write(self.SPILL_ENTRY.pack(len(name), len(payload)) +
+                                     name + payload)
+            # Buffered entry is not on disk yet, its write error would show up later
+            self.spill_handler.flush()
+        # pylint: disable=C0103
+        except OSError as e:
+            self.fail("spill file write failed", e)
+            return False
+        # pylint: enable=C0103
+        self.spilled_batches += 1
+        if self.metrics is not None:
+            self.metrics.inc("ingest_spilled_batches_total")
+        if self.spill_handler.tell() >= self.SPILL_SEGMENT_SIZE:
+            self.seal_spill()
+        self.condition.notify_all()
+        return True
+
+    def seal_spill(self):
+        """Close current spill file and hand it to parsers, condition must be held"""
+        if self.spill_handler is not None:
+            handler, self.spill_handler = self.spill_handler, None
+            try:
+                handler.close()
+            except OSError:
+                # Entries written before stay readable, a partial one ends the file
+                pass
+            self.spill_sealed.append(handler.name)
+
+    @classmethod
+    def read_spill(cls, path):
+        """Read spill file, returns list of (source, lines)"""
+        with open(path, "rb") as handler:
+            data = handler.read()
+        batches = []
+        offset = 0
+        entry_size = cls.SPILL_ENTRY.size
+        while offset + entry_size <= len(data):
+            name_length, payload_length = cls.SPILL_ENTRY.unpack_from(data, offset)
+            offset += entry_size
+            end = offset + name_length + payload_length
+            if end > len(data):
+                break
+            source = data[offset:offset + name_length].decode("utf-8")
+            payload = data[offset + name_length:end].decode("utf-8")
+            batches.append((source, payload.split("\n") if payload else []))
+            offset = end
+        return batches
+
+    def get(self, max_batches=16, timeout=1):
+        """Take up to max_batches batches, waiting up to timeout for the first one.
+        Memory queue goes first, then spill files. Returns list of (source, lines),
+        empty list on timeout, None if queue is closed and drained."""
+        with self.condition:
+            if not self.batches and not self.spill_sealed and self.spill_handler is None:
+                if self.closed:
+                    return None
+                self.condition.wait(timeout)
+            if self.batches:
+                count = min(max_batches, len(self.batches))
+                result = [self.batches.popleft() for _ in range(count)]
+                self.condition.notify_all()
+                return result
+            if not self.spill_sealed:
+                self.seal_spill()
+            if not self.spill_sealed:
+                return None if self.closed else []
+            path = self.spill_sealed.pop(0)
+        # Spill file is read outside of the lock, receiver keeps going meanwhile
+        try:
+            batches = self.read_spill(path)
+        # pylint: disable=C0103
+        except OSError as e:
+            self.error_log.write("ERROR: " + str(datetime.datetime.now()) +
+                                 " Unable to read ingest spill file, it is left for the " +
+                                 "next start: " + str(e))
+            return []
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self.error_log.write("ERROR: " + str(datetime.datetime.now()) +
+                                 " Unable to remove ingest spill file, it is parsed again " +
+                                 "on the next start: " + str(e))
+        # pylint: enable=C0103
+        return batches
+
+    def close(self):
+        """No more batches, parsers exit once everything is drained"""
+        with self.condition:
+            self.closed = True
+            self.seal_spill()
+            self.condition.notify_all()
+
+
+class ParserThread(threading.Thread):
+    """Parse stage: drains IngestQueue in batches and updates counters"""
+
+    # Batches taken from queue at once
+    DRAIN_BATCHES = 16
+
+    def __init__(self, log_thread, ingest_queue, index):
+        super(ParserThread, self).__init__(name=log_thread.name + "-PARSER-" + str(index),
+                                           daemon=True)
+        self.log_thread = log_thread
+        self.ingest_queue = ingest_queue
+
+    def run(self):
+        """Parser thread "run" function"""
+        while True:
+            batches = self.ingest_queue.get(self.DRAIN_BATCHES)
+            if batches is None:
+                break
+            for source, lines in batches:
+                self.log_thread.parse_lines(lines, source)
 
 
 class LogThread(threading.Thread):
     """
-    One thread for one data source, currently only one data source exists anyway -
-    data redirected from danted.log to socket.
+    Listener thread, serves every connected log feed (one per dante server)
+    with a single selector loop.
     """
     LOG_TYPE_NONE = 0
     LOG_TYPE_DANTE = 1
@@ -400,14 +4986,62 @@ class LogThread(threading.Thread):
 
     log_type = LOG_TYPE_NONE
 
-    # Dictionary to keep traffic
-    traffic_dict = defaultdict(lambda: [0, 0])
+    # How long selector waits for events before checking thread_running
+    SELECT_TIMEOUT = 1
 
-    def __init__(self, name, log_type, application):
+    def __init__(self, name, log_type, application, timer_enabled=True):
         super(LogThread, self).__init__()
         self.name = name
         self.log_type = log_type
         self.app = application
+        # Ingest workers have no timer, aggregator writes to database instead
+        self.timer_enabled = timer_enabled
+        self.parser = IoopParser(timestamps=application.rates_enabled)
+        self.selector = None
+        self.connections = set()
+        # Framing counters of already closed connections
+        self.malformed_lines = 0
+        self.oversized_lines = 0
+        self.line_log = RateLimitedLog(application.log_rate)
+        # Receive and parse stages are split by ingest queue if parser threads are configured
+        self.ingest_queue = None
+        self.parsers = []
+        # edge_id -> (epoch, sequence) of the last applied delta frame, stored with
+        # totals (and journaled with deltas), restored by timer once database is loaded
+        self.edge_sequences = {}
+        self.edges_loaded = False
+        # (source, sequence) of delta frames applied to counters, acknowledged by
+        # timer once they are stored. Lock keeps applying and listing atomic for swap.
+        self.frame_lock = threading.Lock()
+        self.unacked = []
+        # source_id -> (epoch, sequence) of the last applied lines frame
+        self.source_sequences = {}
+
+    def start_parsers(self):
+        """Create ingest queue and parser threads, if configured"""
+        if self.app.ingest_parser_threads <= 0:
+            return
+        self.ingest_queue = IngestQueue(self.app.ingest_queue_batches, self.app.ingest_policy,
+                                        self.app.ingest_spill_directory, self.app.metrics)
+        self.parsers = [ParserThread(self, self.ingest_queue, index)
+                        for index in range(self.app.ingest_parser_threads)]
+        for parser in self.parsers:
+            parser.start()
+
+    def stop_parsers(self):
+        """Let parsers drain ingest queue, then wait for them"""
+        if self.ingest_queue is None:
+            return
+        self.ingest_queue.close()
+        for parser in self.parsers:
+            parser.join()
+
+    def dispatch(self, lines, source):
+        """Hand received lines to parse stage"""
+        if self.ingest_queue is not None:
+            self.ingest_queue.put(source, lines)
+        else:
+            self.parse_lines(lines, source)
 
     def run(self):
         """
@@ -416,12 +5050,12 @@ class LogThread(threading.Thread):
         print("INFO : " + str(datetime.datetime.now()) +
               " Thread " + self.name + " started. Port: " + str(self.app.listen_port))
 
-        self.timer = TimerThread(log_thread=self, application=self.app)
-        self.timer.start()
-
+        # Socket is bound first, dante servers are accepted while timer loads totals
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
+        if self.app.workers > 1:
+            # Kernel spreads incoming connections over all worker processes
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         try:
             sock.bind((self.app.listen_address,
@@ -430,111 +5064,705 @@ class LogThread(threading.Thread):
             print("INFO : " + str(datetime.datetime.now()) +
                   " Socket bind " + self.app.listen_address +
                   ":" + str(self.app.listen_port) + " failed!")
+            self.thread_running = False
             sys.exit(1)
 
-        sock.listen(5)
+        sock.listen(self.app.listen_backlog)
+        sock.setblocking(False)
 
-        while self.thread_running:
-            try:
-                conn, addr = sock.accept()
-            except socket.timeout:
-                continue
+        if self.timer_enabled:
+            self.timer = TimerThread(log_thread=self, application=self.app)
+            self.timer.start()
 
-            print("INFO : " + str(datetime.datetime.now()) +
-                  " Connection established: "+str(addr))
-            while self.thread_running:
-                conn.settimeout(5)
+        # One selector serves the listening socket and every connected feed,
+        # so a slow or idle dante server never blocks the others.
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ, None)
 
-                # Receiving data
-                try:
-                    data = conn.recvfrom(4096)
-                except socket.timeout:
-                    continue
+        self.start_parsers()
 
-                # If data received, parse it
-                if data != (b'', None):
-                    string = data[0].decode("utf-8")
-                    lines = string.splitlines()
-                    # Parsing log string
-                    self.app.lock.acquire()
-                    for line in lines:
-                        print("L:", line)
-                        # Outgoing traffic
-                        regex = r'.*username\%(.*)@.*->.*\((.*)\)'
-                        res = re.match(regex, line)
-                        if res:
-                            if self.app.verbose >= 3: print('  OUT:', res.groups())
-                            self.traffic_dict[res.groups()[0]][0] += int(res.groups()[1])
-                        else:
-                            # Incoming Traffic
-                            regex = r'.*->.*username\%(.*)@.*\((.*)\)'
-                            res = re.match(regex, line)
-                            if res:
-                                if self.app.verbose >= 3: print('  IN :', res.groups())
-                                self.traffic_dict[res.groups()[0]][1] += int(res.groups()[1])
-                        print("-----")
-                        print("")
-                    self.app.lock.release()
+        # Log files are followed by the process which owns the timer, not by ingest workers
+        followers = self.app.start_followers() if self.timer_enabled else []
+        if self.timer_enabled:
+            self.app.metrics.add_collector(self.collect_metrics)
 
+        while self.thread_running:
+            for key, _ in self.selector.select(timeout=self.SELECT_TIMEOUT):
+                if key.data is None:
+                    self.accept_connection(key.fileobj)
                 else:
-                    break
+                    self.service_connection(key.data)
 
-            conn.shutdown(socket.SHUT_RDWR)
-        sock.shutdown(socket.SHUT_RDWR)
+        self.app.stop_followers(followers)
+        self.app.metrics.remove_collector(self.collect_metrics)
+        for source in list(self.connections):
+            self.close_connection(source)
+        self.selector.unregister(sock)
+        self.selector.close()
+        sock.close()
+        self.stop_parsers()
 
         print("INFO : " + str(datetime.datetime.now()) +
               " Thread "+self.name+" terminated.")
 
-    def stop(self):
-        """ Set the thread to stop"""
-        self.thread_running = False
+    def accept_connection(self, sock):
+        """Accept a new log feed and register it with the selector"""
+        try:
+            conn, addr = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
 
-    @staticmethod
-    def write_to_file(filename, out_dict):
-        """Write current collected data of users traffic consumption to file"""
-        file_handler = open(filename, mode="w+")
-        for key, value in out_dict.items():
-            file_handler.write(key+','+str(value[0])+','+str(value[1])+'\n')
-        file_handler.close()
-
-    def write_to_pgsql(self, out_dict):
-        """Write current collected data of users traffic consumption to PostgreSQL database"""
-        result = 0
-        result_msg = ""
+        print("INFO : " + str(datetime.datetime.now()) +
+              " Connection established: "+str(addr))
+        conn.setblocking(False)
+        source = SourceConnection(conn, addr,
+                                  self.app.recv_buffer_size,
+                                  self.app.max_line_length)
+        self.connections.add(source)
+        self.selector.register(conn, selectors.EVENT_READ, source)
+
+    def close_connection(self, source):
+        """Unregister and close log feed connection"""
+        self.selector.unregister(source.conn)
+        self.connections.discard(source)
+        try:
+            source.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        source.conn.close()
+        self.malformed_lines += source.framer.malformed_lines
+        self.oversized_lines += source.framer.oversized_lines
+        print("INFO : " + str(datetime.datetime.now()) +
+              " Connection closed: " + str(source.addr) +
+              " (" + str(source.lines_received) + " lines, " +
+              str(source.framer.malformed_lines) + " malformed, " +
+              str(source.framer.oversized_lines) + " oversized)")
+
+    def framing_counters(self):
+        """Malformed and oversized lines over all connections, closed and open"""
+        malformed = self.malformed_lines
+        oversized = self.oversized_lines
+        for source in list(self.connections):
+            malformed += source.framer.malformed_lines
+            oversized += source.framer.oversized_lines
+        return malformed, oversized
+
+    def collect_metrics(self):
+        """Set connection gauges before metrics are rendered"""
+        malformed, oversized = self.framing_counters()
+        self.app.metrics.set("connections", len(self.connections))
+        self.app.metrics.set("malformed_lines_total", malformed)
+        self.app.metrics.set("oversized_lines_total", oversized)
+        if self.ingest_queue is not None:
+            self.app.metrics.set("ingest_queue_depth", self.ingest_queue.depth())
+
+    def service_connection(self, source):
+        """Read available data from one log feed and parse it"""
+        received = source.bytes_received
         try:
-            conn = psycopg2.connect(host=self.app.db_hostname,
-                                    database=self.app.db_name,
-                                    user=self.app.db_username,
-                                    password=self.app.db_password,
-                                    connect_timeout=5)
+            lines = source.receive()
+        except (BlockingIOError, InterruptedError):
+            return
         # pylint: disable=C0103
-        except psycopg2.OperationalError as e:
+        except ValueError as e:
             print("ERROR: " + str(datetime.datetime.now()) +
-                  " Unable to connect to database (main cycle)")
-            print("ERROR: " + str(datetime.datetime.now()) + " " + str(e))
-            result = 1
-            result_msg = str(e)
+                  " Protocol error from " + str(source.addr) + ": " + str(e))
+            lines = None
+        # pylint: enable=C0103
+        except OSError:
+            lines = None
+        if source.bytes_received != received:
+            self.app.metrics.inc("received_bytes_total", source.bytes_received - received,
+                                 (("source", source.addr[0]),))
+        if source.frames:
+            frames, source.frames = source.frames, []
+            try:
+                for kind, payload in frames:
+                    self.apply_frame(source, kind, payload)
+            # pylint: disable=C0103
+            except ValueError as e:
+                print("ERROR: " + str(datetime.datetime.now()) +
+                      " Protocol error from " + str(source.addr) + ": " + str(e))
+                lines = None
+            # pylint: enable=C0103
+
+        if lines is None:
+            self.dispatch(source.finish(), source.addr[0])
+            self.close_connection(source)
+        elif lines:
+            self.dispatch(lines, source.addr[0])
+
+    def apply_frame(self, source, kind, payload):
+        """Apply frame received from edge node or frame sender. Every sequence of
+        an edge run is applied once, resent frames are only acknowledged again.
+        Delta frames are acknowledged by timer thread, once they are stored.
+        Raises ValueError on broken lines frame, the rest of the connection's
+        stream can not be decompressed, and on delta frame in ingest worker."""
+        if kind == FrameProtocol.LINES:
+            self.apply_lines(source, payload)
+            return
+        if kind != FrameProtocol.DELTA:
+            return
+        if not self.timer_enabled:
+            # Sequences of one edge would be spread over workers, each with its own
+            # dedupe state, and workers do not know when deltas are stored
+            raise ValueError("Edge deltas are not accepted with more than one worker")
+        try:
+            edge_id, epoch, sequence, usernames, values = FrameProtocol.unpack_delta(payload)
+        # pylint: disable=C0103
+        except ValueError as e:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Protocol error from " + str(source.addr) + ": " + str(e))
+            return
         # pylint: enable=C0103
+        with self.frame_lock:
+            if not self.edges_loaded:
+                # Stored sequences are not known yet, a resent frame would be applied again
+                raise ValueError("Edge deltas are not accepted until database is loaded")
+            last_epoch, last_sequence = self.edge_sequences.get(edge_id, (None, 0))
+            if epoch == last_epoch and sequence <= last_sequence:
+                self.app.metrics.inc("edge_deltas_total", 1, (("result", "duplicate"),))
+            else:
+                self.app.counters.add_delta(usernames, values, (edge_id, epoch, sequence))
+                self.edge_sequences[edge_id] = (epoch, sequence)
+                self.app.metrics.inc("edge_deltas_total", 1, (("result", "applied"),))
+            # Duplicate is acknowledged with the next write as well, its first copy
+            # may still be waiting for it
+            self.unacked.append((source, sequence))
+
+    def restore_edge_sequences(self, rows):
+        """Set sequences of edge runs, stored with their deltas, from iterable of
+        (edge_id, epoch, sequence). Delta frames are accepted from now on."""
+        with self.frame_lock:
+            for edge_id, epoch, sequence in rows:
+                # Later run has later epoch, deltas applied meanwhile are newer still
+                self.edge_sequences[edge_id] = max(self.edge_sequences.get(edge_id, (0, 0)),
+                                                   (epoch, sequence))
+            self.edges_loaded = True
+
+    @staticmethod
+    def acknowledge(frames):
+        """Acknowledge stored delta frames, list of (source, sequence)"""
+        for source, sequence in frames:
+            try:
+                source.conn.send(FrameProtocol.ack(sequence))
+            except OSError:
+                # Edge resends the frame, it is acknowledged then
+                pass
+
+    def apply_lines(self, source, payload):
+        """Hand lines of sender's frame to parse stage. Frames are decompressed
+        in order even if already applied, they continue the connection's stream."""
+        source_id, epoch, sequence, data = FrameProtocol.unpack_lines(source.decompressor,
+                                                                      payload)
+        source_id = source_id or source.addr[0]
+        last_epoch, last_sequence = self.source_sequences.get(source_id, (None, 0))
+        if epoch == last_epoch and sequence <= last_sequence:
+            # Resent after reconnect, previous connection delivered it
+            self.app.metrics.inc("line_frames_total", 1, (("result", "duplicate"),))
+            return
+        if epoch == last_epoch and sequence > last_sequence + 1:
+            self.app.metrics.inc("line_frames_total", sequence - last_sequence - 1,
+                                 (("result", "lost"),))
+        self.source_sequences[source_id] = (epoch, sequence)
+        self.app.metrics.inc("line_frames_total", 1, (("result", "applied"),))
+        self.app.metrics.inc("decompressed_bytes_total", len(data), (("source", source_id),))
+        lines = source.framer.decode(data)
+        source.lines_received += len(lines)
+        if lines:
+            self.dispatch(lines, source_id)
+
+    def parse_lines(self, lines, source="local"):
+        """Parse dante log lines and update traffic counters.
+        source is dante server which sent them, for dimensions"""
+        parse = self.parser.parse
+        if self.app.verbose >= 3:
+            records = []
+            for line in lines:
+                record = parse(line)
+                if record is not None:
+                    records.append(record)
+                self.line_log.write("L:", line, "->", record)
         else:
-            cur = conn.cursor()
-
-            # "UPSERT" operation using ON CONFLICT
-            # pylint: disable=C0301
-            for key, value in out_dict.items():
-                if self.app.verbose >= 2: print("  ", key, ':', value[1], '  ', value[0])
-                cur.execute("INSERT INTO traffic(username, outgoing, incoming)"
-                            "VALUES ('" + str(key) + "'," + str(value[0]) + "," + str(value[1]) + ")"
-                            "ON CONFLICT(username) DO UPDATE "
-                            "SET outgoing=" + str(value[0]) +
-                            ",incoming=" + str(value[1]) + "")
-            # pylint: enable=C0301
+            records = [record for record in map(parse, lines) if record is not None]
+        self.app.metrics.count_lines(source, len(lines), records)
+        self.app.counters.add_records(records)
+        if self.app.dimensions is not None and records:
+            self.app.dimensions.add_records(records, source)
+        if self.app.rates is not None and records:
+            self.app.rates.add_records(records)
 
-            conn.commit()
-            cur.close()
-            conn.close()
+    def stop(self):
+        """ Set the thread to stop"""
+        self.thread_running = False
+
+class LogFollower(threading.Thread):
+    """
+    Reads dante log file directly, in large blocks. Follows file rotation (new inode)
+    and truncation, and keeps offset checkpoint, so restart resumes where it stopped.
+    Checkpoint is saved by timer thread, only once parsed lines are stored in
+    database (or journaled with spool), so a crash never skips unstored traffic.
+    Without checkpoint, file found at start is read from its end: what was
+    written before is already counted by the previous feed or not wanted.
+    """
+
+    # How long to wait for new data at the end of file, in seconds
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, application, path):
+        super(LogFollower, self).__init__(name="FOLLOW " + path)
+        self.app = application
+        self.path = path
+        self.running = True
+        self.parser = IoopParser(timestamps=application.rates_enabled)
+        self.framer = LineFramer(application.recv_buffer_size, application.max_line_length)
+        self.handler = None
+        self.lines_read = 0
+        self.open_failed = False
+        # Checkpoint is consulted until the first file is opened, later files
+        # are new ones after rotation. Only a file present at the very start
+        # is skipped to its end.
+        self.resuming = True
+        self.first_open = True
+        # Checkpoint state of lines added to counters so far. Lock makes adding
+        # lines and moving position atomic for timer thread, which swaps counters.
+        self.lock = threading.Lock()
+        self.position = None
+
+        safe_name = path.strip("/").replace("/", "_")
+        self.state_path = os.path.join(application.state_directory,
+                                       "follow." + safe_name + ".json")
+
+    def stop(self):
+        """ Set the thread to stop"""
+        self.running = False
+
+    def run(self):
+        """
+        Run separate thread
+        """
+        print("INFO : " + str(datetime.datetime.now()) + " Following " + self.path)
+        while self.running:
+            if self.handler is None and not self.open_file():
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            if self.read_block():
+                continue
+            # End of file
+            if not self.check_rotation():
+                time.sleep(self.POLL_INTERVAL)
+
+        if self.handler is not None:
+            self.handler.close()
+        print("INFO : " + str(datetime.datetime.now()) + " Stopped following " +
+              self.path + " (" + str(self.lines_read) + " lines)")
+
+    def open_file(self):
+        """Open followed file, resuming from checkpoint if it's still the same file"""
+        first_open, self.first_open = self.first_open, False
+        try:
+            handler = open(self.path, "rb", buffering=0)
+        except OSError as err:
+            if not self.open_failed:
+                print("ERROR: " + str(datetime.datetime.now()) + " " + str(err))
+                self.open_failed = True
+            return False
+        self.open_failed = False
+        stat = os.fstat(handler.fileno())
+
+        state = self.load_checkpoint() if self.resuming else None
+        if state is not None and (state["dev"], state["inode"]) != (stat.st_dev, stat.st_ino):
+            # File was rotated while trafmon was down, finish the old one first
+            rotated = self.path + ".1"
+            try:
+                old = open(rotated, "rb", buffering=0)
+            except OSError:
+                old = None
+            if old is not None:
+                old_stat = os.fstat(old.fileno())
+                if (state["dev"], state["inode"]) == (old_stat.st_dev, old_stat.st_ino):
+                    handler.close()
+                    handler, stat = old, old_stat
+                else:
+                    old.close()
+
+        if (state is not None and (state["dev"], state["inode"]) == (stat.st_dev, stat.st_ino)
+                and state["offset"] <= stat.st_size):
+            handler.seek(state["offset"])
+            print("INFO : " + str(datetime.datetime.now()) + " Resuming " + handler.name +
+                  " at offset " + str(state["offset"]))
+        elif state is None and first_open:
+            handler.seek(0, os.SEEK_END)
+            print("INFO : " + str(datetime.datetime.now()) + " No checkpoint, reading " +
+                  handler.name + " from its end")
+        with self.lock:
+            self.handler = handler
+            self.position = self.current_position()
+        if state is None and self.resuming:
+            # Nothing is parsed yet, crash before the first write resumes here
+            self.checkpoint(self.position)
+        self.resuming = False
+        return True
+
+    def read_block(self):
+        """Read and parse next block of the file, returns number of bytes read"""
+        nbytes = self.framer.read_into(self.handler)
+        if nbytes:
+            self.app.metrics.inc("received_bytes_total", nbytes, (("source", "local"),))
+            self.parse_lines(self.framer.feed(nbytes))
+        return nbytes
+
+    def parse_lines(self, lines):
+        """Parse complete lines and add them to counters, moving position past them"""
+        parse = self.parser.parse
+        records = [record for record in map(parse, lines) if record is not None]
+        self.app.metrics.count_lines("local", len(lines), records)
+        with self.lock:
+            self.app.counters.add_records(records)
+            self.position = self.current_position()
+        if self.app.dimensions is not None and records:
+            self.app.dimensions.add_records(records, "local")
+        if self.app.rates is not None and records:
+            self.app.rates.add_records(records)
+        self.lines_read += len(lines)
+
+    def check_rotation(self):
+        """At the end of file: switch to the new file if log was rotated,
+        start over if it was truncated. Returns True if file position changed."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        current = os.fstat(self.handler.fileno())
+        if (stat.st_dev, stat.st_ino) != (current.st_dev, current.st_ino):
+            # Whatever was written to the old file right before rotation
+            while self.read_block():
+                pass
+            self.parse_lines(self.framer.flush())
+            # Checkpoint keeps pointing to the old file until the new one is stored,
+            # restart finds the old one rotated and finishes it first
+            self.handler.close()
+            self.handler = None
+            print("INFO : " + str(datetime.datetime.now()) + " " + self.path + " rotated")
+            return self.open_file()
+        if current.st_size < self.handler.tell():
+            with self.lock:
+                self.handler.seek(0)
+                self.framer.flush()
+                self.position = self.current_position()
+            print("INFO : " + str(datetime.datetime.now()) + " " + self.path + " truncated")
+            return True
+        return False
+
+    def current_position(self):
+        """Checkpoint state of the first byte not yet parsed"""
+        stat = os.fstat(self.handler.fileno())
+        return {"path": self.path, "dev": stat.st_dev, "inode": stat.st_ino,
+                "offset": self.handler.tell() - self.framer.filled}
+
+    def load_checkpoint(self):
+        """Saved state, or None"""
+        try:
+            with open(self.state_path) as handler:
+                state = json.load(handler)
+        except (OSError, ValueError):
+            return None
+        if state.get("path") != self.path:
+            return None
+        return state
+
+    def checkpoint(self, state):
+        """Atomically save file identity and offset, state is a position
+        whose lines are stored"""
+        tmp_path = self.state_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(tmp_path, "w") as handler:
+                json.dump(state, handler)
+            os.replace(tmp_path, self.state_path)
+        except OSError as err:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Unable to save offset checkpoint: " + str(err))
+
+
+class Backfill:
+    """
+    Rebuilds traffic totals from archived dante logs. Files are split into chunks
+    (compressed files can't be split, one chunk per file), chunks are parsed by
+    a process pool with the same IoopParser as live ingest, per-user totals are
+    merged and written to database with one bulk load.
+    """
+
+    # Plain log files are split into chunks of that size, in bytes
+    CHUNK_SIZE = 32 * 1024 * 1024
+
+    OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+    def __init__(self, application, files, processes=None):
+        self.app = application
+        self.files = files
+        self.processes = processes or os.cpu_count() or 1
+
+        self.lines = 0
+        self.totals = defaultdict(lambda: [0, 0])
+
+    def tasks(self):
+        """List of (path, start, end) chunks, end is None for the whole file"""
+        result = []
+        for path in self.files:
+            if os.path.splitext(path)[1] in self.OPENERS:
+                result.append((path, 0, None))
+                continue
+            size = os.path.getsize(path)
+            for start in range(0, max(size, 1), self.CHUNK_SIZE):
+                result.append((path, start, min(start + self.CHUNK_SIZE, size)))
+        return result
+
+    @classmethod
+    def parse_chunk(cls, task):
+        """Parse one chunk, returns (lines, {username: [outgoing, incoming]}).
+        Line belongs to the chunk it starts in."""
+        path, start, end = task
+        if end is None:
+            opener = cls.OPENERS[os.path.splitext(path)[1]]
+            with opener(path, "rt", encoding="utf-8", errors="replace") as handler:
+                return cls.parse_text(handler)
+
+        with open(path, "rb") as handler:
+            skip_first = False
+            if start > 0:
+                handler.seek(start - 1)
+                skip_first = handler.read(1) != b"\n"
+            data = handler.read(end - start)
+            if data and not data.endswith(b"\n"):
+                data += handler.readline()
+        if skip_first:
+            data = data[data.find(b"\n") + 1:] if b"\n" in data else b""
+        return cls.parse_text(io.StringIO(data.decode("utf-8", errors="replace")))
+
+    @staticmethod
+    def parse_text(handler):
+        """Parse lines of text stream, returns (lines, {username: [outgoing, incoming]})"""
+        parse = IoopParser().parse
+        totals = {}
+        lines = 0
+        for line in handler:
+            lines += 1
+            record = parse(line)
+            if record is not None:
+                value = totals.get(record.username)
+                if value is None:
+                    value = totals[record.username] = [0, 0]
+                value[record.direction] += record.nbytes
+        return lines, totals
 
+    def parse(self):
+        """Parse all files with a process pool, merging per-user totals"""
+        tasks = self.tasks()
+        started = time.perf_counter()
+        with multiprocessing.Pool(self.processes) as pool:
+            for done, (lines, totals) in enumerate(
+                    pool.imap_unordered(self.parse_chunk, tasks), 1):
+                self.lines += lines
+                for username, value in totals.items():
+                    total = self.totals[username]
+                    total[0] += value[0]
+                    total[1] += value[1]
+                if self.app.verbose >= 1:
+                    elapsed = time.perf_counter() - started
+                    print("INFO : " + str(datetime.datetime.now()) + " Backfill: " +
+                          str(done) + "/" + str(len(tasks)) + " chunks, " +
+                          str(self.lines) + " lines, " +
+                          "%.0f lines/sec" % (self.lines / max(elapsed, 1e-9)))
+        return time.perf_counter() - started
+
+    def run(self):
+        """Parse files and write totals. Returns (result, result_msg)"""
+        elapsed = self.parse()
+        rows = [(username, value[0], value[1]) for username, value in self.totals.items()]
+        writer = self.app.create_storage()
+        result, result_msg = writer.bulk_load_traffic(rows)
+        writer.close()
+        if result == 0:
+            print("INFO : " + str(datetime.datetime.now()) + " Backfill: " +
+                  str(self.lines) + " lines in %.1f s" % elapsed +
+                  " (%.0f lines/sec), " % (self.lines / max(elapsed, 1e-9)) +
+                  str(len(rows)) + " users written in " +
+                  "%.1f ms" % (writer.last_flush_latency * 1000))
+        else:
+            print("ERROR: " + str(datetime.datetime.now()) +
+                  " Backfill: unable to write to database")
+            print("ERROR: " + str(datetime.datetime.now()) + " " + result_msg)
         return result, result_msg
 
+
+class IngestWorker(multiprocessing.Process):
+    """
+    Ingest worker process for multi-process mode. Every worker listens on the same
+    port (SO_REUSEPORT), parses its own connections and periodically ships compact
+    per-user deltas to the aggregator, which owns the database writer.
+    """
+
+    # How often to ship deltas to aggregator, in seconds
+    SHIP_PERIOD = 0.5
+
+    def __init__(self, application, delta_queue, index):
+        super(IngestWorker, self).__init__(name="WORKER-" + str(index), daemon=True)
+        self.app = application
+        self.delta_queue = delta_queue
+        self.index = index
+        self.log_thread = None
+
+    def sigusr2_handler(self, signl, frame):
+        """SIGUSR2 Handler, aggregator asks worker to profile itself"""
+        # pylint: disable=W0612,W0613
+        self.app.start_profiler("worker" + str(self.index))
+
+    def sigterm_handler(self, signl, frame):
+        """SIGTERM Handler, aggregator asks worker to stop"""
+        # pylint: disable=W0612,W0613
+        if self.log_thread is not None:
+            self.log_thread.stop()
+
+    def run(self):
+        """Worker process "run" function"""
+        setproctitle.setproctitle("dante_trafmon: worker " + str(self.index))
+        # Ctrl+C reaches the whole process group, aggregator will stop workers itself
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, self.sigusr2_handler)
+        signal.signal(signal.SIGTERM, self.sigterm_handler)
+
+        # Worker's own counters hold deltas only, totals are kept by aggregator
+        self.app.counters = TrafficCounters()
+        if self.app.history_enabled:
+            self.app.counters.enable_buckets()
+        if self.app.dimensions_enabled:
+            self.app.dimensions = None
+            self.app.enable_dimensions()
+        if self.app.rates_enabled:
+            # Sums are only shipped, aggregator ranks users
+            self.app.rates = None
+            self.app.enable_rates(top_k=0)
+
+        self.log_thread = LogThread(self.name, LogThread.LOG_TYPE_DANTE, self.app,
+                                    timer_enabled=False)
+        self.log_thread.start()
+        while self.log_thread.is_alive():
+            self.log_thread.join(self.SHIP_PERIOD)
+            self.ship()
+        self.ship()
+        self.delta_queue.close()
+        self.delta_queue.join_thread()
+
+    def ship(self):
+        """Send deltas collected since the last call to aggregator"""
+        counters = self.app.counters
+        delta, _ = counters.swap()
+        bucket_rows = []
+        if self.app.history_enabled:
+            bucket_rows = [(minute, username, value[0], value[1])
+                           for (minute, username), value in counters.swap_buckets().items()]
+        source_rows, destination_rows = [], []
+        if self.app.dimensions is not None:
+            source_rows, destination_rows = self.app.dimensions.drain()
+        metric_rows = self.app.metrics.swap_counters()
+        rates = self.app.rates.drain() if self.app.rates is not None else None
+        if delta or bucket_rows or source_rows or metric_rows:
+            usernames, values = delta.export()
+            self.delta_queue.put((usernames, values.tobytes(), bucket_rows,
+                                  source_rows, destination_rows, metric_rows, rates))
+
+
+class AggregatorThread(threading.Thread):
+    """
+    Multi-process mode: starts ingest worker processes, merges their deltas into
+    application counters, TimerThread writes them to database as usual.
+    Same interface as LogThread as far as Application and TimerThread are concerned.
+    """
+    name = 'Aggregator'
+    app = None
+    timer = None
+
+    thread_running = True
+
+    def __init__(self, name, application):
+        super(AggregatorThread, self).__init__()
+        self.name = name
+        self.app = application
+        self.stopping = False
+        self.deltas_received = 0
+        # Workers are forked right away, before any thread of this process starts
+        self.delta_queue = multiprocessing.Queue()
+        self.workers = [IngestWorker(application, self.delta_queue, i)
+                        for i in range(application.workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def run(self):
+        """
+        Run separate thread
+        """
+        print("INFO : " + str(datetime.datetime.now()) +
+              " Thread " + self.name + " started, " + str(len(self.workers)) +
+              " workers. Port: " + str(self.app.listen_port))
+
+        self.timer = TimerThread(log_thread=self, application=self.app)
+        self.timer.start()
+        followers = self.app.start_followers()
+
+        while not self.stopping or any(worker.is_alive() for worker in self.workers):
+            try:
+                message = self.delta_queue.get(timeout=1)
+            except queue.Empty:
+                if not self.stopping and not any(worker.is_alive() for worker in self.workers):
+                    print("ERROR: " + str(datetime.datetime.now()) +
+                          " All ingest workers are gone, terminating now.")
+                    self.stopping = True
+                continue
+            self.merge(message)
+
+        # Whatever workers shipped right before exit
+        while True:
+            try:
+                self.merge(self.delta_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.app.stop_followers(followers)
+        # Followers' last lines are in counters now, let the timer finish
+        self.thread_running = False
+        print("INFO : " + str(datetime.datetime.now()) +
+              " Thread "+self.name+" terminated.")
+
+    def merge(self, message):
+        """Merge deltas shipped by one worker"""
+        usernames, values, bucket_rows, source_rows, destination_rows, metric_rows, \
+            rates = message
+        self.app.counters.add_delta(usernames, array("Q", values))
+        if bucket_rows:
+            self.app.counters.add_buckets(bucket_rows)
+        if source_rows and self.app.dimensions is not None:
+            self.app.dimensions.add_rows(source_rows, destination_rows)
+        if metric_rows:
+            self.app.metrics.add_counters(metric_rows)
+        if rates is not None and self.app.rates is not None:
+            self.app.rates.add_rows(*rates)
+        self.deltas_received += 1
+
+    def signal_workers(self, signum):
+        """Send signal to every running worker"""
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    def stop(self):
+        """Stop workers, thread stops after their last deltas are merged"""
+        self.stopping = True
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+
 # ------------                           MAIN                                 ------------ #
 
 #pylint: disable=C0103
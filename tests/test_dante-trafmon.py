@@ -1,3 +1,14 @@
+import errno
+import gzip
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+import pytest
 import dante_trafmon
 
 def test_initial():
@@ -42,3 +53,1404 @@ def test_server_does_not_have_pgsql():
     app.db_password = "TestPass8594"
     result, result_msg = app.dante_thread.timer_thread.data_init_from_db()
     assert result == 1
+
+#----                          LISTENER TESTS                              ----#
+
+OUT_LINE = ("Oct 18 12:00:01 (1792324801.123456) danted[4242]: info: pass(1): tcp/connect -: "
+            "username%{user}@192.168.1.5.52112 10.0.0.1.1080 -> "
+            "10.0.0.1.52113 93.184.216.34.80 ({nbytes})")
+IN_LINE = ("Oct 18 12:00:01 (1792324801.223456) danted[4242]: info: pass(1): tcp/connect -: "
+           "93.184.216.34.80 10.0.0.1.52113 -> "
+           "10.0.0.1.1080 username%{user}@192.168.1.5.52112 ({nbytes})")
+
+
+class NullTimer(threading.Thread):
+    """Timer thread replacement for tests which do not need database"""
+    def __init__(self, application, log_thread):
+        super(NullTimer, self).__init__(daemon=True)
+
+    def run(self):
+        pass
+
+
+def start_listener(monkeypatch):
+    """Start LogThread on a free port without database timer"""
+    monkeypatch.setattr(dante_trafmon.dante_trafmon, "TimerThread", NullTimer)
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        app.listen_port = sock.getsockname()[1]
+    thread = dante_trafmon.LogThread("TEST", dante_trafmon.LogThread.LOG_TYPE_DANTE, app)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", app.listen_port)).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.01)
+    return thread
+
+
+def wait_for(condition, timeout=5):
+    """Poll condition until it's true or timeout expires"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_listener_serves_concurrent_feeds(monkeypatch):
+    """Second feed is parsed while the first one is still connected"""
+    thread = start_listener(monkeypatch)
+    try:
+        first = socket.create_connection(("127.0.0.1", thread.app.listen_port))
+        second = socket.create_connection(("127.0.0.1", thread.app.listen_port))
+        second.sendall((OUT_LINE.format(user="bob", nbytes=100) + "\n").encode())
+        assert wait_for(lambda: thread.app.counters.snapshot().get("bob") == [100, 0])
+        first.sendall((IN_LINE.format(user="alice", nbytes=200) + "\n").encode())
+        assert wait_for(lambda: thread.app.counters.snapshot().get("alice") == [0, 200])
+        first.close()
+        second.close()
+        assert wait_for(lambda: not thread.connections)
+    finally:
+        thread.stop()
+        thread.join()
+
+#----                           FRAMING TESTS                              ----#
+
+def framer_feed(framer, data):
+    """Write data into framer buffer as if it was received from socket"""
+    framer.view[framer.filled:framer.filled + len(data)] = data
+    return framer.feed(len(data))
+
+
+def test_framer_keeps_partial_lines():
+    """Line split between reads is joined back together"""
+    framer = dante_trafmon.LineFramer(buffer_size=64, max_line_length=32)
+    assert framer_feed(framer, b"first line\nsec") == ["first line"]
+    assert framer_feed(framer, b"ond ") == []
+    assert framer_feed(framer, b"line\nthird") == ["second line"]
+    assert framer.flush() == ["third"]
+
+
+def test_framer_counts_malformed_and_oversized():
+    """Broken utf-8 and too long lines are dropped and counted"""
+    framer = dante_trafmon.LineFramer(buffer_size=64, max_line_length=16)
+    assert framer_feed(framer, b"good\n\xff\xfe\nfine\n") == ["good", "fine"]
+    assert framer.malformed_lines == 1
+    assert framer_feed(framer, b"x" * 20) == []
+    assert framer_feed(framer, b"y" * 20 + b"\nok\n") == ["ok"]
+    assert framer_feed(framer, b"z" * 20 + b"\n") == []
+    assert framer.oversized_lines == 2
+
+
+def test_listener_line_crossing_receive_boundary(monkeypatch):
+    """Log lines crossing receive buffer boundaries are not lost"""
+    thread = start_listener(monkeypatch)
+    try:
+        feed = socket.create_connection(("127.0.0.1", thread.app.listen_port))
+        payload = "".join(OUT_LINE.format(user="user%d" % (i % 7), nbytes=10) + "\n"
+                          for i in range(2000)).encode()
+        feed.sendall(payload)
+        feed.close()
+        assert wait_for(lambda: sum(v[0] for v in thread.app.counters.snapshot().values()) == 20000)
+    finally:
+        thread.stop()
+        thread.join()
+
+#----                            PARSER TESTS                              ----#
+
+def test_parser_outgoing_line():
+    """Username on the left side of the arrow is outgoing traffic"""
+    record = dante_trafmon.IoopParser().parse(OUT_LINE.format(user="alice", nbytes=517))
+    assert record == dante_trafmon.IoopRecord(dante_trafmon.IoopParser.DIRECTION_OUT,
+                                              "alice", 517,
+                                              "192.168.1.5.52112", "93.184.216.34.80")
+
+
+def test_parser_incoming_line():
+    """Username on the right side of the arrow is incoming traffic"""
+    record = dante_trafmon.IoopParser().parse(IN_LINE.format(user="bob@corp", nbytes=1448))
+    assert record == dante_trafmon.IoopRecord(dante_trafmon.IoopParser.DIRECTION_IN,
+                                              "bob@corp", 1448,
+                                              "192.168.1.5.52112", "93.184.216.34.80")
+
+
+def test_parser_ignores_other_lines():
+    """Non-ioop and broken lines are not parsed"""
+    parser = dante_trafmon.IoopParser()
+    assert parser.parse("") is None
+    assert parser.parse("Oct 18 12:00:01 (1792324801.1) danted[1]: info: pass(1): "
+                        "tcp/accept [: 192.168.1.5.52112 10.0.0.1.1080") is None
+    assert parser.parse(OUT_LINE.format(user="alice", nbytes="12x")) is None
+
+#----                         DATABASE WRITER TESTS                        ----#
+
+def make_timer(**settings):
+    """LogThread and TimerThread pair which are not started,
+    settings are set on Application first"""
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    for name, value in settings.items():
+        setattr(app, name, value)
+    log_thread = dante_trafmon.LogThread("TEST", dante_trafmon.LogThread.LOG_TYPE_DANTE, app)
+    timer = dante_trafmon.TimerThread(log_thread=log_thread, application=app)
+    return log_thread, timer
+
+
+def test_writer_flushes_only_dirty_users(monkeypatch):
+    """Only users changed since the last write are sent, failed ones are retried"""
+    log_thread, timer = make_timer()
+    written = []
+    results = [(0, "OK!")]
+    monkeypatch.setattr(timer.writer, "write_traffic",
+                        lambda rows: written.append(sorted(rows)) or results[-1])
+
+    timer.app.counters.load([("idle", 5, 5)])
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10),
+                            IN_LINE.format(user="bob", nbytes=20)])
+    assert timer.write_to_pgsql()[0] == 0
+    assert written[-1] == [("alice", 10, 0), ("bob", 0, 20)]
+
+    log_thread.parse_lines([IN_LINE.format(user="bob", nbytes=1)])
+    results.append((1, "database is gone"))
+    assert timer.write_to_pgsql()[0] == 1
+    assert written[-1] == [("bob", 0, 21)]
+    assert timer.pending_users == {"bob"}
+
+
+def test_writer_reports_unreachable_database():
+    """Write fails cleanly and connection is dropped for reconnect"""
+    _, timer = make_timer()
+    timer.app.db_hostname = "127.0.0.2"
+    result, _ = timer.writer.write_traffic([("alice", 1, 2)])
+    assert result == 1
+    assert timer.writer.conn is None
+
+
+#----                         TRAFFIC COUNTERS TESTS                       ----#
+
+def test_counters_swap_and_reset():
+    """Delta buffer is merged into totals, reset drops everything"""
+    counters = dante_trafmon.TrafficCounters()
+    parser = dante_trafmon.IoopParser()
+    counters.load([("alice", 100, 200)])
+    counters.add_records([parser.parse(OUT_LINE.format(user="alice", nbytes=1)),
+                          parser.parse(IN_LINE.format(user="bob", nbytes=2))])
+    assert counters.snapshot() == {"alice": [101, 200], "bob": [0, 2]}
+
+    delta, reset = counters.swap()
+    counters.merge(delta, reset)
+    assert counters.rows(["alice", "bob"]) == [("alice", 101, 200), ("bob", 0, 2)]
+
+    counters.reset()
+    assert counters.snapshot() == {}
+    counters.merge(*counters.swap())
+    assert len(counters.totals) == 0
+
+
+def test_counter_store_grows_and_exports():
+    """Slots survive growth past capacity, packed export loads back the same"""
+    store = dante_trafmon.CounterStore(capacity=2)
+    store.add(["user%d" % i for i in range(100)], range(100), range(0, 200, 2))
+    store.add_packed(["user7"], [1, 1])
+    assert store.slot("user7") == 7 and len(store) == 100
+    assert store.get("user7") == (8, 15)
+    assert store.get("nobody") is None
+    store.load([("user7", 5, 6), ("new", 1 << 63, 0)])
+    assert store.rows(["user7", "nobody", "new"]) == [("user7", 5, 6), ("new", 1 << 63, 0)]
+
+    copy = dante_trafmon.CounterStore.from_packed(*store.export())
+    assert list(copy) == list(store)
+    assert copy.rows(list(store)) == store.rows(list(store))
+    delta = dante_trafmon.CounterStore()
+    delta.add_packed(["late", "user7", "late"], [1, 2, 1, 1, 1, 2])
+    copy.add_delta(delta)
+    assert copy.get("late") == (2, 4) and copy.get("user7") == (6, 7)
+    assert "late" not in store
+    assert delta.columns() == (["late", "user7"], array("Q", [2, 1]), array("Q", [4, 1]))
+
+
+def test_ingest_does_not_wait_for_database(monkeypatch):
+    """Parsing goes on while database write is stuck"""
+    log_thread, timer = make_timer()
+    stalled = threading.Event()
+    release = threading.Event()
+
+    def stuck_write(rows):
+        stalled.set()
+        release.wait(5)
+        return 0, "OK!"
+    monkeypatch.setattr(timer.writer, "write_traffic", stuck_write)
+
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10)])
+    flusher = threading.Thread(target=timer.write_to_pgsql)
+    flusher.start()
+    assert stalled.wait(5)
+
+    started = time.time()
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=5)] * 1000)
+    assert time.time() - started < 1
+    assert timer.app.counters.snapshot()["alice"] == [5010, 0]
+    release.set()
+    flusher.join()
+
+
+#----                          TRAFFIC HISTORY TESTS                       ----#
+
+def test_history_rollups():
+    """Minute buckets are rolled up to hours and days incrementally"""
+    app = dante_trafmon.Application()
+    history = dante_trafmon.TrafficHistory(app)
+    day = 1792281600
+    history.add({(day + 60, "alice"): [1, 2], (day + 120, "alice"): [3, 4],
+                 (day + 3600, "alice"): [5, 6], (day + 60, "bob"): [7, 8]})
+    rows = history.rows()
+    assert sorted(rows["traffic_minute"]) == [(day + 60, "alice", 1, 2), (day + 60, "bob", 7, 8),
+                                              (day + 120, "alice", 3, 4),
+                                              (day + 3600, "alice", 5, 6)]
+    assert sorted(rows["traffic_hour"]) == [(day, "alice", 4, 6), (day, "bob", 7, 8),
+                                            (day + 3600, "alice", 5, 6)]
+    assert sorted(rows["traffic_day"]) == [(day, "alice", 9, 12), (day, "bob", 7, 8)]
+
+    history.clear()
+    assert history.rows()["traffic_day"] == []
+
+
+def test_history_retention_period():
+    """Expired rows are deleted once per expire period"""
+    app = dante_trafmon.Application()
+    app.history_minute_retention = 1
+    history = dante_trafmon.TrafficHistory(app)
+    cutoffs = history.expire_cutoffs(now=1000000)
+    assert cutoffs["traffic_minute"] == 1000000 - 86400
+    assert history.expire_cutoffs(now=1000010) is None
+
+
+def test_history_written_from_counters(monkeypatch):
+    """Ingested traffic ends up in history tables, failed writes are retried"""
+    log_thread, timer = make_timer(history_enabled=True)
+    written = []
+    results = [(1, "database is gone"), (0, "OK!")]
+    monkeypatch.setattr(timer.writer, "write_history",
+                        lambda tables, cutoffs: written.append(tables) or results.pop(0))
+
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10)])
+    assert timer.write_history()[0] == 1
+    log_thread.parse_lines([IN_LINE.format(user="alice", nbytes=5)])
+    assert timer.write_history()[0] == 0
+    day_rows = written[-1]["traffic_day"]
+    assert [row[1:] for row in day_rows] == [("alice", 10, 5)]
+
+
+#----                        MULTI-PROCESS MODE TESTS                      ----#
+
+def test_workers_ship_deltas_to_aggregator(monkeypatch):
+    """Connections spread over worker processes end up in aggregator counters"""
+    monkeypatch.setattr(dante_trafmon.dante_trafmon, "TimerThread", NullTimer)
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    app.workers = 2
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        app.listen_port = sock.getsockname()[1]
+    aggregator = dante_trafmon.AggregatorThread("TEST", app)
+    aggregator.start()
+    try:
+        for i in range(8):
+            for _ in range(100):
+                try:
+                    feed = socket.create_connection(("127.0.0.1", app.listen_port))
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.05)
+            feed.sendall((OUT_LINE.format(user="user%d" % (i % 2), nbytes=10) + "\n").encode())
+            feed.close()
+        assert wait_for(lambda: app.counters.snapshot() == {"user0": [40, 0], "user1": [40, 0]},
+                        timeout=10)
+    finally:
+        aggregator.stop()
+        aggregator.join()
+    assert not any(worker.is_alive() for worker in aggregator.workers)
+
+
+#----                              SPOOL TESTS                             ----#
+
+def test_journal_replay_and_compact(tmp_path):
+    """Journal survives reopening, reset drops older deltas, compaction keeps the sum"""
+    journal = dante_trafmon.DeltaJournal(str(tmp_path))
+    journal.open()
+    journal.write(journal.reserve(), journal.pack_delta(["alice", "bob"], [1, 2, 3, 4]))
+    journal.append_reset()
+    journal.seal(journal.rotate())
+    for _ in range(journal.COMPACT_SEGMENTS):
+        journal.write(journal.reserve(), journal.pack_delta(["alice"], [10, 20]))
+        journal.seal(journal.rotate())
+    journal.close()
+
+    journal = dante_trafmon.DeltaJournal(str(tmp_path))
+    journal.open()
+    expected = ({"alice": [160, 320]}, True)
+    delta, reset = journal.replay()
+    assert (dict(delta), reset) == expected
+    journal.compact()
+    assert len(journal.sealed) == 1
+    delta, reset = journal.replay()
+    assert (dict(delta), reset) == expected
+    journal.commit()
+    assert journal.replay()[0] == {}
+
+    # Username too long for entry is not cut, it would be replayed as another user
+    journal.write(journal.reserve(), journal.pack_delta(["\u00e9" * 40000, "bob"], [1, 2, 3, 4]))
+    journal.seal(journal.rotate())
+    assert dict(journal.replay()[0]) == {"bob": [3, 4]}
+    journal.close()
+
+
+def test_spool_keeps_counters_over_restart(tmp_path, monkeypatch):
+    """Traffic not yet written to database is replayed after restart"""
+    log_thread, timer = make_timer(spool_enabled=True, spool_directory=str(tmp_path))
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10),
+                            IN_LINE.format(user="bob", nbytes=20)])
+    monkeypatch.setattr(timer.writer, "write_traffic", lambda rows: (1, "database is gone"))
+    assert timer.write_to_pgsql()[0] == 1
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=5)])
+    timer.journal.close()
+
+    _, timer = make_timer(spool_enabled=True, spool_directory=str(tmp_path))
+    assert timer.app.counters.snapshot() == {"alice": [15, 0], "bob": [0, 20]}
+
+
+def test_spool_waits_for_database(tmp_path, monkeypatch):
+    """Database down at start: traffic is kept until totals are loaded, then written"""
+    log_thread, timer = make_timer(spool_enabled=True, spool_directory=str(tmp_path))
+    timer.waiting_for_db = True
+    loads = [(1, "database is gone")]
+
+    def data_init_from_db():
+        if loads:
+            return loads.pop()
+        timer.app.counters.load([("alice", 1000, 2000)])
+        return 0, "OK!"
+    monkeypatch.setattr(timer, "data_init_from_db", data_init_from_db)
+    written = []
+    monkeypatch.setattr(timer.writer, "write_traffic",
+                        lambda rows: written.append(rows) or (0, "OK!"))
+
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10)])
+    assert timer.write_to_pgsql()[0] == 1
+    log_thread.parse_lines([IN_LINE.format(user="alice", nbytes=20)])
+    assert timer.write_to_pgsql()[0] == 0
+    assert written == [[("alice", 1010, 2020)]]
+    assert not timer.journal.sealed
+
+
+def test_spool_survives_disk_errors(tmp_path, monkeypatch):
+    """Journal write error does not stop counting, journal is degraded
+    until the deltas it missed are in database"""
+    log_thread, timer = make_timer(spool_enabled=True, spool_directory=str(tmp_path))
+    journal = timer.journal
+
+    class FullDisk:
+        """Segment file on a full disk"""
+        def write(self, data):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        def close(self):
+            pass
+    journal.current.handler.close()
+    journal.current.handler = FullDisk()
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10)])
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=5)])
+    assert timer.app.counters.snapshot() == {"alice": [15, 0]}
+    assert journal.degraded
+
+    monkeypatch.setattr(timer.writer, "write_traffic", lambda rows: (1, "database is gone"))
+    assert timer.write_to_pgsql()[0] == 1
+    # New segment is written again, sealed one still misses deltas
+    log_thread.parse_lines([OUT_LINE.format(user="bob", nbytes=1)])
+    assert journal.degraded and not journal.current.failed
+    monkeypatch.setattr(timer.writer, "write_traffic", lambda rows: (0, "OK!"))
+    assert timer.write_to_pgsql()[0] == 0
+    assert not journal.degraded
+
+
+def test_spool_disk_stall_does_not_hold_counters(tmp_path):
+    """Journal write stuck on disk does not keep counters lock, swap waits for it"""
+    log_thread, timer = make_timer(spool_enabled=True, spool_directory=str(tmp_path))
+    counters = timer.app.counters
+    segment = timer.journal.current
+    released = threading.Event()
+
+    class StalledDisk:
+        """Segment file on a disk which does not answer"""
+        def __init__(self, handler):
+            self.handler = handler
+
+        def write(self, data):
+            released.wait(5)
+            return self.handler.write(data)
+
+        def close(self):
+            self.handler.close()
+    segment.handler = StalledDisk(segment.handler)
+    parser = threading.Thread(target=log_thread.parse_lines,
+                              args=([OUT_LINE.format(user="alice", nbytes=10)],))
+    parser.start()
+    assert wait_for(lambda: segment.writers == 1)
+    assert counters.snapshot() == {"alice": [10, 0]}
+    swapper = threading.Thread(target=counters.swap)
+    swapper.start()
+    swapper.join(0.2)
+    # Swap is done with the lock, sealing waits for the write
+    assert swapper.is_alive() and counters.lock.acquire(timeout=1)
+    counters.lock.release()
+    released.set()
+    parser.join()
+    swapper.join()
+    assert segment.path in timer.journal.sealed
+    assert dict(timer.journal.replay()[0]) == {"alice": [10, 0]}
+
+
+#----                           LOG FOLLOWER TESTS                         ----#
+
+def start_follower(tmp_path, monkeypatch, app=None):
+    """LogFollower for tmp_path/danted.log with fast polling"""
+    monkeypatch.setattr(dante_trafmon.LogFollower, "POLL_INTERVAL", 0.01)
+    if app is None:
+        app = dante_trafmon.Application()
+        app.verbose = 0
+        app.state_directory = str(tmp_path / "state")
+    follower = dante_trafmon.LogFollower(app, str(tmp_path / "danted.log"))
+    follower.start()
+    return follower
+
+
+def append_log(path, lines):
+    """Append lines to log file"""
+    with open(path, "a") as handler:
+        handler.write("".join(line + "\n" for line in lines))
+
+
+def test_follower_handles_rotation_and_truncation(tmp_path, monkeypatch):
+    """Lines are counted once over rotation and truncation"""
+    log = tmp_path / "danted.log"
+    log.touch()
+    follower = start_follower(tmp_path, monkeypatch)
+    counters = follower.app.counters
+    try:
+        assert wait_for(lambda: follower.position is not None)
+        append_log(log, [OUT_LINE.format(user="alice", nbytes=10)])
+        assert wait_for(lambda: counters.snapshot() == {"alice": [10, 0]})
+        append_log(log, [OUT_LINE.format(user="alice", nbytes=5)])
+        os.rename(str(log), str(log) + ".1")
+        append_log(log, [IN_LINE.format(user="alice", nbytes=7)])
+        assert wait_for(lambda: counters.snapshot() == {"alice": [15, 7]})
+        open(str(log), "w").close()
+        append_log(log, [IN_LINE.format(user="bob", nbytes=1)])
+        assert wait_for(lambda: counters.snapshot().get("bob") == [0, 1])
+    finally:
+        follower.stop()
+        follower.join()
+    assert counters.snapshot() == {"alice": [15, 7], "bob": [0, 1]}
+
+
+def test_follower_resumes_from_checkpoint(tmp_path, monkeypatch):
+    """Restart continues at saved offset, even if log was rotated meanwhile.
+    Lines read after the offset was saved are read again."""
+    log = tmp_path / "danted.log"
+    append_log(log, [OUT_LINE.format(user="skipped", nbytes=99)])
+    follower = start_follower(tmp_path, monkeypatch)
+    assert wait_for(lambda: follower.position is not None)
+    append_log(log, [OUT_LINE.format(user="alice", nbytes=10)])
+    assert wait_for(lambda: follower.app.counters.snapshot() == {"alice": [10, 0]})
+    # As timer does once lines are stored
+    follower.checkpoint(follower.position)
+    append_log(log, [OUT_LINE.format(user="alice", nbytes=3)])
+    assert wait_for(lambda: follower.app.counters.snapshot() == {"alice": [13, 0]})
+    follower.stop()
+    follower.join()
+
+    append_log(log, [OUT_LINE.format(user="alice", nbytes=1)])
+    os.rename(str(log), str(log) + ".1")
+    append_log(log, [OUT_LINE.format(user="bob", nbytes=2)])
+
+    app = follower.app
+    app.counters = dante_trafmon.TrafficCounters()
+    follower = start_follower(tmp_path, monkeypatch, app)
+    try:
+        assert wait_for(lambda: app.counters.snapshot() == {"alice": [4, 0], "bob": [2, 0]})
+    finally:
+        follower.stop()
+        follower.join()
+
+
+def test_follower_offset_saved_after_database_write(tmp_path, monkeypatch):
+    """Offset of followed file moves only when its lines are written to database"""
+    log = tmp_path / "danted.log"
+    log.touch()
+    log_thread, timer = make_timer()
+    timer.app.state_directory = str(tmp_path / "state")
+    results = [(1, "database is gone")]
+    monkeypatch.setattr(timer.writer, "write_traffic", lambda rows: results[-1])
+    follower = start_follower(tmp_path, monkeypatch, timer.app)
+    timer.app.followers = [follower]
+    try:
+        assert wait_for(lambda: follower.load_checkpoint() is not None)
+        append_log(log, [OUT_LINE.format(user="alice", nbytes=10)])
+        assert wait_for(lambda: timer.app.counters.snapshot() == {"alice": [10, 0]})
+        assert timer.write_to_pgsql()[0] == 1
+        assert follower.load_checkpoint()["offset"] == 0
+        results.append((0, "OK!"))
+        assert timer.write_to_pgsql()[0] == 0
+        assert follower.load_checkpoint()["offset"] == log.stat().st_size
+    finally:
+        follower.stop()
+        follower.join()
+
+
+#----                             BACKFILL TESTS                           ----#
+
+def test_backfill_rebuilds_totals(tmp_path, monkeypatch):
+    """Chunked plain and compressed logs give the same totals as line by line parsing"""
+    monkeypatch.setattr(dante_trafmon.Backfill, "CHUNK_SIZE", 1000)
+    lines = [(OUT_LINE if i % 3 else IN_LINE).format(user="user%d" % (i % 5), nbytes=i)
+             for i in range(300)]
+    plain = tmp_path / "danted.log"
+    append_log(plain, lines[:200])
+    packed = tmp_path / "danted.log.1.gz"
+    with gzip.open(str(packed), "wt") as handler:
+        handler.write("".join(line + "\n" for line in lines[200:]))
+
+    expected = {}
+    parser = dante_trafmon.IoopParser()
+    for line in lines:
+        record = parser.parse(line)
+        expected.setdefault(record.username, [0, 0])[record.direction] += record.nbytes
+
+    written = []
+    monkeypatch.setattr(dante_trafmon.PgsqlBackend, "bulk_load_traffic",
+                        lambda self, rows: written.append(rows) or (0, "OK!"))
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    backfill = dante_trafmon.Backfill(app, [str(plain), str(packed)], processes=2)
+    assert len(backfill.tasks()) > 2
+    assert backfill.run()[0] == 0
+    assert backfill.lines == 300
+    assert {row[0]: [row[1], row[2]] for row in written[0]} == expected
+
+
+def test_copy_escape():
+    """Usernames are safe for COPY text format"""
+    escape = dante_trafmon.PgsqlBackend.copy_escape
+    assert escape("a\tb\\c\nd") == "a\\tb\\\\c\\nd"
+
+
+#----                         STORAGE BACKEND TESTS                        ----#
+
+@pytest.mark.parametrize("backend", ["sqlite", "file"])
+def test_embedded_storage_roundtrip(tmp_path, backend):
+    """Counters written by one run are loaded by the next one"""
+    log_thread, timer = make_timer(db_backend=backend, db_path=str(tmp_path / "traffic.db"))
+    assert timer.data_init_from_db()[0] == 0
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=100),
+                            IN_LINE.format(user="bob", nbytes=7)])
+    assert timer.write_to_pgsql()[0] == 0
+    log_thread.parse_lines([IN_LINE.format(user="alice", nbytes=5)])
+    assert timer.write_to_pgsql()[0] == 0
+    assert timer.writer.rows_total == 3
+    timer.writer.close()
+
+    log_thread, timer = make_timer(db_backend=backend, db_path=str(tmp_path / "traffic.db"))
+    assert timer.data_init_from_db()[0] == 0
+    assert log_thread.app.counters.snapshot() == {"alice": [100, 5], "bob": [0, 7]}
+    timer.writer.close()
+
+
+def test_sqlite_storage_history(tmp_path):
+    """SQLite backend runs in WAL mode and keeps additive history with retention"""
+    _, timer = make_timer(db_backend="sqlite", db_path=str(tmp_path / "traffic.db"))
+    writer = timer.writer
+    tables = {"traffic_minute": [(60, "alice", 1, 2), (120, "alice", 3, 4)]}
+    assert writer.write_history(tables)[0] == 0
+    assert writer.write_history(tables, {"traffic_minute": 120})[0] == 0
+    conn = writer.connect()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("SELECT bucket, username, outgoing, incoming "
+                        "FROM traffic_minute").fetchall() == [(120, "alice", 6, 8)]
+    writer.close()
+
+
+def test_snapshot_storage_is_replaced_atomically(tmp_path, monkeypatch):
+    """Failed snapshot write leaves the previous file intact"""
+    _, timer = make_timer(db_backend="file", db_path=str(tmp_path / "traffic.db"))
+    writer = timer.writer
+    assert writer.write_traffic([("alice", 1, 2)])[0] == 0
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(dante_trafmon.dante_trafmon.os, "replace", failing_replace)
+    assert writer.write_traffic([("alice", 10, 20), ("bob", 3, 4)])[0] == 1
+    assert dante_trafmon.SnapshotBackend.read_file(str(tmp_path / "traffic.db")) == \
+        {"alice": (1, 2)}
+
+
+def test_snapshot_storage_skips_long_usernames(tmp_path):
+    """Username too long for snapshot entry is left out, the rest is written"""
+    path = str(tmp_path / "traffic.db")
+    dante_trafmon.SnapshotBackend.write_file(path, {"alice": (1, 2), "x" * 65536: (3, 4)})
+    assert dante_trafmon.SnapshotBackend.read_file(path) == {"alice": (1, 2)}
+    # Username cut short by a crash is not read as another user
+    with open(path, "rb") as handler:
+        data = handler.read()
+    with open(path, "wb") as handler:
+        handler.write(data[:-1])
+    with pytest.raises(ValueError):
+        dante_trafmon.SnapshotBackend.read_file(path)
+
+
+def test_unknown_storage_backend():
+    """Misspelled backend is reported, not silently replaced by PostgreSQL"""
+    app = dante_trafmon.Application()
+    app.db_backend = "mysql"
+    with pytest.raises(ValueError):
+        app.create_storage()
+
+
+def test_startup_snapshot(tmp_path):
+    """Clean shutdown saves counters, next start serves them until database
+    is loaded, then database totals replace them"""
+    log_thread, timer = make_timer(db_backend="sqlite", db_path=str(tmp_path / "traffic.db"),
+                                   state_directory=str(tmp_path / "state"))
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=100),
+                            IN_LINE.format(user="bob", nbytes=7)])
+    log_thread.stop()
+    timer.run()
+    assert timer.loaded.is_set()
+
+    conn = sqlite3.connect(str(tmp_path / "traffic.db"))
+    with conn:
+        conn.execute("DELETE FROM traffic WHERE username = 'bob'")
+    conn.close()
+
+    log_thread, timer = make_timer(db_backend="sqlite", db_path=str(tmp_path / "traffic.db"),
+                                   state_directory=str(tmp_path / "state"))
+    assert timer.restore_snapshot() == 2
+    assert not os.path.exists(timer.snapshot_path())
+    log_thread.parse_lines([IN_LINE.format(user="alice", nbytes=5)])
+    assert log_thread.app.counters.snapshot() == {"alice": [100, 5], "bob": [0, 7]}
+    assert timer.data_init_from_db()[0] == 0
+    assert log_thread.app.counters.snapshot() == {"alice": [100, 5]}
+    timer.writer.close()
+
+
+def test_storage_streams_traffic(tmp_path, monkeypatch):
+    """Totals are read in batches"""
+    monkeypatch.setattr(dante_trafmon.StorageBackend, "LOAD_BATCH_ROWS", 2)
+    _, timer = make_timer(db_backend="sqlite", db_path=str(tmp_path / "traffic.db"))
+    rows = [("user%d" % i, i, i) for i in range(5)]
+    assert timer.writer.write_traffic(rows)[0] == 0
+    assert [len(batch) for batch in timer.writer.iter_traffic()] == [2, 2, 1]
+    timer.writer.close()
+
+
+#----                            DIMENSIONS TESTS                          ----#
+
+def record(username, target, nbytes, direction=0):
+    """IoopRecord to given target"""
+    return dante_trafmon.IoopRecord(direction, username, nbytes, "192.168.1.5.52112", target)
+
+
+def test_destination_sketch_keeps_heavy_hitters():
+    """Heavy destinations survive a stream of light ones, memory stays capped"""
+    dims = dante_trafmon.DimensionCounters(top_k=3, max_entries=12)
+    records = []
+    for i in range(2000):
+        records.append(record("alice", "10.0.0.%d.443" % (i % 3), 1000))
+        records.append(record("alice", "172.16.%d.%d.80" % (i // 250, i % 250), 1))
+    dims.add_records(records, "local")
+    rows = dims.destination_rows(["alice"])
+    assert sorted(row[1] for row in rows) == ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
+    for _, destination, nbytes, error in rows:
+        exact = len(range(int(destination[-1]), 2000, 3)) * 1000
+        assert nbytes - error <= exact <= nbytes
+    assert len(dims.sketches["alice"]) == 6
+
+    dims.add_records([record("user%d" % i, "1.1.1.1.53", 5) for i in range(3)], "local")
+    assert len(dims.sketches) == 2
+    assert dims.untracked_bytes == 10
+
+
+def test_dimensions_written_to_storage(tmp_path):
+    """Per-source counters add up, top destinations are replaced and restored on start"""
+    log_thread, timer = make_timer(db_backend="sqlite", db_path=str(tmp_path / "traffic.db"),
+                                   dimensions_enabled=True)
+    assert timer.data_init_from_db()[0] == 0
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=10)], "10.0.0.7")
+    log_thread.parse_lines([IN_LINE.format(user="alice", nbytes=5)])
+    assert timer.write_dimensions()[0] == 0
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=1)], "10.0.0.7")
+    assert timer.write_dimensions()[0] == 0
+    conn = timer.writer.connect()
+    assert sorted(conn.execute("SELECT username, source, outgoing, incoming "
+                               "FROM traffic_source").fetchall()) == \
+        [("alice", "10.0.0.7", 11, 0), ("alice", "local", 0, 5)]
+    assert conn.execute("SELECT * FROM traffic_destination").fetchall() == \
+        [("alice", "93.184.216.34", 16, 0)]
+    timer.writer.close()
+
+    app = log_thread.app
+    app.dimensions = None
+    timer = dante_trafmon.TimerThread(log_thread=log_thread, application=app)
+    assert timer.data_init_from_db()[0] == 0
+    assert app.dimensions.destination_rows(["alice"]) == [("alice", "93.184.216.34", 16, 0)]
+    timer.writer.close()
+
+
+#----                              QUOTA TESTS                             ----#
+
+def drain_events(engine):
+    """Events queued by QuotaEngine so far"""
+    events = []
+    while not engine.events.empty():
+        events.append(engine.events.get())
+    return events
+
+
+def test_quota_thresholds_fire_once():
+    """Every threshold fires once, jumps fire the highest one, reset clears the level"""
+    engine = dante_trafmon.QuotaEngine(thresholds=[100, 80])
+    engine.rearm({"alice": 1000, "bob": 100}, {"bob": 150})
+    assert drain_events(engine) == [("bob", 100, 150, 100)]
+    assert "bob" not in engine.remaining
+
+    engine.check_records([record("alice", "1.1.1.1.53", 700), record("carol", "1.1.1.1.53", 5)])
+    assert drain_events(engine) == []
+    engine.check_records([record("alice", "1.1.1.1.53", 100)])
+    assert drain_events(engine) == [("alice", 80, 800, 1000)]
+    engine.check_delta(["alice"], [150, 100])
+    assert drain_events(engine) == [("alice", 100, 1050, 1000)]
+    engine.check_records([record("alice", "1.1.1.1.53", 100)])
+    assert drain_events(engine) == []
+
+    engine.rearm({"alice": 1000, "bob": 100}, {"alice": 10})
+    assert sorted(drain_events(engine)) == [("alice", 0, 10, 1000), ("bob", 0, 0, 100)]
+    assert engine.remaining == {"alice": 790, "bob": 80}
+
+
+def test_quota_rearm_counts_unmerged_delta():
+    """Rearm takes usage from totals and delta buffer together, later updates
+    are checked against the new index"""
+    counters = dante_trafmon.TrafficCounters()
+    counters.quota = dante_trafmon.QuotaEngine(thresholds=[100])
+    counters.load([("alice", 300, 200)])
+    counters.add_records([record("alice", "1.1.1.1.53", 400)])
+    counters.rearm_quota({"alice": 1000})
+    assert counters.quota.remaining == {"alice": 100}
+    counters.add_records([record("alice", "1.1.1.1.53", 100)])
+    assert drain_events(counters.quota) == [("alice", 100, 1000, 1000)]
+
+
+def test_quota_file(tmp_path):
+    """Quota file sizes may have binary suffixes, bad lines are reported"""
+    path = tmp_path / "quota"
+    path.write_text("# user quota\nalice 2G\nbob 1500 # bytes\n\n")
+    assert dante_trafmon.QuotaEngine.read_file(str(path)) == {"alice": 2 * 1024 ** 3,
+                                                              "bob": 1500}
+    path.write_text("alice\n")
+    with pytest.raises(ValueError):
+        dante_trafmon.QuotaEngine.read_file(str(path))
+
+
+def test_quota_hooks(tmp_path):
+    """Crossing is seen inline in ingest, socket hook and database flag follow it"""
+    (tmp_path / "quota").write_text("alice 100\n")
+    log_thread, timer = make_timer(db_backend="sqlite", db_path=str(tmp_path / "traffic.db"),
+                                   quota_enabled=True, quota_file=str(tmp_path / "quota"),
+                                   quota_socket=str(tmp_path / "quota.sock"),
+                                   quota_database_flag=True)
+    app = log_thread.app
+    timer.writer.connect().execute("INSERT INTO traffic_quota(username, quota) "
+                                   "VALUES ('alice', 100)")
+    timer.writer.conn.commit()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as listener:
+        listener.bind(app.quota_socket)
+        listener.settimeout(5)
+        timer.quota_notifier.start()
+        assert timer.data_init_from_db()[0] == 0
+        assert timer.refresh_quota()[0] == 0
+        log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=60)])
+        log_thread.parse_lines([IN_LINE.format(user="alice", nbytes=60)])
+        message = listener.recv(4096)
+    timer.quota_notifier.stop()
+    timer.quota_notifier.join()
+    assert json.loads(message.decode()) == {"username": "alice", "percent": 100,
+                                            "usage": 120, "quota": 100}
+    assert timer.writer.connect().execute("SELECT exceeded FROM traffic_quota").fetchall() == \
+        [(100,)]
+    timer.writer.close()
+
+
+#----                             READ API TESTS                           ----#
+
+def test_read_snapshot_queries():
+    """Prefix and top-N queries of read snapshot"""
+    snapshot = dante_trafmon.ReadSnapshot({"alice": [1, 2], "alex": [10, 0], "bob": [0, 100]},
+                                          created=1.0)
+    assert json.loads(snapshot.all_body)["users"][0] == {"username": "alex", "outgoing": 10,
+                                                          "incoming": 0}
+    assert [row["username"] for row in json.loads(snapshot.prefix("al"))["users"]] == \
+        ["alex", "alice"]
+    assert json.loads(snapshot.prefix("zed"))["users"] == []
+    assert [row["username"] for row in json.loads(snapshot.top(2))["users"]] == ["bob", "alex"]
+    assert snapshot.user("carol") is None
+
+
+def test_read_api_serves_snapshot(tmp_path):
+    """Read API answers over unix socket, from the last published snapshot"""
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    app.api_socket = str(tmp_path / "api.sock")
+    api = dante_trafmon.ReadApiThread(app)
+    api.publish(dante_trafmon.ReadSnapshot({"alice": [1, 2], "bob": [3, 4]}))
+    api.start()
+
+    def get(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(app.api_socket)
+            conn.sendall(("GET " + path + " HTTP/1.1\r\nHost: localhost\r\n\r\n").encode())
+            response = b""
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                response += data
+        head, body = response.split(b"\r\n\r\n", 1)
+        return int(head.split()[1]), json.loads(body)
+
+    try:
+        assert wait_for(lambda: os.path.exists(app.api_socket))
+        assert get("/traffic/bob") == (200, {"time": api.snapshot.created,
+                                             "users": [{"username": "bob", "outgoing": 3,
+                                                        "incoming": 4}]})
+        assert len(get("/traffic")[1]["users"]) == 2
+        assert get("/top?n=1")[1]["users"][0]["username"] == "bob"
+        assert get("/traffic/carol")[0] == 404
+        assert get("/top?n=x")[0] == 400
+    finally:
+        api.stop()
+        api.join()
+    assert api.requests_served == 5
+
+
+#----                              METRICS TESTS                           ----#
+
+def test_metrics_render():
+    """Counters with labels and histograms in Prometheus text format"""
+    metrics = dante_trafmon.Metrics()
+    histogram = dante_trafmon.Histogram(buckets=(0.1, 1))
+    metrics.add_histogram("flush_seconds", histogram)
+    metrics.inc("lines_total", 5, (("source", 'a"b'),))
+    metrics.inc("lines_total", 2, (("source", 'a"b'),))
+    histogram.observe(0.05)
+    histogram.observe(5)
+    text = metrics.render().decode()
+    assert "# TYPE dante_trafmon_lines_total counter" in text
+    assert 'dante_trafmon_lines_total{source="a\\"b"} 7' in text
+    assert 'dante_trafmon_flush_seconds_bucket{le="0.1"} 1' in text
+    assert 'dante_trafmon_flush_seconds_bucket{le="1"} 1' in text
+    assert 'dante_trafmon_flush_seconds_bucket{le="+Inf"} 2' in text
+    assert "dante_trafmon_flush_seconds_count 2" in text
+
+
+def test_ingest_metrics_and_quiet_log(capsys):
+    """Parsed batches are counted, per-line log is rate limited"""
+    app = dante_trafmon.Application()
+    app.log_rate = 3
+    log_thread = dante_trafmon.LogThread("TEST", dante_trafmon.LogThread.LOG_TYPE_DANTE, app)
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=1)] * 5 +
+                           [IN_LINE.format(user="alice", nbytes=1)] * 2 + ["noise"], "10.0.0.7")
+    values = app.metrics.values
+    assert values[("lines_total", (("source", "10.0.0.7"),))] == 8
+    assert values[("records_total", (("direction", "out"),))] == 5
+    assert values[("records_total", (("direction", "in"),))] == 2
+    assert values[("unmatched_lines_total", ())] == 1
+    assert app.counters.lock_hold.count == 1
+    assert capsys.readouterr().out.count("L:") == 3
+
+    app.verbose = 0
+    log_thread.parse_lines([OUT_LINE.format(user="alice", nbytes=1)])
+    assert capsys.readouterr().out == ""
+    assert values[("lines_total", (("source", "10.0.0.7"),))] == 8
+    assert values[("lines_total", (("source", "local"),))] == 1
+
+
+def test_metrics_endpoint():
+    """Metrics are served over HTTP"""
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        app.metrics_port = sock.getsockname()[1]
+    app.metrics.inc("flush_rows_total", 3)
+    server = dante_trafmon.MetricsThread(app)
+    server.start()
+    try:
+        conn = None
+        for _ in range(100):
+            try:
+                conn = socket.create_connection(("127.0.0.1", app.metrics_port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        conn.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            response += data
+        conn.close()
+    finally:
+        server.stop()
+        server.join()
+    assert response.startswith(b"HTTP/1.0 200 OK")
+    assert b"dante_trafmon_flush_rows_total 3" in response
+
+
+#----                             PROFILER TESTS                           ----#
+
+def busy_loop(stop_event):
+    """Something for profiler to find"""
+    while not stop_event.is_set():
+        sum(range(1000))
+
+
+def test_profiler_writes_collapsed_stacks(tmp_path):
+    """Profile of a running thread is written next to trafmon log"""
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    app.daemon_log = str(tmp_path / "dante_trafmon.log")
+    app.profile_duration = 0.3
+    app.profile_interval = 0.005
+    stop_event = threading.Event()
+    busy = threading.Thread(target=busy_loop, args=(stop_event,), name="BUSY")
+    busy.start()
+    try:
+        path = app.start_profiler()
+        assert app.start_profiler() is None
+        app.profiler.join()
+    finally:
+        stop_event.set()
+        busy.join()
+    assert os.path.dirname(path) == str(tmp_path)
+    with open(path) as handler:
+        lines = handler.read().splitlines()
+    busy_samples = [int(line.rsplit(" ", 1)[1]) for line in lines
+                    if line.startswith("BUSY;") and "busy_loop (test_dante-trafmon.py:" in line]
+    assert sum(busy_samples) > 10
+
+
+#----                           INGEST QUEUE TESTS                         ----#
+
+def test_ingest_queue_drop_oldest():
+    """Full queue drops the oldest batch and accounts its lines"""
+    metrics = dante_trafmon.Metrics()
+    queue = dante_trafmon.IngestQueue(2, "drop_oldest", metrics=metrics)
+    queue.put("a", ["1", "2"])
+    queue.put("b", ["3"])
+    queue.put("c", ["4", "5", "6"])
+    assert queue.get() == [("b", ["3"]), ("c", ["4", "5", "6"])]
+    assert (queue.dropped_batches, queue.dropped_lines) == (1, 2)
+    text = metrics.render().decode("utf-8")
+    assert "dante_trafmon_ingest_dropped_lines_total 2" in text
+    queue.close()
+    assert queue.get() is None
+
+
+def test_ingest_queue_spill(tmp_path):
+    """Batches over the limit go to disk and come back after memory queue,
+    leftovers are replayed by a new queue after restart"""
+    queue = dante_trafmon.IngestQueue(1, "spill", str(tmp_path))
+    queue.put("a", ["1"])
+    queue.put("b", ["2", "3"])
+    queue.put("c", [])
+    assert queue.spilled_batches == 2
+    assert queue.get() == [("a", ["1"])]
+    assert queue.get() == [("b", ["2", "3"]), ("c", [])]
+    assert os.listdir(str(tmp_path)) == []
+
+    queue.put("d", ["4"])
+    queue.put("e", ["5"])
+    queue.close()
+    restarted = dante_trafmon.IngestQueue(1, "spill", str(tmp_path))
+    assert restarted.get() == [("e", ["5"])]
+    restarted.close()
+    assert restarted.get() is None
+
+
+def test_ingest_queue_spill_disk_errors(tmp_path):
+    """Spill directory which can not be written turns spilling into dropping
+    the oldest batches, receiver keeps going"""
+    (tmp_path / "file").write_text("")
+    queue = dante_trafmon.IngestQueue(1, "spill", str(tmp_path / "file"))
+    assert queue.policy == "drop_oldest"
+
+    metrics = dante_trafmon.Metrics()
+    queue = dante_trafmon.IngestQueue(1, "spill", str(tmp_path / "spill"), metrics)
+    os.rmdir(str(tmp_path / "spill"))
+    queue.put("a", ["1"])
+    queue.put("b", ["2", "3"])
+    assert queue.policy == "drop_oldest"
+    assert (queue.spilled_batches, queue.dropped_batches, queue.dropped_lines) == (0, 1, 1)
+    assert "dante_trafmon_ingest_dropped_lines_total 1" in metrics.render().decode("utf-8")
+    assert queue.get() == [("b", ["2", "3"])]
+
+
+def test_ingest_queue_block():
+    """Receiver waits while queue is full"""
+    queue = dante_trafmon.IngestQueue(1, "block")
+    queue.put("a", ["1"])
+    sender = threading.Thread(target=queue.put, args=("b", ["2"]))
+    sender.start()
+    sender.join(0.2)
+    assert sender.is_alive()
+    assert queue.get() == [("a", ["1"])]
+    sender.join(1)
+    assert not sender.is_alive()
+    assert queue.get() == [("b", ["2"])]
+
+
+def test_listener_with_parser_threads():
+    """Lines received by listener are counted by parser threads"""
+    app = dante_trafmon.Application()
+    app.verbose = 0
+    app.ingest_parser_threads = 2
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        app.listen_port = sock.getsockname()[1]
+    thread = dante_trafmon.LogThread("TEST", dante_trafmon.LogThread.LOG_TYPE_DANTE, app,
+                                     timer_enabled=False)
+    thread.start()
+    for _ in range(100):
+        try:
+            conn = socket.create_connection(("127.0.0.1", app.listen_port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    line = ("Jan  1 00:00:00 (1.0) danted[1]: info: pass(1): tcp/connect -: "
+            "username%alice@10.0.0.5.52112 10.0.0.1.1080 -> 10.0.0.1.52113 1.2.3.4.80 (100)\n")
+    conn.sendall(line.encode("utf-8") * 50)
+    conn.close()
+    for _ in range(100):
+        if app.counters.snapshot().get("alice", (0, 0))[0] == 5000:
+            break
+        time.sleep(0.05)
+    thread.stop()
+    thread.join()
+    assert app.counters.snapshot()["alice"][0] == 5000
+
+
+#----                          EDGE / COLLECTOR TESTS                      ----#
+
+def test_frame_reader_splits_stream():
+    """Frames split at any byte come out whole"""
+    usernames = ["alice", "bob"]
+    values = array("Q", [1, 2, 3, 4])
+    data = dante_trafmon.FrameProtocol.pack_delta("edge1", 7, 1, usernames, values) + \
+        dante_trafmon.FrameProtocol.ack(1)
+    reader = dante_trafmon.FrameReader()
+    frames = []
+    for i in range(len(data)):
+        frames.extend(reader.feed(data[i:i + 1]))
+    assert [kind for kind, _ in frames] == [dante_trafmon.FrameProtocol.DELTA,
+                                            dante_trafmon.FrameProtocol.ACK]
+    edge_id, epoch, sequence, names, counts = \
+        dante_trafmon.FrameProtocol.unpack_delta(frames[0][1])
+    assert (edge_id, epoch, sequence, names, list(counts)) == \
+        ("edge1", 7, 1, usernames, [1, 2, 3, 4])
+
+
+def start_collector(tmp_path):
+    """Start collector on a free port with file backend in tmp_path,
+    returns once its database is loaded and edge deltas are accepted"""
+    collector = dante_trafmon.Application()
+    collector.verbose = 0
+    collector.db_backend = "file"
+    collector.db_path = str(tmp_path / "traffic.db")
+    collector.state_directory = str(tmp_path)
+    collector.write_period = 0.1
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        collector.listen_port = sock.getsockname()[1]
+    thread = dante_trafmon.LogThread("COLLECTOR", dante_trafmon.LogThread.LOG_TYPE_DANTE,
+                                     collector)
+    thread.start()
+    assert wait_for(lambda: thread.edges_loaded)
+    return collector, thread
+
+
+def stop_collector(thread):
+    """Stop collector and wait for its final database write"""
+    thread.stop()
+    thread.join()
+    thread.timer.join()
+
+
+def swapped_delta(username, outgoing, incoming):
+    """Delta buffer of one user, as swapped out of counters"""
+    delta = dante_trafmon.CounterStore()
+    delta.add([username], [outgoing], [incoming])
+    return delta
+
+
+def connect_edge(collector):
+    """Create edge backend connected to collector"""
+    edge = dante_trafmon.Application()
+    edge.verbose = 0
+    edge.db_backend = "edge"
+    edge.edge_collector = "127.0.0.1:" + str(collector.listen_port)
+    edge.edge_id = "edge1"
+    writer = edge.create_storage()
+    for _ in range(100):
+        try:
+            writer.connect()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return edge, writer
+
+
+def test_edge_forwards_deltas_to_collector(tmp_path):
+    """Edge deltas are merged by collector once, even when a frame is resent,
+    and acknowledged once collector has stored them"""
+    collector, thread = start_collector(tmp_path)
+    writer = None
+    try:
+        writer = connect_edge(collector)[1]
+        writer.add_delta(swapped_delta("alice", 100, 200))
+        assert writer.write_traffic([("alice", 100, 200)])[0] == 0
+        # Acknowledgement was lost, same frame comes again
+        writer.sequence -= 1
+        writer.add_delta(swapped_delta("alice", 100, 200))
+        assert writer.write_traffic([("alice", 100, 200)])[0] == 0
+        writer.add_delta(swapped_delta("bob", 1, 2))
+        assert writer.write_traffic([("bob", 1, 2)])[0] == 0
+        # Acknowledged deltas are in collector's database already
+        assert dante_trafmon.SnapshotBackend.read_file(collector.db_path) == \
+            {"alice": (100, 200), "bob": (1, 2)}
+    finally:
+        if writer is not None:
+            writer.close()
+        stop_collector(thread)
+    assert collector.counters.snapshot() == {"alice": [100, 200], "bob": [1, 2]}
+    assert writer.frames_sent == 3
+
+
+def test_collector_restart_keeps_edge_sequences(tmp_path):
+    """Frame stored before collector restart is not merged again when edge
+    resends it to the restarted collector"""
+    collector, thread = start_collector(tmp_path)
+    writer = None
+    try:
+        edge, writer = connect_edge(collector)
+        writer.add_delta(swapped_delta("alice", 100, 200))
+        assert writer.write_traffic([("alice", 100, 200)])[0] == 0
+    finally:
+        if writer is not None:
+            writer.close()
+        stop_collector(thread)
+    assert dante_trafmon.SnapshotBackend.read_snapshot(collector.db_path)[1] == \
+        [("edge1", writer.epoch, 1)]
+
+    collector, thread = start_collector(tmp_path)
+    try:
+        # Collector stored the frame but went down before acknowledging it
+        edge.edge_collector = "127.0.0.1:" + str(collector.listen_port)
+        writer.sequence -= 1
+        writer.add_delta(swapped_delta("alice", 100, 200))
+        assert writer.write_traffic([("alice", 100, 200)])[0] == 0
+        writer.add_delta(swapped_delta("bob", 1, 2))
+        assert writer.write_traffic([("bob", 1, 2)])[0] == 0
+        assert dante_trafmon.SnapshotBackend.read_file(collector.db_path) == \
+            {"alice": (100, 200), "bob": (1, 2)}
+    finally:
+        writer.close()
+        stop_collector(thread)
+    assert collector.counters.snapshot() == {"alice": [100, 200], "bob": [1, 2]}
+
+
+def send_lines_frames(port, frames):
+    """Open FrameProtocol connection and send frames, returns the connection"""
+    conn = socket.create_connection(("127.0.0.1", port))
+    conn.sendall(dante_trafmon.FrameProtocol.MAGIC)
+    for frame in frames:
+        conn.sendall(frame)
+    return conn
+
+
+def test_sender_feeds_listener(monkeypatch):
+    """Lines piped into sender are counted under its source name,
+    next to a plain text feed"""
+    thread = start_listener(monkeypatch)
+    read_fd, write_fd = os.pipe()
+    sender = dante_trafmon.FrameSender(("127.0.0.1", thread.app.listen_port), "dante1",
+                                       os.fdopen(read_fd, "rb", buffering=0))
+    sender.FLUSH_INTERVAL = 0.05
+    runner = threading.Thread(target=sender.run)
+    runner.start()
+    try:
+        plain = socket.create_connection(("127.0.0.1", thread.app.listen_port))
+        plain.sendall((OUT_LINE.format(user="bob", nbytes=7) + "\n").encode())
+        data = "".join(OUT_LINE.format(user="alice", nbytes=100) + "\n"
+                       for _ in range(2000)).encode()
+        # Line split between writes, the last one has no newline
+        for offset in range(0, len(data), 999):
+            os.write(write_fd, data[offset:offset + 999])
+        os.write(write_fd, IN_LINE.format(user="alice", nbytes=5).encode())
+        os.close(write_fd)
+        runner.join(10)
+        assert not runner.is_alive()
+        assert wait_for(lambda: thread.app.counters.snapshot().get("alice") == [200000, 5])
+        assert wait_for(lambda: thread.app.counters.snapshot().get("bob") == [7, 0])
+        plain.close()
+        values = thread.app.metrics.values
+        assert values[("lines_total", (("source", "dante1"),))] == 2001
+        # Frames leave out newline after their last line, input had none at its end
+        assert values[("decompressed_bytes_total", (("source", "dante1"),))] == \
+            sender.bytes_read - sender.frames_sent + 1
+        assert sender.bytes_sent < sender.bytes_read / 10
+        assert sender.frames_sent > 1
+    finally:
+        thread.stop()
+        thread.join()
+
+
+def test_source_waits_for_whole_magic():
+    """Protocol is chosen once enough bytes arrive, magic split over reads
+    is still a frame connection and a short plain line is still a line"""
+    magic = dante_trafmon.FrameProtocol.MAGIC
+    frame = dante_trafmon.FrameProtocol.pack_lines(zlib.compressobj(), "dante1", 1, 1, b"line")
+    local, remote = socket.socketpair()
+    try:
+        source = dante_trafmon.SourceConnection(local, None)
+        remote.sendall(magic[:2])
+        assert source.receive() == []
+        remote.sendall(magic[2:] + frame)
+        assert source.receive() == []
+        assert source.reader is not None
+        assert [kind for kind, _ in source.frames] == [dante_trafmon.FrameProtocol.LINES]
+    finally:
+        local.close()
+        remote.close()
+
+    local, remote = socket.socketpair()
+    try:
+        source = dante_trafmon.SourceConnection(local, None)
+        remote.sendall(magic[:1])
+        assert source.receive() == []
+        remote.sendall(b"x\n")
+        assert source.receive() == [magic[:1].decode() + "x"]
+        assert source.reader is None
+    finally:
+        local.close()
+        remote.close()
+
+
+def test_lines_frames_resent_and_lost(monkeypatch):
+    """Frame resent on a new connection is skipped, missing sequences are
+    counted, broken stream closes the connection"""
+    protocol = dante_trafmon.FrameProtocol
+    thread = start_listener(monkeypatch)
+
+    def frame(compressor, sequence, nbytes):
+        line = OUT_LINE.format(user="alice", nbytes=nbytes).encode()
+        return protocol.pack_lines(compressor, "dante1", 7, sequence, line)
+
+    try:
+        first = zlib.compressobj()
+        conn = send_lines_frames(thread.app.listen_port,
+                                 [frame(first, 1, 1), frame(first, 2, 10)])
+        assert wait_for(lambda: thread.app.counters.snapshot().get("alice") == [11, 0])
+        conn.close()
+        second = zlib.compressobj()
+        conn = send_lines_frames(thread.app.listen_port,
+                                 [frame(second, 2, 10), frame(second, 5, 100)])
+        assert wait_for(lambda: thread.app.counters.snapshot().get("alice") == [111, 0])
+        values = thread.app.metrics.values
+        assert values[("line_frames_total", (("result", "applied"),))] == 3
+        assert values[("line_frames_total", (("result", "duplicate"),))] == 1
+        assert values[("line_frames_total", (("result", "lost"),))] == 2
+        # Not a continuation of this connection's zlib stream
+        conn.sendall(frame(zlib.compressobj(), 6, 1000))
+        assert wait_for(lambda: len(thread.connections) == 0)
+        conn.close()
+        assert thread.app.counters.snapshot()["alice"] == [111, 0]
+    finally:
+        thread.stop()
+        thread.join()
+
+#----                               RATES TESTS                            ----#
+
+def test_parser_timestamps():
+    """Log time is parsed when asked for, lines without it get 0.0"""
+    parser = dante_trafmon.IoopParser(timestamps=True)
+    assert parser.parse(OUT_LINE.format(user="alice", nbytes=1)).timestamp == 1792324801.123456
+    line = OUT_LINE.format(user="alice", nbytes=1).replace("(1792324801.123456) ", "")
+    assert parser.parse(line).timestamp == 0.0
+    assert dante_trafmon.IoopParser().parse(OUT_LINE.format(user="alice", nbytes=1)) \
+        .timestamp == 0.0
+
+
+def test_rates_of_steady_user():
+    """1000 bytes/sec for ten minutes reads as about 1000 bytes/sec
+    on short windows, less on the 5 minutes one which is still filling up"""
+    rates = dante_trafmon.RateEstimator()
+    start = time.time() - 600
+    for second in range(600):
+        rates.add_records([record("alice", "1.2.3.4.80", 1000)._replace(timestamp=start + second)],
+                          now=start + second)
+    ten_seconds, minute, five_minutes = rates.rates("alice", now=start + 600)
+    assert 900 < ten_seconds < 1060
+    assert 950 < minute < 1010
+    assert 820 < five_minutes < 890
+    assert rates.rates("bob") is None
+
+
+def test_rates_top_users_match_full_scan():
+    """Top users kept with each batch are the ones a full scan finds,
+    also after landmarks move"""
+    rates = dante_trafmon.RateEstimator(top_k=5)
+    now = time.time()
+    for step in range(200):
+        batch = [record("user%d" % ((step * 7 + i) % 40), "1.2.3.4.80", (step * 31 + i * 17) % 997)
+                 ._replace(timestamp=now + step * 0.5) for i in range(5)]
+        rates.add_records(batch, now=now + step * 0.5)
+    # Right after 10s window landmark moves
+    later = dante_trafmon.RateEstimator.landmark(10, now) + 2001
+    with rates.lock:
+        rates.check_landmarks(later)
+    for index in range(len(rates.WINDOWS)):
+        expected = sorted(((username, rates.rates(username, later)[index])
+                           for username in rates.sums), key=lambda item: -item[1])[:3]
+        top = rates.top(3, index, later)
+        assert [username for username, _ in top] == [username for username, _ in expected]
+        assert [rate for _, rate in top] == pytest.approx([rate for _, rate in expected])
+
+
+def test_rates_shipped_by_worker():
+    """Sums drained from worker estimator add up in aggregator's one"""
+    worker = dante_trafmon.RateEstimator(top_k=0)
+    aggregator = dante_trafmon.RateEstimator()
+    now = time.time()
+    worker.add_records([record("alice", "1.2.3.4.80", 5000)._replace(timestamp=now)], now=now)
+    aggregator.add_records([record("alice", "1.2.3.4.80", 5000)._replace(timestamp=now)],
+                           now=now)
+    aggregator.add_rows(*worker.drain())
+    assert worker.sums == {}
+    assert aggregator.rates("alice", now)[0] == pytest.approx(1000, rel=0.01)
+    assert aggregator.top(1, 0, now)[0][0] == "alice"